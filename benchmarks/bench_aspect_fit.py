@@ -0,0 +1,182 @@
+"""アスペクト比調整のベンチマークと、旧実装（1ピクセルずつ調整するループ）との等価性チェック
+
+使い方:
+    python benchmarks/bench_aspect_fit.py --count 20000
+
+等価性の基準:
+    - 新実装の結果は常に画像の範囲内で、比率が厳密に p:q であること
+    - 旧実装（16:9）の結果が元の領域を含む場合は、幅・高さの差が比率1段分（幅16px・高さ9px）+丸め誤差1px 以内であること
+    - 旧実装が画像の端で領域を削った場合（画像内でずらさずに縮めるため元の領域を含まない）は、
+      新実装の矩形が旧実装以上の大きさであること（厳密な比率にするための比率1段分の差は許容する）
+    - ベクトル化版 fit_aspect_ratio_batch の結果がスカラー版 fit_aspect_ratio と完全に一致すること
+いずれかを満たさない場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from cropping import fit_aspect_ratio, fit_aspect_ratio_batch
+
+
+def legacy_adjust_crop_to_exact_16_9_ratio(crop_coordinates, img_width, img_height):
+    """比較用の旧実装（ログ出力を除いたもの）"""
+    x_min = crop_coordinates["x_min"]
+    y_min = crop_coordinates["y_min"]
+    x_max = crop_coordinates["x_max"]
+    y_max = crop_coordinates["y_max"]
+    current_width = x_max - x_min
+    current_height = y_max - y_min
+    target_ratio = 16/9
+    current_ratio = current_width / current_height if current_height != 0 else 0
+
+    if current_ratio <= target_ratio:
+        new_width = int(current_height * target_ratio + 0.5)
+        width_diff = new_width - current_width
+        new_x_min = max(0, x_min - width_diff // 2)
+        new_x_max = min(img_width, new_x_min + new_width)
+        if new_x_max > img_width:
+            new_x_max = img_width
+            new_x_min = max(0, new_x_max - new_width)
+        new_y_min = y_min
+        new_y_max = y_max
+    else:
+        new_height = int(current_width / target_ratio + 0.5)
+        height_diff = new_height - current_height
+        new_y_min = max(0, y_min - height_diff // 2)
+        new_y_max = min(img_height, new_y_min + new_height)
+        if new_y_max > img_height:
+            new_y_max = img_height
+            new_y_min = max(0, new_y_max - new_height)
+        new_x_min = x_min
+        new_x_max = x_max
+
+    new_x_min = max(0, int(new_x_min))
+    new_y_min = max(0, int(new_y_min))
+    new_x_max = min(img_width, int(new_x_max))
+    new_y_max = min(img_height, int(new_y_max))
+
+    final_ratio = (new_x_max - new_x_min) / (new_y_max - new_y_min)
+    if abs(final_ratio - target_ratio) > 0.0001:
+        if final_ratio < target_ratio:
+            while (new_x_max - new_x_min) / (new_y_max - new_y_min) < target_ratio and new_x_max < img_width:
+                new_x_max += 1
+            while (new_x_max - new_x_min) / (new_y_max - new_y_min) < target_ratio and new_y_max > new_y_min + 1:
+                new_y_max -= 1
+        else:
+            while (new_x_max - new_x_min) / (new_y_max - new_y_min) > target_ratio and new_y_max < img_height:
+                new_y_max += 1
+            while (new_x_max - new_x_min) / (new_y_max - new_y_min) > target_ratio and new_x_max > new_x_min + 1:
+                new_x_max -= 1
+
+    return {"x_min": new_x_min, "y_min": new_y_min, "x_max": new_x_max, "y_max": new_y_max}
+
+
+def random_cases(count, seed):
+    """ランダムな画像サイズとクロップ座標の組み合わせを生成"""
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(count):
+        img_width = rng.randint(320, 6000)
+        img_height = rng.randint(240, 6000)
+        x_min = rng.randint(0, img_width - 2)
+        y_min = rng.randint(0, img_height - 2)
+        x_max = rng.randint(x_min + 1, img_width)
+        y_max = rng.randint(y_min + 1, img_height)
+        cases.append(({"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}, img_width, img_height))
+    return cases
+
+
+def check_equivalence(cases):
+    """新実装が旧実装と等価な結果を返すか確認し、失敗したケースのリストを返す"""
+    failures = []
+    for coords, img_width, img_height in cases:
+        new = fit_aspect_ratio(coords, img_width, img_height, ratio=(16, 9))
+        old = legacy_adjust_crop_to_exact_16_9_ratio(coords, img_width, img_height)
+        new_width = new["x_max"] - new["x_min"]
+        new_height = new["y_max"] - new["y_min"]
+        old_width = old["x_max"] - old["x_min"]
+        old_height = old["y_max"] - old["y_min"]
+        problems = []
+        if new["x_min"] < 0 or new["y_min"] < 0 or new["x_max"] > img_width or new["y_max"] > img_height:
+            problems.append("範囲外")
+        if new_width * 9 != new_height * 16:
+            problems.append("比率が16:9ではない")
+        old_contains = (old["x_min"] <= coords["x_min"] and old["y_min"] <= coords["y_min"]
+                        and old["x_max"] >= coords["x_max"] and old["y_max"] >= coords["y_max"])
+        if old_contains:
+            if abs(new_width - old_width) > 16 + 1 or abs(new_height - old_height) > 9 + 1:
+                problems.append(f"旧実装とのサイズ差が大きい (新: {new_width}x{new_height}, 旧: {old_width}x{old_height})")
+        elif new_width < old_width - 16 - 1 or new_height < old_height - 9 - 1:
+            problems.append(f"旧実装より小さい (新: {new_width}x{new_height}, 旧: {old_width}x{old_height})")
+        if problems:
+            failures.append({"coords": coords, "size": [img_width, img_height], "problems": problems})
+
+    boxes = np.array([[c["x_min"], c["y_min"], c["x_max"], c["y_max"]] for c, _, _ in cases])
+    widths = np.array([w for _, w, _ in cases])
+    heights = np.array([h for _, _, h in cases])
+    for ratio in [(16, 9), (4, 3), (1, 1), "2.39"]:
+        for mode in ["expand", "shrink"]:
+            batch = fit_aspect_ratio_batch(boxes, widths, heights, ratio=ratio, mode=mode)
+            for row, (coords, img_width, img_height) in zip(batch, cases):
+                scalar = fit_aspect_ratio(coords, img_width, img_height, ratio=ratio, mode=mode)
+                if list(row) != [scalar["x_min"], scalar["y_min"], scalar["x_max"], scalar["y_max"]]:
+                    failures.append({"coords": coords, "size": [img_width, img_height],
+                                     "problems": [f"ベクトル化版の結果が一致しない (ratio={ratio}, mode={mode})"]})
+                    break
+    return failures
+
+
+def benchmark(cases, repeat):
+    """旧実装・スカラー版・ベクトル化版の1件あたりの処理時間(マイクロ秒)を計測"""
+    boxes = np.array([[c["x_min"], c["y_min"], c["x_max"], c["y_max"]] for c, _, _ in cases])
+    widths = np.array([w for _, w, _ in cases])
+    heights = np.array([h for _, _, h in cases])
+
+    def best_of(func):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return min(timings) / len(cases) * 1e6
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return {
+            "legacy_us_per_box": best_of(lambda: [legacy_adjust_crop_to_exact_16_9_ratio(*case) for case in cases]),
+            "closed_form_us_per_box": best_of(lambda: [fit_aspect_ratio(*case) for case in cases]),
+            "vectorized_us_per_box": best_of(lambda: fit_aspect_ratio_batch(boxes, widths, heights)),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='アスペクト比調整のベンチマークと等価性チェック')
+    parser.add_argument('--count', type=int, default=20000, help='ランダムに生成するケース数(デフォルト: 20000)')
+    parser.add_argument('--seed', type=int, default=0, help='乱数シード(デフォルト: 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='計測の繰り返し回数(デフォルト: 3)')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    cases = random_cases(args.count, args.seed)
+    failures = check_equivalence(cases)
+    timings = benchmark(cases, args.repeat)
+
+    report = {"count": args.count, "failures": len(failures), **timings}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    for failure in failures[:10]:
+        print("失敗:", json.dumps(failure, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
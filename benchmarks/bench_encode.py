@@ -0,0 +1,126 @@
+"""出力段（エンコード・書き込み）のベンチマーク（スレッドのみ と プロセスプールの比較）
+
+使い方:
+    python benchmarks/bench_encode.py --count 64 --size 4000x3000 --crop_workers 8 --encode_workers 8
+
+合成画像から count 件のクロップを作成し、crop_and_save_image で保存する時間を次の方法で比較する。
+    - threads: クロップワーカーのスレッドでエンコード・書き込みを行う
+    - processes: エンコード・書き込みを encode_workers 個のプロセスで行う
+出力ファイル名は content_output_filename で決め、同じ内容の出力が同じパスになることも確認する。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+import cropping
+from metrics import RequestMetrics
+
+
+def make_source(path, width, height, seed=0):
+    """ノイズを含む合成画像（JPEGの圧縮が効きにくい）を作成"""
+    rng = np.random.default_rng(seed)
+    base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None].repeat(height, axis=0).repeat(3, axis=2)
+    noise = rng.normal(0, 24, (height, width, 3)).astype(np.float32)
+    Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8)).save(path, quality=92)
+
+
+def run(job, boxes, output_dir, crop_workers, encode_pool, renditions):
+    metrics = [RequestMetrics() for _ in boxes]
+    paths = [
+        cropping.content_output_filename(output_dir, job.sha256, f"工程{index}", "0x0@16:9")
+        for index in range(len(boxes))
+    ]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=crop_workers) as pool:
+        futures = [
+            pool.submit(cropping.crop_and_save_image, job, box, path, renditions=renditions, metrics=metric,
+                        encode_pool=encode_pool)
+            for box, path, metric in zip(boxes, paths, metrics)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for result in results if result[0] is None)
+    total = RequestMetrics()
+    for metric in metrics:
+        total.merge(metric)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "items_per_s": round(len(boxes) / elapsed, 1),
+        "failed": failed,
+        "encode_s": round(total.timings.get("encode", 0.0), 3),
+        "write_s": round(total.timings.get("write", 0.0), 3),
+        "output_bytes": total.values.get("output_bytes", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='出力段のベンチマーク')
+    parser.add_argument('--count', type=int, default=64, help='保存するクロップの数(デフォルト: 64)')
+    parser.add_argument('--size', default='4000x3000', help='合成画像のサイズ(デフォルト: 4000x3000)')
+    parser.add_argument('--crop_workers', type=int, default=os.cpu_count() or 1, help='クロップワーカーのスレッド数(デフォルト: CPUコア数)')
+    parser.add_argument('--encode_workers', type=int, default=os.cpu_count() or 1, help='エンコードのプロセス数(デフォルト: CPUコア数)')
+    parser.add_argument('--rendition', action='append', default=None, help='追加で保存するレンディション（cropping.py と同じ形式）')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    cropping.QUIET = True
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    renditions = [cropping.parse_rendition(spec) for spec in args.rendition or []]
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "source.jpg")
+        make_source(source, width, height)
+        job = cropping.ImageJob.from_path(source)
+        job.image  # デコードは計測に含めない
+        rng = np.random.default_rng(1)
+        boxes = []
+        for _ in range(args.count):
+            box_width = int(width * rng.uniform(0.3, 0.6))
+            box_height = int(height * rng.uniform(0.3, 0.6))
+            x_min = int(rng.integers(0, width - box_width))
+            y_min = int(rng.integers(0, height - box_height))
+            boxes.append({"x_min": x_min, "y_min": y_min, "x_max": x_min + box_width, "y_max": y_min + box_height})
+
+        threads = run(job, boxes, os.path.join(directory, "threads"), args.crop_workers, None, renditions)
+        with ProcessPoolExecutor(max_workers=args.encode_workers) as encode_pool:
+            processes = run(job, boxes, os.path.join(directory, "processes"), args.crop_workers, encode_pool,
+                            renditions)
+        # 同じ入力からは同じファイル名・同じ内容になること
+        names = sorted(os.path.relpath(os.path.join(root, name), os.path.join(directory, "threads"))
+                       for root, _, files in os.walk(os.path.join(directory, "threads")) for name in files)
+        names_match = names == sorted(
+            os.path.relpath(os.path.join(root, name), os.path.join(directory, "processes"))
+            for root, _, files in os.walk(os.path.join(directory, "processes")) for name in files
+        )
+
+    report = {
+        "count": args.count,
+        "size": args.size,
+        "cpu_count": os.cpu_count(),
+        "crop_workers": args.crop_workers,
+        "encode_workers": args.encode_workers,
+        "threads": threads,
+        "processes": processes,
+        "speedup": round(threads["elapsed_s"] / processes["elapsed_s"], 2),
+        "deterministic_names": names_match,
+        "temporary_files_left": sum(1 for name in names if ".tmp." in name),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if threads["failed"] or processes["failed"] or not names_match:
+        print("失敗: 保存に失敗したクロップがあるか、出力ファイル名が一致しません")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""段階的なモデルの切り替え（軽量なモデル → 大きいモデル）のベンチマーク
+
+使い方:
+    python benchmarks/bench_escalation.py --requests 100 --hard_rate 0.2 --fast_latency 0.08 --full_latency 0.3
+
+疑似APIサーバー（fake_openai_server.py）を、モデルごとの応答時間と「難しい画像」の割合を指定して起動し、
+同じ画像・指示を次の2つの方法で1件ずつ処理する。
+    - single: 常に大きいモデル（gpt-4.1）に問い合わせる
+    - tiered: まず --fast_model に問い合わせ、結果がほぼ全体・確からしさが低いなどの場合だけ大きいモデルで取り直す
+1件あたりの時間（平均・p50・p95）、エスカレーションの割合と理由、段ごとの時間・トークン数、
+--fast_cost_ratio（軽量なモデルのトークン単価の、大きいモデルに対する比）で換算した相対的なコストを比較する。
+エスカレーションした件数がサーバーが難しい画像の結果を返した件数と一致しない場合や、
+tiered の平均時間が single より長い場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from PIL import Image
+
+import cropping
+from escalation import EscalationPolicy
+from fake_openai_server import FakeOpenAIServer
+
+
+def make_images(directory, count):
+    """ぼかしたノイズによる模様の合成画像を作成してパスのリストを返す"""
+    paths = []
+    for seed in range(count):
+        rng = np.random.default_rng(seed)
+        coarse = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        path = os.path.join(directory, f"image_{seed}.jpg")
+        Image.fromarray(coarse).resize((640, 480), Image.Resampling.BICUBIC).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def _summary(latencies):
+    ordered = sorted(latencies)
+    return {
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+    }
+
+
+def run(mode, paths, args):
+    server = FakeOpenAIServer(
+        rpm=1000000, burst=1000000, latency=args.full_latency, seed=args.seed, hard_rate=args.hard_rate,
+        model_latency={args.fast_model: args.fast_latency}
+    ).start()
+    try:
+        client = cropping._create_client(base_url=server.base_url, api_key="benchmark")
+        escalation = EscalationPolicy(args.fast_model, min_confidence=args.min_confidence) if mode == "tiered" else None
+        latencies = []
+        failures = 0
+        tokens = 0
+        for number in range(args.requests):
+            job = cropping.ImageJob.from_path(paths[number % len(paths)])
+            started = time.perf_counter()
+            result = cropping.analyze_image(job, [f"工程{number + 1}の手元"], client=client, escalation=escalation)[0]
+            latencies.append(time.perf_counter() - started)
+            failures += bool(cropping.validate_crop_result(result))
+            if isinstance(result, dict):
+                tokens += (result.get('metrics') or {}).get('total_tokens') or 0
+        report = {"requests": args.requests, "failures": failures, **_summary(latencies), "tokens": tokens,
+                  "server": server.stats()}
+        if escalation is None:
+            report["weighted_tokens"] = tokens
+            return report
+        stats = escalation.stats()
+        tiers = stats["tiers"]
+        fast_tokens = tiers.get("fast", {}).get("prompt_tokens", 0) + tiers.get("fast", {}).get("completion_tokens", 0)
+        full_tokens = tiers.get("full", {}).get("prompt_tokens", 0) + tiers.get("full", {}).get("completion_tokens", 0)
+        report["escalation"] = stats
+        report["weighted_tokens"] = fast_tokens * args.fast_cost_ratio + full_tokens
+        return report
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='段階的なモデルの切り替えのベンチマーク')
+    parser.add_argument('--requests', type=int, default=100, help='処理する件数(デフォルト: 100)')
+    parser.add_argument('--images', type=int, default=10, help='使う合成画像の枚数(デフォルト: 10)')
+    parser.add_argument('--fast_model', default='gpt-4.1-mini', help='軽量なモデル(デフォルト: gpt-4.1-mini)')
+    parser.add_argument('--fast_latency', type=float, default=0.08, help='軽量なモデルの応答時間(秒)(デフォルト: 0.08)')
+    parser.add_argument('--full_latency', type=float, default=0.3, help='大きいモデルの応答時間(秒)(デフォルト: 0.3)')
+    parser.add_argument('--hard_rate', type=float, default=0.2, help='軽量なモデルが難しい画像の結果を返す割合(デフォルト: 0.2)')
+    parser.add_argument('--min_confidence', type=float, default=0.6, help='大きいモデルに切り替える確からしさの下限(デフォルト: 0.6)')
+    parser.add_argument('--fast_cost_ratio', type=float, default=0.2, help='軽量なモデルのトークン単価の、大きいモデルに対する比(デフォルト: 0.2)')
+    parser.add_argument('--seed', type=int, default=0, help='疑似APIサーバーの乱数のシード(デフォルト: 0)')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    cropping.QUIET = True
+    # openai の読み込みを計測に含めない
+    import openai  # noqa: F401
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_images(directory, args.images)
+        report = {mode: run(mode, paths, args) for mode in ("single", "tiered")}
+
+    single = report["single"]
+    tiered = report["tiered"]
+    tiered["relative_cost"] = round(tiered["weighted_tokens"] / single["weighted_tokens"], 3) if single["weighted_tokens"] else None
+    report["speedup"] = round(single["mean_ms"] / tiered["mean_ms"], 2) if tiered["mean_ms"] else None
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    mismatch = tiered["escalation"]["escalated"] != tiered["server"]["hard"]
+    if mismatch or tiered["failures"] or single["failures"] or tiered["mean_ms"] > single["mean_ms"]:
+        print("失敗: エスカレーションの件数が難しい画像の件数と一致しないか、失敗した件数があるか、tiered の方が遅くなりました")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
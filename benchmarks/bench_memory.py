@@ -0,0 +1,164 @@
+"""大きい画像モードとメモリ予算のベンチマーク（最大メモリ使用量の比較）
+
+使い方:
+    python benchmarks/bench_memory.py --size 8000x6000 --images 4 --crop_workers 4 --memory_budget_mb 400
+
+合成画像（JPEG・PNG）を作成し、それぞれ別のプロセスで次の処理の最大メモリ使用量（VmHWM）を測る。
+    - single: 1枚の画像のbase64エンコードとクロップ・保存を、通常のモードと大きい画像モードで比較する
+    - batch: images 枚の画像のバッチ処理（ローカルのバックエンド）を、メモリ予算なしと memory_budget_mb で比較する
+大きい画像モードの出力が通常のモードと同じでない場合や、バッチ処理に失敗した行がある場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_source(path, width, height):
+    """グラデーションとノイズを含む合成画像を作成"""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=2)
+    pixels += rng.normal(0, 8, pixels.shape).astype(np.float32)
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=92)
+
+
+def peak_mb():
+    """このプロセスの最大メモリ使用量（MB）
+
+    ru_maxrss は fork 元のプロセスの値を引き継ぐため、Linux ではプロセスごとの VmHWM を使う。
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child_single(args):
+    """1枚の画像をbase64エンコードしてからクロップ・保存し、最大メモリ使用量と出力のハッシュを返す"""
+    import cropping
+    cropping.QUIET = True
+    job = cropping.ImageJob.from_path(args.source, large_image_bytes=1 if args.large else 0)
+    base64_image, _ = cropping.encode_image_to_base64(job)
+    base64_hash = hashlib.sha256(base64_image.encode('ascii')).hexdigest()
+    del base64_image
+    width, height = job.size
+    # 画像の上側の中央付近を切り出す
+    box = {"x_min": width // 4, "y_min": height // 10, "x_max": width * 3 // 4, "y_max": height * 4 // 10}
+    cropping.crop_and_save_image(job, box, args.output)
+    with open(args.output, "rb") as f:
+        output_hash = hashlib.sha256(f.read()).hexdigest()
+    return {"peak_mb": round(peak_mb(), 1), "base64_sha256": base64_hash, "output_sha256": output_hash}
+
+
+def child_batch(args):
+    """ローカルのバックエンドでバッチ処理を行い、最大メモリ使用量と成功件数を返す"""
+    import io
+    import contextlib
+    import cropping
+    from memory_budget import MemoryBudget
+    cropping.QUIET = True
+    budget = MemoryBudget(int(args.memory_budget_mb * 1024 * 1024)) if args.memory_budget_mb else None
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        records = cropping.run_batch(
+            args.source, output_dir=args.output, results_path=os.path.join(args.output, "results.jsonl"),
+            concurrency=args.crop_workers, crop_workers=args.crop_workers, backend="local",
+            large_image_bytes=int(args.large_image_mb * 1024 * 1024), memory_budget=budget
+        )
+    report = {
+        "peak_mb": round(peak_mb(), 1),
+        "elapsed_s": round(time.perf_counter() - started, 2),
+        "succeeded": sum(1 for record in records if record["status"] == "ok"),
+        "failed": sum(1 for record in records if record["status"] != "ok"),
+    }
+    if budget is not None:
+        stats = budget.stats()
+        report.update(budget_peak_mb=round(stats["peak"] / 1024 / 1024, 1), waited=stats["waited"])
+    return report
+
+
+def run_child(*options):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", *options],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='大きい画像モードとメモリ予算のベンチマーク')
+    parser.add_argument('--size', default='8000x6000', help='合成画像のサイズ(デフォルト: 8000x6000)')
+    parser.add_argument('--images', type=int, default=4, help='バッチ処理に使う画像の枚数(デフォルト: 4)')
+    parser.add_argument('--crop_workers', type=int, default=4, help='バッチ処理のワーカー数(デフォルト: 4)')
+    parser.add_argument('--memory_budget_mb', type=float, default=400, help='バッチ処理のメモリ予算(MB)(デフォルト: 400)')
+    parser.add_argument('--large_image_mb', type=float, default=64, help='バッチ処理で大きい画像モードにする画像のデコード後のサイズ(MB)(デフォルト: 64)')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    # 以下は計測用の子プロセスが使う
+    parser.add_argument('--child', choices=['single', 'batch'], help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    parser.add_argument('--large', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child_single(args) if args.child == 'single' else child_batch(args)))
+        return
+
+    width, height = (int(value) for value in args.size.lower().split('x'))
+    report = {"size": args.size, "single": {}, "batch": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        sources = {}
+        for extension in ["jpg", "png"]:
+            sources[extension] = os.path.join(directory, f"source.{extension}")
+            make_source(sources[extension], width, height)
+            results = {
+                mode: run_child("single", "--source", sources[extension], "--output",
+                                os.path.join(directory, f"{mode}.{extension}"), *(["--large"] if mode == "large" else []))
+                for mode in ["normal", "large"]
+            }
+            report["single"][extension] = {
+                "file_mb": round(os.path.getsize(sources[extension]) / 1024 / 1024, 1),
+                "normal_peak_mb": results["normal"]["peak_mb"],
+                "large_peak_mb": results["large"]["peak_mb"],
+                "identical_output": (results["normal"]["output_sha256"] == results["large"]["output_sha256"]
+                                     and results["normal"]["base64_sha256"] == results["large"]["base64_sha256"]),
+            }
+
+        manifest_path = os.path.join(directory, "manifest.csv")
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            f.write("image,instruction\n")
+            for index in range(args.images):
+                path = os.path.join(directory, f"image_{index}.jpg")
+                os.link(sources["jpg"], path)
+                f.write(f"{path},工程{index + 1}\n")
+        for name, budget in [("unlimited", 0), ("budget", args.memory_budget_mb)]:
+            output_dir = os.path.join(directory, name)
+            report["batch"][name] = run_child(
+                "batch", "--source", manifest_path, "--output", output_dir, "--crop_workers", str(args.crop_workers),
+                "--memory_budget_mb", str(budget), "--large_image_mb", str(args.large_image_mb)
+            )
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if (not all(item["identical_output"] for item in report["single"].values())
+            or any(item["failed"] for item in report["batch"].values())):
+        print("失敗: 大きい画像モードの出力が通常のモードと異なるか、バッチ処理に失敗した行があります")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""似た画像のクロップ座標の再利用のベンチマーク（検索時間と判定の正確さ）
+
+使い方:
+    python benchmarks/bench_near_duplicate.py --entries 300000 --queries 1000 --images 20
+
+次の2つを測る。
+    - lookup: entries 件のエントリがある範囲で、NearDuplicateIndex.lookup にかかる時間（中央値・p99）
+    - matching: images 枚の合成画像の結果を登録し、縮小・再圧縮・明るさを変えた画像では再利用され（座標が
+      画像サイズに合わせて変換される）、別の画像・トリミングした画像では再利用されないことを確認する
+検索の p99 が --max_lookup_ms を超えた場合や、判定を誤った画像がある場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from contextlib import closing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+import cropping
+from perceptual_index import NearDuplicateIndex, make_scope_key, _to_signed
+
+
+def make_source(path, width, height, seed):
+    """ぼかしたノイズによる模様の合成画像（シードごとに異なる内容）を作成"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(coarse).resize((width, height), Image.Resampling.BICUBIC)
+    img.save(path, quality=92)
+
+
+def bench_lookup(directory, entries, queries):
+    """entries 件のランダムなハッシュを登録した範囲で、検索にかかる時間を測る"""
+    index = NearDuplicateIndex(os.path.join(directory, "lookup.sqlite3"))
+    scope = make_scope_key("工程1", cropping.MODEL_NAME, cropping.PROMPT_VERSION)
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(entries)]
+    value = json.dumps({"crop_coordinates": {"x_min": 0, "y_min": 0, "x_max": 10, "y_max": 10}, "description": None})
+    # 登録時間は計測の対象外のため、まとめて書き込む
+    with closing(index._connect()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO entries (scope, hash, width, height, value, created_at) VALUES (?, ?, 640, 480, ?, 0)",
+            ((scope, _to_signed(value_hash), value) for value_hash in hashes)
+        )
+    started = time.perf_counter()
+    index.lookup(scope, hashes[0], (640, 480))
+    load_ms = (time.perf_counter() - started) * 1000
+
+    timings = []
+    found = 0
+    for number in range(queries):
+        # 半分は登録済みのハッシュから数ビットを変えたもの、半分はランダムなハッシュ
+        query = hashes[rng.randrange(entries)] ^ (1 << rng.randrange(64)) if number % 2 else rng.getrandbits(64)
+        started = time.perf_counter()
+        found += index.lookup(scope, query, (640, 480)) is not None
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "entries": entries,
+        "queries": queries,
+        "first_lookup_ms": round(load_ms, 1),
+        "median_ms": round(timings[len(timings) // 2], 3),
+        "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+        "found": found,
+    }
+
+
+def bench_matching(directory, images):
+    """合成画像の結果を登録し、変形した画像で再利用されるか（されないか）を確認する"""
+    index = NearDuplicateIndex(os.path.join(directory, "matching.sqlite3"))
+    instruction = "工程1"
+    failures = []
+    counts = {"reused": 0, "not_reused": 0}
+    for seed in range(images):
+        source = os.path.join(directory, f"source_{seed}.jpg")
+        make_source(source, 1600, 1200, seed)
+        box = {"x_min": 400, "y_min": 300, "x_max": 1200, "y_max": 750}
+        cropping.store_near_duplicate(source, instruction, index, {"crop_coordinates": box, "description": "登録"})
+
+        with Image.open(source) as img:
+            variants = {
+                "resized": (img.resize((800, 600), Image.Resampling.LANCZOS), True),
+                "recompressed": (img.copy(), True),
+                "brighter": (ImageEnhance.Brightness(img).enhance(1.15), True),
+                "cropped": (img.crop((0, 0, 1200, 1200)), False),
+            }
+        for name, (variant, expected) in variants.items():
+            path = os.path.join(directory, f"variant_{seed}_{name}.jpg")
+            variant.save(path, quality=60 if name == "recompressed" else 90)
+            job = cropping.ImageJob.from_path(path)
+            reused = cropping.reuse_near_duplicate(job, instruction, index)
+            counts["reused" if reused else "not_reused"] += 1
+            if bool(reused) != expected:
+                failures.append({"seed": seed, "variant": name, "expected": expected})
+            elif reused and name == "resized" and reused["crop_coordinates"] != {
+                    "x_min": 200, "y_min": 150, "x_max": 600, "y_max": 375}:
+                failures.append({"seed": seed, "variant": name, "coordinates": reused["crop_coordinates"]})
+        # 別の画像（次のシードの画像）では再利用されないこと
+        other = os.path.join(directory, "other.jpg")
+        make_source(other, 1600, 1200, seed + 10000)
+        if cropping.reuse_near_duplicate(other, instruction, index) is not None:
+            failures.append({"seed": seed, "variant": "other", "expected": False})
+        # 別の指示文では再利用されないこと
+        if cropping.reuse_near_duplicate(source, "工程2", index) is not None:
+            failures.append({"seed": seed, "variant": "other_instruction", "expected": False})
+    return {"images": images, **counts, "stats": index.stats(), "failures": failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='似た画像のクロップ座標の再利用のベンチマーク')
+    parser.add_argument('--entries', type=int, default=300000, help='検索時間を測るインデックスのエントリ数(デフォルト: 300000)')
+    parser.add_argument('--queries', type=int, default=1000, help='検索の回数(デフォルト: 1000)')
+    parser.add_argument('--images', type=int, default=20, help='判定の確認に使う合成画像の枚数(デフォルト: 20)')
+    parser.add_argument('--max_lookup_ms', type=float, default=20, help='検索時間の p99 の上限(ms)(デフォルト: 20)')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    cropping.QUIET = True
+    with tempfile.TemporaryDirectory() as directory:
+        report = {
+            "lookup": bench_lookup(directory, args.entries, args.queries),
+            "matching": bench_matching(directory, args.images),
+        }
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report["lookup"]["p99_ms"] > args.max_lookup_ms or report["matching"]["failures"]:
+        print("失敗: 検索時間が上限を超えたか、似た画像の判定を誤った画像があります")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
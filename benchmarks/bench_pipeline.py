@@ -0,0 +1,339 @@
+"""記録したAPI応答を再生する、クロップ処理全体のベンチマークと精度の回帰テスト
+
+使い方:
+    python benchmarks/bench_pipeline.py --repeat 5 --output pipeline.json
+    python benchmarks/bench_pipeline.py --repeat 5 --baseline pipeline.json --max_slowdown 1.5
+
+benchmarks/replay/golden.json の各ケースについて、画像の仕様（サイズ・モード・形式・対象物の位置）から
+合成画像を作成し、次の処理を repeat 回ずつ行う（ネットワーク・GPUは使わない）。
+    - ImageJob.from_path で読み込む
+    - 記録したAPI応答（ChatCompletion）を返す再生用のクライアントで crop_image_with_gpt を呼び出す
+      （--proxy_max_edge で送信する画像を縮小した場合は、応答の座標を送信した画像のサイズに合わせて変換する）
+    - crop_and_save_image でクロップ・保存する
+処理段ごとのスループットとレイテンシのパーセンタイル、最大メモリ使用量（VmHWM、計測用の子プロセスの値）、
+最終的なクロップ領域とラベル付けした正解領域（golden）との IoU をJSONで出力する。
+IoU が --min_iou を下回るケースがある場合、--baseline の結果より IoU が下がったケースがある場合、
+--max_slowdown を指定して1件あたりの処理時間（中央値）がその倍率を超えて遅くなった場合は終了コード1で終了する。
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_memory import peak_mb
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "replay", "golden.json")
+
+# 1件あたりの処理時間として集計する処理段の名前
+END_TO_END = "end_to_end"
+
+
+def load_golden(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def image_path(directory, case):
+    extension = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}[case["image"]["format"]]
+    return os.path.join(directory, f"{case['name']}.{extension}")
+
+
+def make_image(spec, path):
+    """ケースの仕様から合成画像（背景の模様・まな板・対象物の楕円）を作成"""
+    import numpy as np
+    from PIL import Image, ImageDraw
+    width, height = spec["size"]
+    rng = np.random.default_rng(spec["seed"])
+    coarse = rng.integers(90, 200, (6, 8, 3), dtype=np.uint8)
+    img = Image.fromarray(coarse).resize((width, height), Image.Resampling.BICUBIC)
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    img = Image.blend(img, noise, 0.15)
+    draw = ImageDraw.Draw(img)
+    x_min, y_min, x_max, y_max = spec["object"]
+    margin_x, margin_y = (x_max - x_min) // 4, (y_max - y_min) // 8
+    draw.rectangle([x_min - margin_x, y_min - margin_y, x_max + margin_x, y_max + margin_y], fill=(181, 136, 99))
+    draw.ellipse([x_min, y_min, x_max, y_max], fill=(220, 80, 40), outline=(90, 40, 20), width=max(2, width // 400))
+
+    mode = spec["mode"]
+    if mode == "P":
+        img = img.quantize(64)
+    elif mode in ("RGBA", "LA"):
+        # 周囲の帯を半透明にする
+        alpha = Image.new('L', img.size, 255)
+        band = max(4, min(width, height) // 20)
+        ImageDraw.Draw(alpha).rectangle([0, 0, width - 1, height - 1], outline=96, width=band)
+        img = img.convert('L' if mode == "LA" else 'RGB')
+        img.putalpha(alpha)
+    options = {"JPEG": {"quality": 90}, "WEBP": {"quality": 85}}.get(spec["format"], {})
+    img.save(path, spec["format"], **options)
+
+
+def iou(box, other):
+    """2つの矩形（crop_coordinates の形式）の IoU"""
+    width = min(box["x_max"], other["x_max"]) - max(box["x_min"], other["x_min"])
+    height = min(box["y_max"], other["y_max"]) - max(box["y_min"], other["y_min"])
+    intersection = max(0, width) * max(0, height)
+    area = lambda b: (b["x_max"] - b["x_min"]) * (b["y_max"] - b["y_min"])
+    union = area(box) + area(other) - intersection
+    return intersection / union if union else 0.0
+
+
+def percentile(sorted_values, fraction):
+    """ソート済みの値の fraction（0〜1）の位置の値（nearest-rank）"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def summarize(samples):
+    """処理段ごとの1件あたりの時間（秒）のリストから、件数・合計・スループット・パーセンタイルを求める"""
+    summary = {}
+    for stage, values in sorted(samples.items()):
+        values = sorted(values)
+        total = sum(values)
+        summary[stage] = {
+            "count": len(values),
+            "total_s": round(total, 4),
+            "items_per_s": round(len(values) / total, 1) if total else None,
+            "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+            "p90_ms": round(percentile(values, 0.9) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    return summary
+
+
+class ReplayClient:
+    """記録した応答を返す OpenAI クライアントの代わり（chat.completions.create のみ）
+
+    ユーザープロンプトの指示文で応答を選び、画像サイズが記録時と違う場合（縮小プロキシ）は座標を変換する。
+    """
+
+    def __init__(self, cases):
+        self.cases = {case["instruction"]: case for case in cases}
+        self.chat = SimpleNamespace(completions=self)
+        self.calls = 0
+
+    def create(self, **body):
+        from openai.types.chat import ChatCompletion
+        import cropping
+
+        text = body["messages"][1]["content"][0]["text"]
+        size = tuple(int(value) for value in re.search(r"幅(\d+)ピクセル、高さ(\d+)ピクセル", text).groups())
+        case = self.cases[re.search(r"「(.+?)」", text).group(1)]
+        response = json.loads(json.dumps(case["response"]))
+        if size != tuple(case["request_size"]):
+            message = response["choices"][0]["message"]
+            parsed = json.loads(cropping.extract_json_string(message["content"]))
+            parsed["crop_coordinates"] = {
+                name: round(value * (size[0] if name.startswith("x") else size[1])
+                            / (case["request_size"][0] if name.startswith("x") else case["request_size"][1]))
+                for name, value in parsed["crop_coordinates"].items()
+            }
+            message["content"] = json.dumps(parsed, ensure_ascii=False)
+        self.calls += 1
+        return ChatCompletion.model_validate(response)
+
+
+def child_run(args):
+    """全ケースを repeat 回処理し、処理段ごとの時間・ケースごとの最終座標・最大メモリ使用量を返す"""
+    import cropping
+    from metrics import RequestMetrics
+    # openai の読み込みは計測に含めない
+    from openai.types.chat import ChatCompletion  # noqa: F401
+    cropping.QUIET = True
+
+    cases = load_golden(args.golden)["cases"]
+    client = ReplayClient(cases)
+    renditions = [cropping.parse_rendition(spec) for spec in args.rendition or []]
+    large_image_bytes = int(args.large_image_mb * 1024 * 1024)
+    samples = {}
+    finals = {case["name"]: [] for case in cases}
+    case_seconds = {case["name"]: [] for case in cases}
+    errors = []
+    output_dir = os.path.join(args.image_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+
+    started = None
+    # 最初の warmup 回は計測に含めない
+    for repeat in range(-args.warmup, args.repeat):
+        if repeat == 0:
+            started = time.perf_counter()
+            samples.clear()
+            client.calls = 0
+            for name in finals:
+                finals[name].clear()
+                case_seconds[name].clear()
+        for case in cases:
+            item_started = time.perf_counter()
+            metrics = RequestMetrics()
+            with metrics.stage("read"):
+                job = cropping.ImageJob.from_path(image_path(args.image_dir, case), large_image_bytes=large_image_bytes)
+            result = cropping.crop_image_with_gpt(job, case["instruction"], proxy_max_edge=args.proxy_max_edge or None,
+                                                  client=client)
+            error = cropping.validate_crop_result(result)
+            if error:
+                errors.append({"case": case["name"], "error": error})
+                continue
+            metrics.merge(result.get("metrics"))
+            output = os.path.join(output_dir, f"{case['name']}_{repeat}.jpg")
+            saved = cropping.crop_and_save_image(
+                job, result["crop_coordinates"], output, resize_width=args.resize_width or None,
+                renditions=renditions or None, metrics=metrics
+            )
+            if saved[0] is None:
+                errors.append({"case": case["name"], "error": "クロップ・保存に失敗しました"})
+                continue
+            elapsed = time.perf_counter() - item_started
+            for stage, seconds in metrics.timings.items():
+                samples.setdefault(stage, []).append(seconds)
+            samples.setdefault(END_TO_END, []).append(elapsed)
+            case_seconds[case["name"]].append(elapsed)
+            finals[case["name"]].append(saved[1])
+            job.release()
+
+    return {
+        "elapsed_s": round(time.perf_counter() - started, 3),
+        "samples": samples,
+        "finals": finals,
+        "case_seconds": case_seconds,
+        "api_calls": client.calls,
+        "errors": errors,
+        "peak_mb": round(peak_mb(), 1),
+    }
+
+
+def compare(report, baseline, max_slowdown):
+    """前回の結果と比べた変化と、回帰（IoU の低下・処理時間の増加）の一覧を返す"""
+    changes = {"iou": {}, "p50_ratio": {}}
+    regressions = []
+    if baseline.get("options") != report["options"]:
+        # 送信する画像の縮小などの設定が違う場合は、IoU・処理時間が変わるのは想定通り
+        changes["options_differ"] = True
+    for name, case in report["accuracy"]["cases"].items():
+        before = baseline.get("accuracy", {}).get("cases", {}).get(name)
+        if before is None:
+            continue
+        changes["iou"][name] = round(case["iou"] - before["iou"], 4)
+        if case["iou"] < before["iou"] - 1e-4:
+            regressions.append(f"{name} の IoU が下がりました: {before['iou']} → {case['iou']}")
+    for stage, stats in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before and before["p50_ms"]:
+            changes["p50_ratio"][stage] = round(stats["p50_ms"] / before["p50_ms"], 2)
+    slowdown = changes["p50_ratio"].get(END_TO_END)
+    if max_slowdown and slowdown and slowdown > max_slowdown:
+        regressions.append(f"1件あたりの処理時間（中央値）が {slowdown} 倍になりました（上限 {max_slowdown} 倍）")
+    if "peak_mb" in baseline:
+        changes["peak_mb"] = round(report["peak_mb"] - baseline["peak_mb"], 1)
+    return changes, regressions
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='記録したAPI応答を再生するクロップ処理全体のベンチマークと精度の回帰テスト')
+    parser.add_argument('--golden', default=GOLDEN_PATH, help='ケース（画像の仕様・記録した応答・正解領域）のファイル(デフォルト: benchmarks/replay/golden.json)')
+    parser.add_argument('--repeat', type=int, default=5, help='各ケースを処理する回数(デフォルト: 5)')
+    parser.add_argument('--warmup', type=int, default=1, help='計測の前に各ケースを処理する回数(デフォルト: 1)')
+    parser.add_argument('--proxy_max_edge', type=int, default=0, help='API送信用の縮小プロキシ画像の長辺(px)。0の場合は元画像を送信(デフォルト: 0)')
+    parser.add_argument('--large_image_mb', type=float, default=64, help='大きい画像モードにする画像のデコード後のサイズ(MB)。0の場合は使わない(デフォルト: 64)')
+    parser.add_argument('--resize_width', type=int, default=0, help='クロップ後の画像の幅(px)。0の場合はリサイズしない(デフォルト: 0)')
+    parser.add_argument('--rendition', action='append', default=None, help='追加で保存するレンディション（cropping.py と同じ形式）')
+    parser.add_argument('--min_iou', type=float, default=0.5, help='各ケースの IoU の下限(デフォルト: 0.5)')
+    parser.add_argument('--baseline', default=None, help='比較する前回の結果（このスクリプトの --output）')
+    parser.add_argument('--max_slowdown', type=float, default=0, help='--baseline と比べた1件あたりの処理時間の倍率の上限。0の場合は確認しない(デフォルト: 0)')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    # 以下は計測用の子プロセスが使う
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--image_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child_run(args), ensure_ascii=False))
+        return
+
+    golden = load_golden(args.golden)
+    with tempfile.TemporaryDirectory() as directory:
+        for case in golden["cases"]:
+            make_image(case["image"], image_path(directory, case))
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--image_dir", directory, "--golden", args.golden,
+                   "--repeat", str(args.repeat), "--warmup", str(args.warmup), "--proxy_max_edge", str(args.proxy_max_edge),
+                   "--large_image_mb", str(args.large_image_mb), "--resize_width", str(args.resize_width)]
+        for spec in args.rendition or []:
+            command += ["--rendition", spec]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+
+    cases = {}
+    for case in golden["cases"]:
+        boxes = run["finals"][case["name"]]
+        seconds = sorted(run["case_seconds"][case["name"]])
+        cases[case["name"]] = {
+            "size": case["image"]["size"],
+            "mode": case["image"]["mode"],
+            "format": case["image"]["format"],
+            "final": boxes[0] if boxes else None,
+            "golden": case["golden"],
+            "iou": round(iou(boxes[0], case["golden"]), 4) if boxes else 0.0,
+            # 同じ入力から毎回同じ領域になること
+            "deterministic": all(box == boxes[0] for box in boxes),
+            "p50_ms": round(percentile(seconds, 0.5) * 1000, 3),
+        }
+    ious = [case["iou"] for case in cases.values()]
+    items = len(run["samples"].get(END_TO_END, []))
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "options": {"repeat": args.repeat, "warmup": args.warmup, "proxy_max_edge": args.proxy_max_edge, "large_image_mb": args.large_image_mb,
+                    "resize_width": args.resize_width, "rendition": args.rendition or []},
+        "items": items,
+        "elapsed_s": run["elapsed_s"],
+        "items_per_s": round(items / run["elapsed_s"], 1) if run["elapsed_s"] else None,
+        "api_calls": run["api_calls"],
+        "peak_mb": run["peak_mb"],
+        "stages": summarize(run["samples"]),
+        "accuracy": {
+            "mean_iou": round(sum(ious) / len(ious), 4) if ious else 0.0,
+            "min_iou": min(ious) if ious else 0.0,
+            "cases": cases,
+        },
+        "errors": run["errors"],
+    }
+    regressions = [f"{name} の IoU が下限を下回りました: {case['iou']}" for name, case in cases.items()
+                   if case["iou"] < args.min_iou]
+    regressions += [f"{name} の結果が実行ごとに異なります" for name, case in cases.items() if not case["deterministic"]]
+    regressions += [f"{error['case']}: {error['error']}" for error in run["errors"]]
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report["comparison"], baseline_regressions = compare(report, json.load(f), args.max_slowdown)
+        regressions += baseline_regressions
+    report["regressions"] = regressions
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if regressions:
+        print("失敗: " + " / ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
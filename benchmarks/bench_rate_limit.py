@@ -0,0 +1,112 @@
+"""レート制限下でのバッチ処理のベンチマーク（SDKのリトライのみ と RateLimiter の比較）
+
+使い方:
+    python benchmarks/bench_rate_limit.py --rows 40 --concurrency 8 --rpm 60 --latency 0.3
+
+疑似APIサーバー（fake_openai_server.py）を起動し、同じマニフェストを次の2つの方法で処理する。
+    - sdk: RateLimiter を使わず、OpenAIクライアントの既定のリトライ（2回）に任せる
+    - scheduler: RateLimiter（トークンバケット・同時実行数の自動調整・ジッター付きバックオフ）を使う
+成功件数・経過時間・スループット・サーバーが返した429の回数・リトライ回数を比較する。
+--min_success_rate を指定すると、scheduler の成功率がそれを下回った場合に終了コード1で終了する。
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+
+import cropping
+from rate_limit import RateLimiter
+from fake_openai_server import FakeOpenAIServer
+
+
+def write_manifest(directory, rows):
+    """テスト用の画像とマニフェスト（CSV）を作成してパスを返す"""
+    image_path = os.path.join(directory, "kitchen.jpg")
+    Image.new("RGB", (640, 480), (180, 140, 90)).save(image_path, quality=90)
+    os.makedirs(os.path.join(directory, "out"), exist_ok=True)
+    manifest_path = os.path.join(directory, "manifest.csv")
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        f.write("image,instruction,output\n")
+        for index in range(rows):
+            f.write(f"{image_path},工程{index + 1}の手元,{os.path.join(directory, 'out', f'{index:04d}.jpg')}\n")
+    return manifest_path
+
+
+def run(mode, manifest_path, output_dir, args):
+    server = FakeOpenAIServer(rpm=args.rpm, latency=args.latency, error_rate=args.error_rate, seed=args.seed).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    limiter = None
+    if mode == "scheduler":
+        limiter = RateLimiter(max_rpm=args.rpm, max_concurrency=args.concurrency, max_retries=args.max_retries,
+                              deadline=args.retry_deadline)
+    started = time.perf_counter()
+    try:
+        # バッチ処理の経過出力は結果のJSONに混ざらないよう捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            records = cropping.run_batch(
+                manifest_path, output_dir=output_dir, results_path=os.path.join(output_dir, f"{mode}.jsonl"),
+                concurrency=args.concurrency, limiter=limiter
+            )
+    finally:
+        elapsed = time.perf_counter() - started
+        server.stop()
+    succeeded = sum(1 for record in records if record["status"] == "ok")
+    report = {
+        "succeeded": succeeded,
+        "failed": len(records) - succeeded,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_min": round(succeeded / elapsed * 60, 1),
+        "server": server.stats(),
+    }
+    if limiter is not None:
+        report["limiter"] = limiter.stats()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='レート制限下でのバッチ処理のベンチマーク')
+    parser.add_argument('--rows', type=int, default=40, help='マニフェストの行数(デフォルト: 40)')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時に実行するAPIリクエスト数(デフォルト: 8)')
+    parser.add_argument('--rpm', type=int, default=60, help='疑似APIサーバーの1分あたりのリクエスト数の上限(デフォルト: 60)')
+    parser.add_argument('--latency', type=float, default=0.3, help='疑似APIサーバーの応答時間(秒)(デフォルト: 0.3)')
+    parser.add_argument('--error_rate', type=float, default=0.05, help='疑似APIサーバーが503を返す割合(デフォルト: 0.05)')
+    parser.add_argument('--max_retries', type=int, default=5, help='RateLimiter のリトライ回数(デフォルト: 5)')
+    parser.add_argument('--retry_deadline', type=float, default=120, help='RateLimiter のリトライの期限(秒)(デフォルト: 120)')
+    parser.add_argument('--seed', type=int, default=0, help='503を返すリクエストを決める乱数のシード(デフォルト: 0)')
+    parser.add_argument('--min_success_rate', type=float, default=0, help='scheduler の成功率の下限。0の場合は確認しない')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-fake")
+    cropping.QUIET = True
+    with tempfile.TemporaryDirectory() as directory:
+        manifest_path = write_manifest(directory, args.rows)
+        report = {
+            "rows": args.rows,
+            "concurrency": args.concurrency,
+            "rpm": args.rpm,
+            "sdk": run("sdk", manifest_path, directory, args),
+            "scheduler": run("scheduler", manifest_path, directory, args),
+        }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    success_rate = report["scheduler"]["succeeded"] / args.rows
+    if args.min_success_rate and success_rate < args.min_success_rate:
+        print(f"失敗: scheduler の成功率 {success_rate:.1%} が下限 {args.min_success_rate:.1%} を下回っています")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
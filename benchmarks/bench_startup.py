@@ -0,0 +1,93 @@
+"""起動時間（コールドスタート）のベンチマーク
+
+使い方:
+    python benchmarks/bench_startup.py --runs 10 --max_import_ms 300
+
+新しいPythonプロセスで cropping を読み込む時間と `cropping.py --help` の実行時間を計測する。
+あわせて、モジュールの読み込み時に matplotlib・openai・numpy が読み込まれていないことを確認し、
+読み込まれている場合や --max_import_ms を超えた場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 起動時に読み込まれてはいけない重いモジュール
+HEAVY_MODULES = ["matplotlib", "openai", "numpy"]
+
+CHECK_IMPORTS = (
+    "import sys, json, cropping; "
+    "print(json.dumps([name for name in {modules!r} if name in sys.modules]))"
+)
+
+
+def time_command(command, runs, env):
+    """コマンドを runs 回実行し、実行時間(ミリ秒)のリストを返す"""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=REPO_DIR, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings):
+    return {
+        "min_ms": round(min(timings), 1),
+        "median_ms": round(statistics.median(timings), 1),
+        "max_ms": round(max(timings), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時間のベンチマーク')
+    parser.add_argument('--runs', type=int, default=10, help='計測の繰り返し回数(デフォルト: 10)')
+    parser.add_argument('--max_import_ms', type=float, default=0, help='import cropping の中央値の上限(ミリ秒)。0の場合は確認しない')
+    parser.add_argument('--output', default=None, help='結果をJSONで書き出すパス')
+    args = parser.parse_args()
+
+    # ディスプレイのない環境を再現する
+    env = dict(os.environ)
+    env.pop("DISPLAY", None)
+    env.pop("WAYLAND_DISPLAY", None)
+
+    baseline = time_command([sys.executable, "-c", "pass"], args.runs, env)
+    import_timings = time_command([sys.executable, "-c", "import cropping"], args.runs, env)
+    help_timings = time_command([sys.executable, "cropping.py", "--help"], args.runs, env)
+
+    loaded = subprocess.run(
+        [sys.executable, "-c", CHECK_IMPORTS.format(modules=HEAVY_MODULES)],
+        cwd=REPO_DIR, env=env, check=True, capture_output=True, text=True
+    )
+    heavy_loaded = json.loads(loaded.stdout.strip().splitlines()[-1])
+
+    report = {
+        "runs": args.runs,
+        "python_startup": summarize(baseline),
+        "import_cropping": summarize(import_timings),
+        "cli_help": summarize(help_timings),
+        "heavy_modules_loaded_at_import": heavy_loaded,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = False
+    if heavy_loaded:
+        print(f"失敗: 起動時に重いモジュールが読み込まれています: {heavy_loaded}")
+        failed = True
+    if args.max_import_ms and report["import_cropping"]["median_ms"] > args.max_import_ms:
+        print(f"失敗: import cropping の中央値が上限 {args.max_import_ms}ms を超えています")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""バッチファイルから、バッチAPIの結果ファイルと同じ形式の疑似的な結果を作成する（動作確認用）
+
+使い方:
+    python cropping.py --manifest jobs.csv --batch_file batch.jsonl
+    python benchmarks/fake_batch_results.py batch.jsonl batch_output.jsonl --error_rate 0.1
+    python cropping.py --batch_file batch.jsonl --batch_results batch_output.jsonl --output_dir results
+
+応答の内容は疑似APIサーバー（fake_openai_server.py）と同じ固定の座標で、
+--error_rate の割合のリクエストはエラー（ステータス 500）の結果にする。
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai_server import build_content
+
+
+def main():
+    parser = argparse.ArgumentParser(description='バッチAPIの疑似的な結果ファイルを作成')
+    parser.add_argument('batch_file', help='cropping.py --batch_file で書き出したリクエストファイル')
+    parser.add_argument('output', help='書き出す結果ファイル（JSONL）')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='エラーの結果にする割合(デフォルト: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='エラーにするリクエストを決める乱数のシード(デフォルト: 0)')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    count = errors = 0
+    with open(args.batch_file, encoding='utf-8') as source, open(args.output, 'w', encoding='utf-8') as output:
+        for line in source:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            count += 1
+            if rng.random() < args.error_rate:
+                errors += 1
+                response = {"status_code": 500, "request_id": f"req-{count}",
+                            "body": {"error": {"message": "Internal server error", "type": "server_error"}}}
+            else:
+                response = {"status_code": 200, "request_id": f"req-{count}", "body": {
+                    "id": f"chatcmpl-batch-{count}",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": request["body"]["model"],
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": build_content(request["body"])},
+                    }],
+                    "usage": {"prompt_tokens": 1100, "completion_tokens": 60, "total_tokens": 1160},
+                }}
+            output.write(json.dumps({"id": f"batch_req_{count}", "custom_id": request["custom_id"],
+                                     "response": response, "error": None}, ensure_ascii=False) + "\n")
+    print(f"疑似的な結果を書き出しました: {args.output} ({count}件, うちエラー {errors}件)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""レート制限を再現するOpenAI互換の疑似APIサーバー（ベンチマーク・動作確認用）
+
+使い方:
+    python benchmarks/fake_openai_server.py --port 8900 --rpm 60 --latency 0.3 --error_rate 0.05
+
+POST /v1/chat/completions に対して固定のクロップ座標を返す（複数工程のリクエストには工程数分を返す）。
+1分あたりのリクエスト数（--rpm）を超えた場合は 429 と retry-after-ms を返し、
+全ての応答に x-ratelimit-* ヘッダー（上限・残量・リセットまでの時間）を付ける。
+--error_rate の割合で 503 を返し、一時的なエラーも再現する。
+段階的なモデルの切り替えの確認用に、--model_latency でモデルごとの応答時間を変えられ、
+FULL_MODEL 以外のモデルへのリクエストは --hard_rate の割合で「難しい画像」の結果
+（画像のほぼ全体の領域と低い確からしさ）を返す。確からしさはプロンプトで求められた場合のみ返す。
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CROP_RESULT = {
+    "crop_coordinates": {"x_min": 100, "y_min": 80, "x_max": 420, "y_max": 260},
+    "description": "疑似APIサーバーの固定の結果",
+}
+
+# 「難しい画像」の結果を返さない（常に固定の結果を返す）大きいモデル
+FULL_MODEL = "gpt-4.1"
+
+
+def hard_result(request):
+    """画像のほぼ全体（ユーザープロンプトの画像サイズ）の領域の結果"""
+    match = re.search(r"幅(\d+)ピクセル、高さ(\d+)ピクセル", json.dumps(request.get("messages"), ensure_ascii=False))
+    width, height = (int(match.group(1)), int(match.group(2))) if match else (640, 480)
+    return {
+        "crop_coordinates": {"x_min": 0, "y_min": 0, "x_max": width, "y_max": height},
+        "description": "疑似APIサーバーの難しい画像の結果",
+    }
+
+
+def build_content(request, hard=False):
+    """リクエストの内容に応じた応答テキスト（複数工程の場合は steps の配列）
+
+    hard の場合は難しい画像の結果を返す。プロンプトが confidence を求めている場合は確からしさを付ける。
+    """
+    messages = request.get("messages") or [{}]
+    system_prompt = str(messages[0].get("content", ""))
+    result = hard_result(request) if hard else dict(CROP_RESULT)
+    if '"confidence"' in system_prompt:
+        result["confidence"] = 0.2 if hard else 0.9
+    if "steps" not in system_prompt:
+        return json.dumps(result, ensure_ascii=False)
+    match = re.search(r"以下の(\d+)個", json.dumps(messages[-1], ensure_ascii=False))
+    count = int(match.group(1)) if match else 1
+    steps = [dict(result, step=number) for number in range(1, count + 1)]
+    return json.dumps({"steps": steps}, ensure_ascii=False)
+
+
+class FakeOpenAIServer:
+    """別スレッドで動く疑似APIサーバー
+
+    リクエスト数の制限は1分間の固定ウィンドウではなく、本物のAPIと同じく
+    1分あたり rpm 個まで連続的に補充されるバケットで計算する。
+    """
+
+    def __init__(self, port=0, rpm=60, latency=0.3, error_rate=0.0, burst=None, seed=0, model_latency=None,
+                 hard_rate=0.0):
+        self.rpm = rpm
+        self.latency = latency
+        self.model_latency = model_latency or {}
+        self.hard_rate = hard_rate
+        self.error_rate = error_rate
+        self.capacity = burst or max(1, rpm // 10)
+        self.available = float(self.capacity)
+        self.updated = time.monotonic()
+        self.random = random.Random(seed)
+        self.counts = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0, "hard": 0, "models": {}}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def _admit(self):
+        """リクエストを受け付けるか判定し、(受け付けたか, 残量, 次の1件までの秒数, エラーにするか) を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rpm / 60)
+            self.updated = now
+            self.counts["requests"] += 1
+            wait = max(0.0, (1 - self.available) * 60 / self.rpm)
+            if self.available < 1:
+                self.counts["rate_limited"] += 1
+                return False, 0, wait, False
+            self.available -= 1
+            failed = self.random.random() < self.error_rate
+            self.counts["errors" if failed else "ok"] += 1
+            return True, int(self.available), wait, failed
+
+    def _is_hard(self, model):
+        """このリクエストに難しい画像の結果を返すか（大きいモデル以外のみ）"""
+        with self._lock:
+            self.counts["models"][model] = self.counts["models"].get(model, 0) + 1
+            hard = model != FULL_MODEL and self.random.random() < self.hard_rate
+            self.counts["hard"] += hard
+            return hard
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, headers):
+                body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                admitted, remaining, wait, failed = fake._admit()
+                headers = {
+                    "x-ratelimit-limit-requests": str(fake.rpm),
+                    "x-ratelimit-remaining-requests": str(remaining),
+                    "x-ratelimit-reset-requests": f"{wait:.3f}s",
+                }
+                if not admitted:
+                    headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers)
+                    return
+                model = request.get("model") or FULL_MODEL
+                time.sleep(fake.model_latency.get(model, fake.latency))
+                if failed:
+                    self._send(503, {"error": {"message": "Service unavailable", "type": "server_error"}}, headers)
+                    return
+                self._send(200, {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": build_content(request, fake._is_hard(model))},
+                    }],
+                    "usage": {"prompt_tokens": 1100, "completion_tokens": 60, "total_tokens": 1160},
+                }, headers)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, models=dict(self.counts["models"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='レート制限を再現する疑似APIサーバー')
+    parser.add_argument('--port', type=int, default=8900, help='待ち受けるポート(デフォルト: 8900)')
+    parser.add_argument('--rpm', type=int, default=60, help='1分あたりのリクエスト数の上限(デフォルト: 60)')
+    parser.add_argument('--burst', type=int, default=0, help='連続して受け付けるリクエスト数。0の場合は rpm の1/10(デフォルト: 0)')
+    parser.add_argument('--latency', type=float, default=0.3, help='1リクエストの応答時間(秒)(デフォルト: 0.3)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='503を返す割合(デフォルト: 0)')
+    parser.add_argument('--model_latency', action='append', default=None, help='モデルごとの応答時間(秒)（複数指定可）。例: "gpt-4.1-mini=0.1"')
+    parser.add_argument('--hard_rate', type=float, default=0.0, help=f'{FULL_MODEL} 以外のモデルへのリクエストに難しい画像の結果を返す割合(デフォルト: 0)')
+    args = parser.parse_args()
+
+    model_latency = {}
+    for spec in args.model_latency or []:
+        model, _, seconds = spec.partition('=')
+        try:
+            model_latency[model] = float(seconds)
+        except ValueError:
+            parser.error(f'--model_latency は "モデル名=秒" の形式で指定してください: {spec}')
+    server = FakeOpenAIServer(args.port, rpm=args.rpm, latency=args.latency, error_rate=args.error_rate,
+                              burst=args.burst or None, model_latency=model_latency, hard_rate=args.hard_rate)
+    print(f"疑似APIサーバーを起動しました: {server.base_url} (rpm: {args.rpm}, 応答時間: {args.latency}秒)")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats()))
+    finally:
+        server.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
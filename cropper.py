@@ -0,0 +1,188 @@
+"""プログラムから呼び出すためのクロップ処理のライブラリAPI
+
+使い方:
+    from cropper import Cropper
+
+    cropper = Cropper(aspect_ratio="16:9", resize_width=1280, renditions=["height=120,name=thumb"])
+    result = cropper.crop(image_bytes, "タマネギを微塵切りにします。")
+    result["crop_coordinates"], result["description"]
+    result["image"]                    # クロップした画像のバイト列（JPEG）
+    result["renditions"][0]["image"]   # レンディションのバイト列
+
+    # asyncio のイベントループから多数のクロップを同時に行う
+    async with AsyncCropper(max_concurrency=8) as cropper:
+        results = await asyncio.gather(*(cropper.crop(data, instruction) for data, instruction in jobs))
+
+クライアント・モデル・バックエンド・比率・レンディションなどの設定は作成時に1回だけ行い、以降の呼び出しで使い回す。
+入力はバイト列・ファイルオブジェクト・PIL画像（または ImageJob）で、結果はエンコード済みのバイト列を含む辞書で返す。
+ファイルの読み書き（cache などを指定した場合を除く）と標準出力への出力は行わない（経過出力は呼び出し中のスレッドだけ止めるため、
+同じプロセスで動く cropping.py のCLIやサーバーの出力には影響しない）。
+"""
+import io
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import cropping
+from metrics import RequestMetrics
+
+
+class Cropper:
+    """設定済みのクロップ処理（複数のスレッドから同時に呼び出せる）
+
+    backend / fallback / proxy_max_edge / structured / cache / near_duplicates / limiter / escalation は cropping.py と同じ。
+    client を省略した場合は、api_key（省略時は環境変数 OPENAI_API_KEY）で作成したクライアントを全ての呼び出しで共有する。
+    renditions はレンディションの辞書または "width=640,format=webp" のような文字列のリスト。
+    """
+
+    def __init__(self, client=None, model=cropping.MODEL_NAME, backend="gpt", fallback=None, aspect_ratio="16:9",
+                 resize_width=0, resize_height=0, image_format="jpg", quality=95, renditions=None, proxy_max_edge=None,
+                 proxy_quality=85, structured=False, timeout=None, api_key=None, base_url=None, cache=None,
+                 near_duplicates=None, limiter=None, large_image_bytes=0, escalation=None):
+        if image_format.lower() not in cropping.IMAGE_FORMATS:
+            raise ValueError(f"対応していない出力形式です: {image_format}")
+        if backend not in cropping.CROP_BACKENDS or (fallback and fallback not in cropping.CROP_BACKENDS):
+            raise ValueError(f"不明なバックエンドです: {backend if backend not in cropping.CROP_BACKENDS else fallback}")
+        self.model = model
+        self.backend = backend
+        self.fallback = fallback
+        self.aspect_ratio = cropping.parse_aspect_ratio(aspect_ratio)
+        self.resize_width = resize_width
+        self.resize_height = resize_height
+        self.image_format = image_format.lower()
+        self.quality = quality
+        self.renditions = [cropping.parse_rendition(spec) if isinstance(spec, str) else dict(spec)
+                           for spec in renditions or []]
+        self.large_image_bytes = large_image_bytes
+        self.options = {}
+        if backend == "gpt" or fallback == "gpt":
+            # limiter を使う場合はリトライを limiter に任せる
+            client = client or cropping._create_client(
+                timeout, base_url=base_url, max_retries=0 if limiter else None, api_key=api_key
+            )
+            self.options = {"client": client, "model": model, "proxy_max_edge": proxy_max_edge,
+                            "proxy_quality": proxy_quality, "structured": structured, "cache": cache,
+                            "near_duplicates": near_duplicates, "limiter": limiter, "escalation": escalation}
+
+    def load(self, image):
+        """入力を ImageJob にする（バイト列・ファイルオブジェクトはそのまま、PIL画像はPNGにエンコードして保持する）"""
+        if isinstance(image, cropping.ImageJob):
+            return image
+        if isinstance(image, Image.Image):
+            buffer = io.BytesIO()
+            image.save(buffer, 'PNG')
+            data = buffer.getvalue()
+        elif isinstance(image, (bytes, bytearray, memoryview)):
+            data = bytes(image)
+        elif hasattr(image, 'read'):
+            data = image.read()
+        else:
+            raise TypeError(f"画像にはバイト列・ファイルオブジェクト・PIL画像を指定してください: {type(image).__name__}")
+        return cropping.ImageJob(data, large_image_bytes=self.large_image_bytes)
+
+    def analyze(self, image, instructions):
+        """各指示のクロップ座標を取得し（複数の場合は1回のリクエストにまとめる）、instructions と同じ順序の結果リストを返す"""
+        job = self.load(image)
+        with cropping.quiet():
+            return cropping.analyze_image(job, list(instructions), backend=self.backend, fallback=self.fallback,
+                                          aspect_ratio=self.aspect_ratio, **self.options)
+
+    def crop(self, image, instruction):
+        """クロップ座標を取得してクロップし、座標・説明・エンコードした画像の辞書を返す
+
+        座標を取得できなかった場合は ValueError。
+        """
+        job = self.load(image)
+        result = self.analyze(job, [instruction])[0]
+        error = cropping.validate_crop_result(result)
+        if error:
+            raise ValueError(error)
+        return self.render(job, result)
+
+    def crop_steps(self, image, instructions):
+        """1枚の画像の複数の工程のクロップ座標を1回のリクエストで取得し、工程ごとの結果（crop と同じ辞書）のリストを返す
+
+        座標を取得できなかった工程は None になる。
+        """
+        job = self.load(image)
+        results = self.analyze(job, instructions)
+        return [None if cropping.validate_crop_result(result) else self.render(job, result) for result in results]
+
+    def render(self, image, result):
+        """取得したクロップ結果（crop_coordinates を含む辞書）で画像をクロップ・リサイズ・エンコードする"""
+        job = self.load(image)
+        metrics = RequestMetrics()
+        metrics.merge(result.get('metrics'))
+        with cropping.quiet():
+            cropped_img, final_coords, requested_coords, full_crop = cropping.crop_image(
+                job, result['crop_coordinates'], resize_width=self.resize_width, resize_height=self.resize_height,
+                aspect_ratio=self.aspect_ratio, reduced_decode=not self.renditions, metrics=metrics
+            )
+            with metrics.stage("encode"):
+                data = cropping.encode_image(cropped_img, self.image_format, quality=self.quality)
+            metrics.add("output_bytes", len(data))
+            renditions = []
+            if self.renditions:
+                with metrics.stage("renditions"):
+                    for rendition, rendered in cropping.render_renditions(
+                            job, requested_coords, self.renditions, aspect_ratio=self.aspect_ratio, base_crop=full_crop):
+                        image_format = (rendition.get('format') or self.image_format).lower()
+                        encoded = cropping.encode_image(rendered, image_format, quality=rendition.get('quality', 95))
+                        renditions.append({
+                            "name": rendition.get('name') or f"{rendered.width}x{rendered.height}",
+                            "width": rendered.width,
+                            "height": rendered.height,
+                            "format": image_format,
+                            "image": encoded,
+                        })
+                metrics.add("output_bytes", sum(len(rendition["image"]) for rendition in renditions))
+        return {
+            "crop_coordinates": result['crop_coordinates'],
+            "final_coordinates": final_coords,
+            "description": result.get('description'),
+            "backend": result.get('backend', self.backend),
+            "cached": bool(result.get('cached')),
+            "near_duplicate": result.get('near_duplicate'),
+            "tier": result.get('tier'),
+            "width": cropped_img.width,
+            "height": cropped_img.height,
+            "format": self.image_format,
+            "image": data,
+            "renditions": renditions,
+            "metrics": metrics.as_dict(),
+        }
+
+
+class AsyncCropper:
+    """Cropper の asyncio 版
+
+    各呼び出しは max_concurrency 個のワーカースレッドで実行する（API呼び出しの待ち時間の間もイベントループは止まらない）。
+    クライアントと接続プールは全ての呼び出しで共有する。cropper（Cropper）を省略した場合は、
+    残りの引数で Cropper を作成する。
+    """
+
+    def __init__(self, max_concurrency=4, cropper=None, **options):
+        self.cropper = cropper or Cropper(**options)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="cropper")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def analyze(self, image, instructions):
+        return await self._run(self.cropper.analyze, image, instructions)
+
+    async def crop(self, image, instruction):
+        return await self._run(self.cropper.crop, image, instruction)
+
+    async def crop_steps(self, image, instructions):
+        return await self._run(self.cropper.crop_steps, image, instructions)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
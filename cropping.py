@@ -1,18 +1,70 @@
 import os
 import datetime
 import base64
+import io
+import hashlib
+import math
+from fractions import Fraction
+import threading
+import contextvars
+import PIL
 from PIL import Image, ImageDraw
 import json
-from openai import OpenAI
 import argparse
-import matplotlib.pyplot as plt
-import matplotlib
-from matplotlib import font_manager
+import csv
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import nullcontext, contextmanager
 import sys
+from response_cache import ResponseCache, make_cache_key
+from metrics import RequestMetrics, MetricsWriter
+from rate_limit import RateLimiter
+from job_journal import JobJournal, make_job_key
+from memory_budget import MemoryBudget, estimate_decode_bytes
+from review_gallery import build_gallery
+from escalation import EscalationPolicy, LOCAL_TIER
+
+# 使用するモデルとプロンプトのバージョン（プロンプトを変更した場合はバージョンを上げてキャッシュを無効化する）
+# 2: 画像サイズをシステムプロンプトからユーザープロンプトに移動（プロンプトキャッシュ対応）
+MODEL_NAME = "gpt-4.1"
+PROMPT_VERSION = "2"
+
+# 起動を速くするため、matplotlib と openai は実際に必要になった時点で読み込む
+# （ヘッドレス環境では matplotlib の読み込みとフォント探索を一切行わない）
+
+# True の場合、処理途中の経過出力（デバッグ用の応答の表示や座標の調整過程など）を行わない
+QUIET = False
+
+# QUIET と同じだが、スレッド（asyncio のタスク）ごとの設定（quiet() の with ブロックの間だけ True）
+_quiet = contextvars.ContextVar("quiet", default=False)
+
+def log(*args, **kwargs):
+    """経過出力用の print（QUIET が True の場合と quiet() の with ブロックの中では何も出力しない）"""
+    if not QUIET and not _quiet.get():
+        print(*args, **kwargs)
+
+@contextmanager
+def quiet():
+    """with ブロックの間、このスレッドでの経過出力を行わない（他のスレッドと QUIET には影響しない）"""
+    token = _quiet.set(True)
+    try:
+        yield
+    finally:
+        _quiet.reset(token)
+
+def has_display():
+    """結果をウィンドウで表示できる環境かどうか"""
+    if sys.platform.startswith('linux'):
+        return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return True
 
 # 日本語フォント太陽
 def japanese_fonts():
     """matplotlibで日本語フォントを使用するための設定"""
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib import font_manager
+
     # プラットフォームに応じたフォント設定
     if sys.platform.startswith('win'):  # Windows
         font_dirs = ['C:/Windows/Fonts']
@@ -59,18 +111,35 @@ def japanese_fonts():
     except:
         print("フォントの設定に失敗しました。")
 
+# 作成・確認済みの出力ディレクトリ（ファイルごとのディレクトリの確認を省く）
+_known_directories = set()
+_directories_lock = threading.Lock()
+
+def ensure_directory(directory):
+    """ディレクトリが存在しない場合は作成する（一度確認したディレクトリは再確認しない）"""
+    if directory in _known_directories:
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+        log(f"出力ディレクトリを作成しました: {directory}")
+    with _directories_lock:
+        _known_directories.add(directory)
+
+def _output_extension(input_image_path, extension="jpg"):
+    """入力画像の拡張子（対応している形式の場合）を出力の拡張子にする"""
+    if input_image_path:
+        input_ext = os.path.splitext(input_image_path)[1].lower()
+        if input_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
+            return input_ext[1:]  # ドットを除く
+    return extension
+
 def generate_output_filename(output_dir, base_name="cropped", extension="jpg", input_image_path=None):
     """タイムスタンプ付きのファイル名を生成する"""
     # 出力ディレクトリが存在しない場合は作成
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        print(f"出力ディレクトリを作成しました: {output_dir}")
+    ensure_directory(output_dir)
     
     # 入力画像から拡張子を取得（指定されている場合）
-    if input_image_path:
-        input_ext = os.path.splitext(input_image_path)[1].lower()
-        if input_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-            extension = input_ext[1:]  # ドットを除く
+    extension = _output_extension(input_image_path, extension)
     
     # 現在の日時を取得
     now = datetime.datetime.now()
@@ -80,34 +149,419 @@ def generate_output_filename(output_dir, base_name="cropped", extension="jpg", i
     filename = f"{base_name}_{timestamp}.{extension}"
     # フルパスを返す
     return os.path.join(output_dir, filename)
+
+def content_output_filename(output_dir, image_hash, instruction, variant="", extension="jpg", input_image_path=None):
+    """入力画像のハッシュ・指示文・出力設定（variant）から決まるファイル名を生成する
+
+    同じ入力と設定からは常に同じパスになり、異なる入力どうしは衝突しないため、並列に実行しても上書きし合わない。
+    画像のハッシュの先頭2文字のサブディレクトリに分けて、1つのディレクトリのファイル数を抑える。
+    レンディションは save_renditions がこのファイル名に "_名前" を付けて保存する。
+    """
+    extension = _output_extension(input_image_path, extension)
+    directory = os.path.join(output_dir, image_hash[:2])
+    ensure_directory(directory)
+    settings_hash = hashlib.sha256(json.dumps([instruction, variant], ensure_ascii=False).encode('utf-8')).hexdigest()
+    return os.path.join(directory, f"{image_hash[:16]}_{settings_hash[:12]}.{extension}")
+
+def write_file_atomic(path, data):
+    """一時ファイルに書き込んでから置き換える（書き込み途中のファイルが読まれず、同じパスへの同時書き込みでも壊れない）"""
+    temp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class ImageJob:
+    """1枚の入力画像をメモリ上に保持し、各処理段で使い回すためのジョブ
+
+    ファイルの読み込みとヘッダー解析は生成時に1回だけ行い、
+    ピクセルデータのデコードは最初に必要になった時点で1回だけ行う。
+    デコード後のサイズが large_image_bytes を超える画像は大きい画像モード（large）で扱い、
+    デコード済みの画像を保持せず、クロップ領域だけをデコードする（decode_region を参照）。
+    data が None の場合はファイルのデータを保持せず、必要な時に path から読み込む。
+    """
+
+    def __init__(self, data, path=None, large_image_bytes=0):
+        self.path = path
+        self._data = data
+        # ヘッダーのみを解析（ピクセルのデコードは行わない）
+        with self.open() as img:
+            self.format = img.format
+            self.size = img.size
+            self.mode = img.mode
+        self.decoded_bytes = estimate_decode_bytes(self.width, self.height, self.mode)
+        self.large = bool(large_image_bytes) and self.decoded_bytes > large_image_bytes
+        self._image = None
+        self._sha256 = None
+        self._perceptual_hash = ()  # 未計算（単色に近い画像のハッシュは None）
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_path(cls, image_path, large_image_bytes=0):
+        """ファイルを1回だけ読み込んでジョブを作成（大きい画像モードの場合はファイルのデータを保持しない）"""
+        if large_image_bytes:
+            job = cls(None, path=image_path, large_image_bytes=large_image_bytes)
+            if job.large:
+                return job
+        with open(image_path, "rb") as image_file:
+            return cls(image_file.read(), path=image_path, large_image_bytes=large_image_bytes)
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def data(self):
+        """画像ファイルのデータ（保持していない場合はファイルから読み込む）"""
+        if self._data is not None:
+            return self._data
+        with open(self.path, "rb") as image_file:
+            return image_file.read()
+
+    def read(self, offset, size):
+        """画像ファイルの offset バイト目から size バイトを返す（ファイルのデータを保持していない場合は必要な部分だけ読み込む）"""
+        if self._data is not None:
+            return self._data[offset:offset + size]
+        with open(self.path, "rb") as image_file:
+            image_file.seek(offset)
+            return image_file.read(size)
+
+    @property
+    def file_size(self):
+        return len(self._data) if self._data is not None else os.path.getsize(self.path)
+
+    def open(self):
+        """ピクセルをデコードしていない状態のPIL画像を開く"""
+        if self._data is not None:
+            return Image.open(io.BytesIO(self._data))
+        return Image.open(self.path)
+
+    @property
+    def sha256(self):
+        """画像データのSHA-256ハッシュ（キャッシュキーなどに使用）"""
+        if self._sha256 is None:
+            if self._data is not None:
+                self._sha256 = hashlib.sha256(self._data).hexdigest()
+            else:
+                digest = hashlib.sha256()
+                with open(self.path, "rb") as image_file:
+                    for chunk in iter(lambda: image_file.read(BASE64_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    @property
+    def perceptual_hash(self):
+        """縮小デコードした画像から求めた知覚ハッシュ（似た画像のクロップ座標の再利用に使用。単色に近い画像は None）"""
+        if self._perceptual_hash == ():
+            from perceptual_index import difference_hash
+            self._perceptual_hash = difference_hash(load_thumbnail(self, 64))
+        return self._perceptual_hash
+
+    @property
+    def mime_type(self):
+        image_format = (self.format or "").lower()
+        return f"image/{image_format}" if image_format in ['jpeg', 'jpg', 'png', 'gif', 'webp'] else "image/jpeg"
+
+    @property
+    def image(self):
+        """デコード済みのPIL画像（初回アクセス時にのみデコード。大きい画像モードでは保持せず毎回デコードする）"""
+        if self.large:
+            img = self.open()
+            img.load()
+            return img
+        if self._image is None:
+            with self._lock:
+                if self._image is None:
+                    img = self.open()
+                    img.load()
+                    self._image = img
+        return self._image
+
+    def release(self):
+        """デコード済みの画像を破棄する（この画像の処理が全て終わった後に呼ぶ）"""
+        with self._lock:
+            self._image = None
+
+def load_image_job(image):
+    """画像パスまたはImageJobを受け取り、ImageJobを返す"""
+    if isinstance(image, ImageJob):
+        return image
+    return ImageJob.from_path(image)
+
+# base64エンコードでファイルを読み込む単位（3の倍数にすると、分割してエンコードした結果をそのまま連結できる）
+BASE64_CHUNK_SIZE = 3 * 1024 * 1024
+
+def encode_file_to_base64(path, chunk_size=BASE64_CHUNK_SIZE):
+    """ファイルを chunk_size ずつ読み込みながらbase64エンコードする（ファイル全体のデータを保持しない）"""
+    size = os.path.getsize(path)
+    encoded = bytearray(4 * math.ceil(size / 3))
+    position = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            piece = base64.b64encode(chunk)
+            encoded[position:position + len(piece)] = piece
+            position += len(piece)
+    del encoded[position:]
+    return encoded.decode('ascii')
+
+def encode_image_to_base64(image):
+    """画像をbase64エンコードし、MIMEタイプも返す（ファイルのデータを保持していないジョブはファイルから分割して読み込む）"""
+    job = load_image_job(image)
+    if job._data is None:
+        return encode_file_to_base64(job.path), job.mime_type
+    base64_data = base64.b64encode(job.data).decode('utf-8')
+    return base64_data, job.mime_type
+
+def convert_to_rgb(img):
+    """パレットモードや透過チャンネルを持つ画像を白背景のRGB画像に変換"""
+    if img.mode in ['RGBA', 'LA'] or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    if img.mode != 'RGB':
+        return img.convert('RGB')
+    return img
+
+def load_thumbnail(image, max_edge):
+    """長辺max_edgeピクセルに縮小したRGB画像を返す"""
+    job = load_image_job(image)
+    with job.open() as img:
+        # thumbnail は JPEG の場合 draft による縮小デコードを利用するため、フルサイズのデコードを避けられる
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        # 既に max_edge より小さい画像は thumbnail でデコードされないため、ファイルを閉じる前に読み込む
+        img.load()
+        return convert_to_rgb(img)
+
+def build_proxy_image(image, max_edge=1024, quality=85):
+    """API送信用に長辺max_edgeピクセルへ縮小し、JPEGで再エンコードしたプロキシ画像のImageJobを返す"""
+    proxy_img = load_thumbnail(image, max_edge)
+    buffer = io.BytesIO()
+    proxy_img.save(buffer, 'JPEG', quality=quality)
+    return ImageJob(buffer.getvalue())
+
+# 必要な行までで打ち切ってデコードできる（途中で止めてもエラーにならない）デコーダー
+ROW_LIMITED_DECODERS = ('raw', 'zip')
+
+# Pillow には圧縮された画像の一部だけをデコードする公開APIがないため、PNG・タイル形式のTIFFの部分的なデコードは
+# 公開されていない ImageFile のタイルの情報（tile）と画像サイズ（_size）を書き換えて行う。
+# 内部の仕組みが変わると使えなくなるため、動作を確認した Pillow のメジャーバージョンでだけ使い、
+# それ以外のバージョンでは画像全体をデコードする（tests/test_decode_region.py で確認する）。
+# 非圧縮の画像（TIFF・BMPなど）は公開APIの Image.frombytes で必要な行だけを読み込むため、バージョンによらない
+PARTIAL_DECODE_PILLOW_VERSIONS = (11, 12)
+
+def partial_decode_supported(version=PIL.__version__):
+    """部分的なデコードを使える Pillow のバージョンか"""
+    major = version.split('.')[0]
+    return major.isdigit() and int(major) in PARTIAL_DECODE_PILLOW_VERSIONS
+
+PARTIAL_DECODE = partial_decode_supported()
+
+def _top_down(tile):
+    """タイルのデータが上の行から順に並んでいるか（下から並ぶBMPなどは行の途中で打ち切れない）"""
+    args = tile[3] if isinstance(tile[3], tuple) else (tile[3],)
+    return len(args) < 3 or not isinstance(args[2], int) or args[2] >= 0
+
+def read_raw_region(job, img, box):
+    """非圧縮の画像（デコーダーが raw のタイル1つ）の box の領域を、必要な行のデータだけ読み込んで返す
+
+    ファイル上の行の並び（上から・下から）と1行のバイト数はタイルの情報から求め、Image.frombytes でデコードする。
+    対応していない画像（圧縮された画像・パレット画像・複数のタイルなど）の場合は None。
+    """
+    if len(img.tile) != 1 or img.mode in ('P', 'PA'):
+        return None
+    codec_name, extents, offset, args = img.tile[0]
+    if codec_name != 'raw' or tuple(extents) != (0, 0, img.width, img.height):
+        return None
+    args = args if isinstance(args, tuple) else (args,)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 and isinstance(args[1], int) else 0
+    orientation = args[2] if len(args) > 2 and isinstance(args[2], int) else 1
+    try:
+        # 1行のバイト数（タイルに指定がない場合は、パディングのない行の長さ）
+        stride = stride or len(Image.new(img.mode, (img.width, 1)).tobytes('raw', rawmode))
+    except ValueError:
+        return None
+    x_min, y_min, x_max, y_max = box
+    rows = y_max - y_min
+    first_row = y_min if orientation >= 0 else img.height - y_max
+    data = job.read(offset + first_row * stride, rows * stride)
+    if len(data) < rows * stride:
+        return None
+    region = Image.frombytes(img.mode, (img.width, rows), data, 'raw', rawmode, stride, orientation)
+    return region.crop((x_min, 0, x_max, rows))
+
+def partial_decode_plan(img, box):
+    """デコード前のPIL画像の box の領域を部分的にデコードする場合の (デコードするタイル, デコードする下端の行) を返す
+
+    部分的にデコードできない形式・Pillow のバージョンの場合は None。
+    """
+    if not PARTIAL_DECODE:
+        return None
+    x_min, y_min, x_max, y_max = box
+    tiles = img.tile
+    if len(tiles) > 1:
+        needed = [tile for tile in tiles
+                  if tile.extents[0] < x_max and tile.extents[2] > x_min
+                  and tile.extents[1] < y_max and tile.extents[3] > y_min]
+        return needed, max((tile.extents[3] for tile in needed), default=y_max)
+    if (len(tiles) == 1 and tiles[0].codec_name in ROW_LIMITED_DECODERS and y_max < img.height
+            and not img.info.get('interlace') and _top_down(tiles[0])):
+        return [tiles[0]._replace(extents=(0, 0, img.width, y_max))], y_max
+    return None
+
+def decode_region(image, box):
+    """画像の box = (x_min, y_min, x_max, y_max) の領域を返す
+
+    大きい画像モード以外のジョブでは、デコード済みの画像（1回だけデコードして使い回す）から切り出す。
+    大きい画像モードでは、画像全体をデコードせずに済む形式ではその部分だけをデコードする。
+    - 非圧縮のTIFF/BMPなど: 領域の行のデータだけを読み込んでデコードする（read_raw_region）
+    - タイル分割された画像（タイル形式のTIFFなど）: 領域に重なるタイルだけをデコードする
+    - PNGなど: 上から順にデコードし、領域の下端の行で打ち切る
+    - その他（JPEGなど）: 画像全体をデコードし、切り出した後すぐに破棄する
+    タイル分割された画像・PNGの範囲は partial_decode_plan で決める（Pillow のバージョンによっては画像全体をデコードする）。
+    開いたファイルは戻る前に閉じる。
+    """
+    job = load_image_job(image)
+    if not job.large:
+        return job.image.crop(box)
+    with job.open() as img:
+        region = read_raw_region(job, img, box)
+        if region is not None:
+            return region
+        plan = partial_decode_plan(img, box)
+        if plan is not None:
+            needed, bottom = plan
+            try:
+                # デコードする範囲を必要なタイル・行に限定する（画像の高さも下端までに縮める）
+                img.tile = needed
+                img._size = (img.width, bottom)
+                img.load()
+                return img.crop(box)
+            except (OSError, ValueError) as e:
+                log(f"警告: 部分的なデコードに失敗したため、画像全体をデコードします: {e}")
+        else:
+            img.load()
+            return img.crop(box)
+    # 部分的なデコードに失敗した画像はタイルの情報を書き換えているため、開き直してデコードする
+    with job.open() as img:
+        img.load()
+        return img.crop(box)
+
+def scale_crop_coordinates(crop_coordinates, from_size, to_size):
+    """ある画像サイズ上のクロップ座標を別の画像サイズ上の座標に変換（領域が欠けないよう外側に丸める）"""
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return {
+        "x_min": max(0, math.floor(crop_coordinates["x_min"] * scale_x)),
+        "y_min": max(0, math.floor(crop_coordinates["y_min"] * scale_y)),
+        "x_max": min(to_size[0], math.ceil(crop_coordinates["x_max"] * scale_x)),
+        "y_max": min(to_size[1], math.ceil(crop_coordinates["y_max"] * scale_y)),
+    }
+
+def crop_and_resize_reduced(image, crop_box, target_size):
+    """クロップ領域を target_size に縮小した画像を、できるだけ小さい解像度でデコードして作成
+
+    JPEG の場合は draft（DCTの縮小デコード）で、クロップ領域が target_size を下回らない範囲で
+    最も小さい倍率（1/2・1/4・1/8）でデコードし、その倍率に合わせたクロップ領域から LANCZOS で仕上げる。
+    その他の形式では縮小デコードができないため、デコード済みの画像（大きい画像モードではクロップ領域だけを
+    デコードした画像）から reduce による整数倍の縮小を挟んでリサイズする。
+    """
+    job = load_image_job(image)
+    x_min, y_min, x_max, y_max = crop_box
+    target_width, target_height = target_size
+    if job.format == 'JPEG' and job._image is None:
+        with job.open() as img:
+            requested = (math.ceil(job.width * target_width / (x_max - x_min)),
+                         math.ceil(job.height * target_height / (y_max - y_min)))
+            img.draft(img.mode, requested)
+            scale_x = img.width / job.width
+            scale_y = img.height / job.height
+            box = (x_min * scale_x, y_min * scale_y, x_max * scale_x, y_max * scale_y)
+            log(f"縮小デコード: {job.width}x{job.height} → {img.width}x{img.height}")
+            return img.resize(target_size, Image.Resampling.LANCZOS, box=box)
+    if job.large:
+        return decode_region(job, crop_box).resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return job.image.resize(target_size, Image.Resampling.LANCZOS, box=crop_box, reducing_gap=3.0)
+
+def estimate_job_memory(job, proxy_max_edge=None, request=True):
+    """1枚の画像を処理する間に必要なメモリ量の見積もり（バイト、メモリ予算の予約に使う）
+
+    保持するファイルのデータ・送信するbase64のデータ（プロキシを送る場合は縮小画像）・デコードした画像の合計。
+    APIに送信しない場合（request=False）はbase64のデータを含めない。
+    大きい画像モードでも、部分的なデコードができない形式があるため、デコードは画像全体の大きさで見積もる。
+    """
+    held = job.file_size if job._data is not None else 0
+    if not request:
+        request = 0
+    elif proxy_max_edge and max(job.size) > proxy_max_edge:
+        request = estimate_decode_bytes(proxy_max_edge, proxy_max_edge)
+    else:
+        # base64のバイト列と文字列（それぞれファイルの4/3倍）
+        request = job.file_size * 8 // 3
+    return held + request + job.decoded_bytes
+
+def build_system_prompt(multi_step=False, confidence=False):
+    """システムプロンプトを作成。multi_step を指定すると複数の工程の座標を配列で返す形式にする
+
+    confidence を指定すると、結果の確からしさ（0〜1）も返させる（段階的なモデルの切り替えで使う）。
+    APIのプロンプトキャッシュ（先頭が一致するリクエストの再利用）が効くように、画像サイズや指示など
+    リクエストごとに変わる内容は含めず、同じ形式のリクエストでは常に同じ文字列にする（build_user_prompt を参照）。
+    """
+    if multi_step:
+        output_format = """
+    ユーザーから番号付きで複数のレシピ指示が送られます。各指示についてそれぞれクロップ範囲を決めてください。
     
-def encode_image_to_base64(image_path):
-    """画像をbase64エンコードし、MIMEタイプも返す"""
-    with Image.open(image_path) as img:
-        # 画像形式を取得
-        image_format = img.format.lower()
-        mime_type = f"image/{image_format}" if image_format in ['jpeg', 'jpg', 'png', 'gif', 'webp'] else "image/jpeg"
+    あなたの出力は必ず以下のJSON形式に厳密に従ってください：
     
-    with open(image_path, "rb") as image_file:
-        base64_data = base64.b64encode(image_file.read()).decode('utf-8')
+    {
+        "steps": [
+            {
+                "step": 指示の番号（整数値）,
+                "crop_coordinates": {
+                    "x_min": 整数値,
+                    "y_min": 整数値,
+                    "x_max": 整数値,
+                    "y_max": 整数値
+                },
+                "description": "このクロップ画像はどんな料理道具を用いてどのような料理工程を行なっているか一言で書いてください。"{confidence_field}
+            }
+        ]
+    }
     
-    return base64_data, mime_type
-
-def crop_image_with_gpt(image_path, instruction):
-    """GPT-4 Vision APIを使用して画像からクロップ領域の座標を取得"""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("環境変数 OPENAI_API_KEY が設定されていません。")
-    client = OpenAI(api_key=api_key)
+    説明と注意点:
+    - "steps" には全ての指示について、指示の番号順に1つずつ要素を含めてください"""
+        output_format = output_format.replace("{confidence_field}", ",\n                " + CONFIDENCE_FIELD if confidence else "")
+    else:
+        output_format = """
+    あなたの出力は必ず以下のJSON形式に厳密に従ってください：
     
-    # 画像サイズを取得
-    with Image.open(image_path) as img:
-        img_width, img_height = img.size
+    {
+        "crop_coordinates": {
+            "x_min": 整数値,
+            "y_min": 整数値,
+            "x_max": 整数値,
+            "y_max": 整数値
+        },
+        "description": "このクロップ画像はどんな料理道具を用いてどのような料理工程を行なっているか一言で書いてください。"{confidence_field}
+    }
     
-    # 画像をbase64エンコード（MIMEタイプも取得）
-    base64_image, mime_type = encode_image_to_base64(image_path)
-    # システムプロンプトとユーザープロンプトを準備
-    system_prompt = f"""
+    説明と注意点:"""
+        output_format = output_format.replace("{confidence_field}", ",\n        " + CONFIDENCE_FIELD if confidence else "")
+    if confidence:
+        output_format += """
+    - "confidence" は、指示に関係する場所が画像内ではっきり分かり、その範囲を正しく選べた確からしさです。該当する場所が見当たらない・判断に迷う場合は低くしてください"""
+
+    return f"""
     あなたは料理画像解析の専門家です。
     ユーザーから送られてきた料理画像に対して、レシピ指示に関連する部分をクロッピングするための座標を提供してください。
 
@@ -127,37 +581,200 @@ def crop_image_with_gpt(image_path, instruction):
     6. どうしても複数の候補がある場合は、最も関連性が高く、かつ視覚的に分かりやすい部分を優先してください。
 
     
-    画像のサイズは幅{img_width}ピクセル、高さ{img_height}ピクセルです。
+    画像のサイズ（幅と高さのピクセル数）はユーザーのメッセージで指定します。
     このサイズ内で有効な座標を返してください。
-    
-    あなたの出力は必ず以下のJSON形式に厳密に従ってください：
-    
-    {{
-        "crop_coordinates": {{
-            "x_min": 整数値,
-            "y_min": 整数値,
-            "x_max": 整数値,
-            "y_max": 整数値
-        }},
-        "description": "このクロップ画像はどんな料理道具を用いてどのような料理工程を行なっているか一言で書いてください。"
-    }}
-    
-    説明と注意点:
+    {output_format}
     - x_min, y_min は左上の座標、x_max, y_max は右下の座標です
     - 座標は元の画像のピクセル単位で整数値で指定してください
     - 必ず有効な座標を返してください (x_min < x_max かつ y_min < y_max)
-    - 必ず画像範囲内の座標を指定してください (0 <= x_min < x_max <= {img_width} かつ 0 <= y_min < y_max <= {img_height})
+    - 必ず画像範囲内の座標を指定してください (0 <= x_min < x_max <= 画像の幅 かつ 0 <= y_min < y_max <= 画像の高さ)
     - JSONフォーマット以外のテキストや説明は一切含めないでください
     - 必ず有効なJSONを出力してください
     - コードブロック記号(```)は含めないでください
     """
+
+# 確からしさを返させる場合の出力形式の項目
+CONFIDENCE_FIELD = '"confidence": 0から1の数値（1に近いほど確か）'
+
+def build_user_prompt(instructions, img_width, img_height):
+    """画像サイズと指示を含むユーザープロンプトを作成（指示が複数の場合は番号付きで並べる）
+
+    リクエストごとに変わる内容はすべてここに入れ、静的なシステムプロンプトの後ろに置く。
+    """
+    size_text = (f"画像のサイズは幅{img_width}ピクセル、高さ{img_height}ピクセルです。"
+                 f"(0 <= x_min < x_max <= {img_width} かつ 0 <= y_min < y_max <= {img_height})\n")
+    if len(instructions) == 1:
+        return size_text + f"この料理画像から「{instructions[0]}」に関連する部分をクロッピングするための座標を教えてください。レシピ指示に関係する食材や調味料または手元を画像の中央付近に含めるようにクロップ範囲を選んでください。"
+    step_lines = "\n".join(f"{number}. {instruction}" for number, instruction in enumerate(instructions, start=1))
+    return size_text + (
+        f"この料理画像から、以下の{len(instructions)}個の各レシピ指示に関連する部分をクロッピングするための座標を指示ごとに教えてください。"
+        "レシピ指示に関係する食材や調味料または手元を画像の中央付近に含めるようにクロップ範囲を選んでください。\n"
+        f"{step_lines}"
+    )
+
+# 構造化出力（JSONスキーマ）で受け取る結果の形式
+CROP_COORDINATES_SCHEMA = {
+    "type": "object",
+    "properties": {key: {"type": "integer"} for key in ["x_min", "y_min", "x_max", "y_max"]},
+    "required": ["x_min", "y_min", "x_max", "y_max"],
+    "additionalProperties": False,
+}
+CROP_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "crop_coordinates": CROP_COORDINATES_SCHEMA,
+        "description": {"type": "string"},
+    },
+    "required": ["crop_coordinates", "description"],
+    "additionalProperties": False,
+}
+CROP_STEPS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "steps": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "step": {"type": "integer"},
+                    "crop_coordinates": CROP_COORDINATES_SCHEMA,
+                    "description": {"type": "string"},
+                },
+                "required": ["step", "crop_coordinates", "description"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["steps"],
+    "additionalProperties": False,
+}
+
+def with_confidence(schema):
+    """結果（複数工程の場合は各工程）に confidence（数値）を必須の項目として加えたスキーマを返す"""
+    schema = json.loads(json.dumps(schema))
+    target = schema["properties"]["steps"]["items"] if "steps" in schema["properties"] else schema
+    target["properties"]["confidence"] = {"type": "number"}
+    target["required"].append("confidence")
+    return schema
+
+# 構造化出力の場合の出力トークン数の上限（座標が約40トークン、一言の説明が約50トークン）
+STRUCTURED_MAX_TOKENS = 150
+STRUCTURED_MAX_TOKENS_PER_STEP = 120
+
+def structured_response_format(step_count=None, confidence=False):
+    """構造化出力を指定する response_format を返す（step_count を指定すると複数工程の形式）"""
+    schema = CROP_STEPS_SCHEMA if step_count else CROP_RESULT_SCHEMA
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "crop_steps" if step_count else "crop_result",
+            "strict": True,
+            "schema": with_confidence(schema) if confidence else schema,
+        },
+    }
+
+def validate_schema(value, schema, path="$"):
+    """値がJSONスキーマ（構造化出力で使う type / properties / required / items のみ対応）に従っているか確認し、
+    問題があればエラーメッセージを返す"""
+    types = {"object": dict, "array": list, "string": str, "integer": int, "number": (int, float)}
+    expected = schema["type"]
+    if not isinstance(value, types[expected]) or (expected in ("integer", "number") and isinstance(value, bool)):
+        return f"{path} が {expected} ではありません"
+    if expected == "object":
+        for key in schema.get("required", []):
+            if key not in value:
+                return f"{path}.{key} がありません"
+        for key, item in value.items():
+            if key not in schema["properties"]:
+                if schema.get("additionalProperties") is False:
+                    return f"{path}.{key} は不明な項目です"
+                continue
+            error = validate_schema(item, schema["properties"][key], f"{path}.{key}")
+            if error:
+                return error
+    elif expected == "array":
+        for index, item in enumerate(value):
+            error = validate_schema(item, schema["items"], f"{path}[{index}]")
+            if error:
+                return error
+    return None
+
+def _create_client(timeout=None, base_url=None, max_retries=None, api_key=None):
+    """OpenAIクライアントを作成（timeout は秒単位、base_url でAPIの接続先を変更。api_key の省略時は環境変数のAPIキー）
+
+    クライアントは接続プール（keep-alive）を持つため、複数のリクエストで使い回すと
+    リクエストごとの接続・TLSハンドシェイクを省略できる。
+    RateLimiter でリトライする場合は max_retries=0 としてクライアント側のリトライを無効にする。
+    """
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("環境変数 OPENAI_API_KEY が設定されていません。")
+    from openai import OpenAI
+    options = {"api_key": api_key}
+    if timeout:
+        options["timeout"] = timeout
+    if base_url:
+        options["base_url"] = base_url
+    if max_retries is not None:
+        options["max_retries"] = max_retries
+    return OpenAI(**options)
+
+def estimate_request_tokens(img_width, img_height, text, max_tokens):
+    """レート制限の計算に使う、1回のリクエストのトークン数の見積もり
+
+    画像は高精細モードの計算方法（2048px以内に縮小し、短辺を768pxにしてから512pxのタイルに分割）で、
+    テキストは日本語を1文字1トークンとして数える。出力トークン数の上限もトークン数の制限に含まれる。
+    """
+    scale = min(1.0, 2048 / max(img_width, img_height))
+    width, height = img_width * scale, img_height * scale
+    scale = min(1.0, 768 / min(width, height))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles + len(text) + max_tokens
+
+def _prepare_request_image(job, proxy_max_edge=None, proxy_quality=85, metrics=None):
+    """送信する画像を決定し（必要に応じて縮小プロキシを作成）、base64データと送信量の情報を返す"""
+    metrics = metrics or RequestMetrics()
+    request_job = job
+    if proxy_max_edge and max(job.size) > proxy_max_edge:
+        with metrics.stage("proxy"):
+            request_job = build_proxy_image(job, max_edge=proxy_max_edge, quality=proxy_quality)
     
-    user_prompt =f"この料理画像から「{instruction}」に関連する部分をクロッピングするための座標を教えてください。レシピ指示に関係する食材や調味料または手元を画像の中央付近に含めるようにクロップ範囲を選んでください。"
-    
-    # API呼び出し
-    response = client.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
+    # 画像をbase64エンコード（MIMEタイプも取得）
+    with metrics.stage("base64"):
+        base64_image, mime_type = encode_image_to_base64(request_job)
+    upload_stats = {
+        "bytes": len(base64_image),
+        "source_bytes": job.file_size,
+        "width": request_job.width,
+        "height": request_job.height,
+        "proxy": request_job is not job,
+    }
+    metrics.add("request_bytes", upload_stats["bytes"])
+    if upload_stats["proxy"]:
+        log(f"プロキシ画像を送信します: {job.width}x{job.height} → {request_job.width}x{request_job.height}, "
+              f"{job.file_size}バイト → {request_job.file_size}バイト (base64: {upload_stats['bytes']}バイト)")
+    return request_job, base64_image, mime_type, upload_stats
+
+def build_request_body(request_job, base64_image, mime_type, instructions, structured=False, multi_step=False,
+                       model=MODEL_NAME, confidence=False):
+    """クロップ座標を問い合わせるリクエストの本文（chat.completions.create の引数）を組み立てる
+
+    multi_step を指定すると複数工程の形式（instructions の各工程の座標を steps の配列で返す）にする。
+    confidence を指定すると結果の確からしさ（confidence）も返させる。
+    バッチ処理用のファイル（build_batch_file）にもこの本文をそのまま書き出す。
+    """
+    img_width, img_height = request_job.size
+    # システムプロンプト（全リクエスト共通）とユーザープロンプト（画像サイズと指示）を準備
+    system_prompt = build_system_prompt(multi_step=multi_step, confidence=confidence)
+    user_prompt = build_user_prompt(instructions, img_width, img_height)
+    # 1工程あたりの出力は100トークン程度のため、工程数に応じて上限を増やす
+    if multi_step:
+        max_tokens = STRUCTURED_MAX_TOKENS_PER_STEP * len(instructions) + 20 if structured else 1000 + 200 * len(instructions)
+    else:
+        max_tokens = STRUCTURED_MAX_TOKENS if structured else 1000
+    body = {
+        "model": model,
+        "messages": [
             {"role": "system", "content": system_prompt},
             {
                 "role": "user", 
@@ -167,322 +784,1018 @@ def crop_image_with_gpt(image_path, instruction):
                 ]
             }
         ],
-        max_tokens=1000
-    )
-    
-    # レスポンスからJSON部分を抽出
-    response_text = response.choices[0].message.content
-    print("APIからのレスポンス（デバッグ用）:")
-    print(response_text)
+        "max_tokens": max_tokens,
+    }
+    if structured:
+        body["response_format"] = structured_response_format(step_count=len(instructions) if multi_step else None,
+                                                             confidence=confidence)
+    return body
+
+def _request_completion(client, body, metrics=None, limiter=None, image_size=None):
+    """リクエストを送信し、応答テキストを返す（metrics に往復時間とトークン数を記録）
+
+    limiter（RateLimiter）を指定すると、レート制限の範囲内で送信し、429 や一時的なエラーはリトライする
+    （トークン数の見積もりには送信する画像のサイズ image_size を使う）。
+    """
+    metrics = metrics or RequestMetrics()
+    with metrics.stage("api"):
+        if limiter is None:
+            response = client.chat.completions.create(**body)
+        else:
+            estimated_tokens = 0
+            if image_size:
+                messages = body["messages"]
+                text = messages[0]["content"] + messages[1]["content"][0]["text"]
+                estimated_tokens = estimate_request_tokens(*image_size, text, body["max_tokens"])
+            # レート制限ヘッダーを読むために生の応答を受け取る
+            raw_response = limiter.call(
+                lambda: client.chat.completions.with_raw_response.create(**body), tokens=estimated_tokens
+            )
+            response = raw_response.parse()
+    return completion_text(response, body["max_tokens"], metrics)
+
+def completion_text(response, max_tokens, metrics=None):
+    """API応答（ChatCompletion）からテキストを取り出し、トークン数を metrics に記録する"""
+    metrics = metrics or RequestMetrics()
+    usage = getattr(response, "usage", None)
+    metrics.add_usage(usage)
+    if usage is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        log(f"トークン数: 入力 {usage.prompt_tokens}（うちプロンプトキャッシュ {cached_tokens}） / 出力 {usage.completion_tokens}")
     
-    # JSONの抽出を改善
+    choice = response.choices[0]
+    if getattr(choice.message, "refusal", None):
+        log(f"警告: APIが応答を拒否しました: {choice.message.refusal}")
+    if getattr(choice, "finish_reason", None) == "length":
+        log(f"警告: 出力トークン数の上限（{max_tokens}）に達したため、応答が途中で切れています")
+    response_text = choice.message.content
+    log("APIからのレスポンス（デバッグ用）:")
+    log(response_text)
+    return response_text
+
+def extract_json_string(response_text):
+    """応答テキストからJSON部分を抽出。見つからない場合は None"""
     if '```json' in response_text:
         json_start = response_text.find('```json') + 7
         json_end = response_text.find('```', json_start)
-        json_str = response_text[json_start:json_end].strip()
-    else:
-        # 単純に最初の{から最後の}までを抽出
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        if json_start >= 0 and json_end > json_start:
-            json_str = response_text[json_start:json_end].strip()
-        else:
-            print("JSONが見つかりませんでした")
-            return None
+        return response_text[json_start:json_end].strip()
+    # 単純に最初の{から最後の}までを抽出
+    json_start = response_text.find('{')
+    json_end = response_text.rfind('}') + 1
+    if json_start >= 0 and json_end > json_start:
+        return response_text[json_start:json_end].strip()
+    log("JSONが見つかりませんでした")
+    return None
+
+def parse_json_response(response_text):
+    """応答テキストからJSONを抽出してパースする。失敗した場合は None"""
+    json_str = extract_json_string(response_text)
+    if json_str is None:
+        return None
     
-    print("抽出されたJSON文字列:")
-    print(json_str)
+    log("抽出されたJSON文字列:")
+    log(json_str)
     
     try:
-        # JSONパース
-        result = json.loads(json_str)
-        
-        # 座標が画像サイズの範囲内かチェック
-        coords = result['crop_coordinates']
-        if coords['x_min'] < 0 or coords['y_min'] < 0 or coords['x_max'] > img_width or coords['y_max'] > img_height:
-            print("警告: 座標が画像の範囲外です。座標を調整します。")
-            coords['x_min'] = max(0, min(coords['x_min'], img_width - 1))
-            coords['y_min'] = max(0, min(coords['y_min'], img_height - 1))
-            coords['x_max'] = max(coords['x_min'] + 1, min(coords['x_max'], img_width))
-            coords['y_max'] = max(coords['y_min'] + 1, min(coords['y_max'], img_height))
-            print(f"調整後の座標: ({coords['x_min']}, {coords['y_min']}) to ({coords['x_max']}, {coords['y_max']})")
-        
-        return result
+        return json.loads(json_str)
     except json.JSONDecodeError as e:
-        print(f"JSONのパースに失敗しました: {e}")
+        log(f"JSONのパースに失敗しました: {e}")
         # JSONをより寛容にパースする追加の試み
         try:
             # 引用符の修正を試みる
-            fixed_json = json_str.replace("'", '"')
-            result = json.loads(fixed_json)
-            return result
+            return json.loads(json_str.replace("'", '"'))
         except:
-            print("修正を試みましたが失敗しました。APIのレスポンス全体:")
-            print(response_text)
+            log("修正を試みましたが失敗しました。APIのレスポンス全体:")
+            log(response_text)
             return None
-        
-def crop_and_save_image(image_path, crop_coordinates, output_path, force_16_9_ratio=True, resize_width=None, resize_height=None):
-    """画像をクロップして保存。16:9の比率にし、オプションで高さをリサイズ"""
-    with Image.open(image_path) as img:
-        # 元の画像形式を保存
-        original_format = img.format
-        # 画像サイズを取得
-        img_width, img_height = img.size
-        print(f"元画像サイズ: {img_width}x{img_height}")
-        
-        # クロップ座標を取得し、画像の範囲内に収める
-        x_min = max(0, int(crop_coordinates["x_min"]))
-        y_min = max(0, int(crop_coordinates["y_min"]))
-        x_max = min(img_width, int(crop_coordinates["x_max"]))
-        y_max = min(img_height, int(crop_coordinates["y_max"]))
-        
-        print(f"初期クロップ座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
-        
-        # 有効な座標かチェック
-        if x_min >= x_max or y_min >= y_max:
-            print("エラー: 無効なクロップ座標です。最小値の座標を調整します。")
-            # 最小サイズのクロップ領域を作成
-            if x_min >= x_max:
-                x_max = min(x_min + 10, img_width)
-            if y_min >= y_max:
-                y_max = min(y_min + 10, img_height)
-            print(f"調整後の座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
-        
-        # 16:9の比率に調整
-        if force_16_9_ratio:
-            # 16:9比率調整前の座標を保存(表示用)
-            original_coords = {
-                "x_min": x_min,
-                "y_min": y_min,
-                "x_max": x_max,
-                "y_max": y_max
-            }
-            
-            # 16:9の比率に精密に調整(新しい関数を使用)
-            adjusted_coords = adjust_crop_to_exact_16_9_ratio(
-                {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max},
-                img_width, img_height
+
+def parse_structured_response(response_text, schema):
+    """構造化出力の応答をパースしてスキーマで検証する（テキストからの抽出や引用符の修正は行わない）。失敗した場合は None"""
+    try:
+        data = json.loads(response_text)
+    except (TypeError, json.JSONDecodeError) as e:
+        log(f"構造化出力のパースに失敗しました: {e}")
+        return None
+    error = validate_schema(data, schema)
+    if error:
+        log(f"構造化出力がスキーマに一致しません: {error}")
+        return None
+    return data
+
+def clamp_crop_coordinates(coords, img_width, img_height):
+    """座標が画像サイズの範囲外の場合は範囲内に収める（coords を直接変更する）"""
+    if coords['x_min'] < 0 or coords['y_min'] < 0 or coords['x_max'] > img_width or coords['y_max'] > img_height:
+        log("警告: 座標が画像の範囲外です。座標を調整します。")
+        coords['x_min'] = max(0, min(coords['x_min'], img_width - 1))
+        coords['y_min'] = max(0, min(coords['y_min'], img_height - 1))
+        coords['x_max'] = max(coords['x_min'] + 1, min(coords['x_max'], img_width))
+        coords['y_max'] = max(coords['y_min'] + 1, min(coords['y_max'], img_height))
+        log(f"調整後の座標: ({coords['x_min']}, {coords['y_min']}) to ({coords['x_max']}, {coords['y_max']})")
+    return coords
+
+def parse_crop_response(response_text, img_width, img_height, structured=False, step_count=None, confidence=False):
+    """応答テキストからクロップ結果を取り出し、座標を送信した画像（img_width x img_height）の範囲内に収める
+
+    step_count を指定すると複数工程の応答として解析し、工程の順の結果リスト（取得できなかった工程は None）を返す。
+    confidence を指定した場合、構造化出力は confidence を含むスキーマで検証する。
+    解析に失敗した場合は None。
+    """
+    if step_count is None:
+        if structured:
+            schema = with_confidence(CROP_RESULT_SCHEMA) if confidence else CROP_RESULT_SCHEMA
+            result = parse_structured_response(response_text, schema)
+        else:
+            result = parse_json_response(response_text)
+        if isinstance(result, dict) and isinstance(result.get('crop_coordinates'), dict):
+            try:
+                clamp_crop_coordinates(result['crop_coordinates'], img_width, img_height)
+            except (KeyError, TypeError):
+                pass
+        return result
+
+    if structured:
+        parsed = parse_structured_response(response_text, with_confidence(CROP_STEPS_SCHEMA) if confidence else CROP_STEPS_SCHEMA)
+    else:
+        parsed = parse_json_response(response_text)
+    steps = parsed.get('steps') if isinstance(parsed, dict) else None
+    if not isinstance(steps, list):
+        log("エラー: APIレスポンスに 'steps' の配列が含まれていません。")
+        return None
+
+    results = [None] * step_count
+    for position, step in enumerate(steps):
+        if not isinstance(step, dict):
+            continue
+        number = step.get('step', position + 1)
+        if not isinstance(number, int) or not 1 <= number <= step_count:
+            log(f"警告: 不明な工程番号のため無視します: {number}")
+            continue
+        if results[number - 1] is not None:
+            continue
+        result = {"crop_coordinates": step.get('crop_coordinates'), "description": step.get('description')}
+        if 'confidence' in step:
+            result['confidence'] = step['confidence']
+        if isinstance(result['crop_coordinates'], dict):
+            try:
+                clamp_crop_coordinates(result['crop_coordinates'], img_width, img_height)
+            except (KeyError, TypeError):
+                pass
+        results[number - 1] = result
+    return results
+
+def crop_image_with_gpt(image, instruction, proxy_max_edge=None, proxy_quality=85, cache=None, timeout=None, client=None,
+                        structured=False, limiter=None, near_duplicates=None, model=None, confidence=False):
+    """GPT-4 Vision APIを使用して画像からクロップ領域の座標を取得（画像パスまたはImageJobを受け付ける）
+
+    proxy_max_edge を指定すると、長辺がそれより大きい画像は縮小したプロキシ画像を送信し、
+    返された座標を元画像のピクセル座標に戻して返す。
+    cache（ResponseCache）を指定すると、同じ画像・指示文の結果がある場合はAPIを呼び出さずに返す。
+    client を指定するとそのクライアントを使い回す（省略した場合は呼び出しごとに作成）。
+    structured を指定すると構造化出力（JSONスキーマ）で応答を受け取り、出力トークン数の上限を小さくする。
+    limiter（RateLimiter）を指定すると、レート制限の範囲内で呼び出し、429 や一時的なエラーはリトライする。
+    near_duplicates（NearDuplicateIndex）を指定すると、似た画像の同じ指示文の結果がある場合は
+    その座標を画像サイズに合わせて変換して返し、APIから取得した結果はインデックスに追加する。
+    model を指定すると MODEL_NAME の代わりにそのモデルを使う（キャッシュなどのキーにも含まれる）。
+    confidence を指定すると、結果の確からしさ（0〜1）も返させて結果の confidence に入れる。
+    """
+    job = load_image_job(image)
+    model = model or MODEL_NAME
+
+    # キャッシュを確認（ヒットした場合はbase64エンコードとAPI呼び出しを省略）
+    cache_key = None
+    if cache is not None:
+        cache_key = make_cache_key(
+            job.sha256, instruction, model, PROMPT_VERSION, proxy_max_edge=proxy_max_edge, structured=structured,
+            confidence=confidence
+        )
+        cached = cache.get(cache_key)
+        if cached is not None:
+            log(f"キャッシュから結果を取得しました: {cached['crop_coordinates']}")
+            cached['cached'] = True
+            return cached
+    if near_duplicates is not None:
+        reused = reuse_near_duplicate(job, instruction, near_duplicates, model)
+        if reused is not None:
+            return reused
+
+    client = client or _create_client(timeout, max_retries=0 if limiter else None)
+    metrics = RequestMetrics()
+    request_job, base64_image, mime_type, upload_stats = _prepare_request_image(job, proxy_max_edge, proxy_quality, metrics)
+    
+    # API呼び出し（プロンプトと座標チェックには送信する画像のサイズを使う）
+    body = build_request_body(request_job, base64_image, mime_type, [instruction], structured=structured, model=model,
+                              confidence=confidence)
+    response_text = _request_completion(client, body, metrics=metrics, limiter=limiter, image_size=request_job.size)
+    
+    with metrics.stage("parse"):
+        result = parse_crop_response(response_text, *request_job.size, structured=structured, confidence=confidence)
+    if result is None:
+        return None
+    if isinstance(result, dict):
+        result['metrics'] = metrics.as_dict()
+    result = _finalize_result(result, request_job.size, job.size, upload_stats, cache, cache_key)
+    store_near_duplicate(job, instruction, near_duplicates, result, model)
+    return result
+
+def crop_image_with_gpt_multi(image, instructions, proxy_max_edge=None, proxy_quality=85, cache=None, timeout=None,
+                              client=None, structured=False, limiter=None, near_duplicates=None, model=None,
+                              confidence=False):
+    """1枚の画像に対する複数の工程のクロップ座標を、1回のAPI呼び出しでまとめて取得
+
+    画像のアップロードとシステムプロンプトの送信は1回だけで済む。
+    戻り値は instructions と同じ順序の結果リストで、取得できなかった工程は None になる。
+    """
+    job = load_image_job(image)
+    model = model or MODEL_NAME
+    results = [None] * len(instructions)
+    cache_keys = [None] * len(instructions)
+
+    # キャッシュにある工程は除外し、残りの工程だけを問い合わせる
+    pending = []
+    for index, instruction in enumerate(instructions):
+        if cache is not None:
+            cache_keys[index] = make_cache_key(
+                job.sha256, instruction, model, PROMPT_VERSION, proxy_max_edge=proxy_max_edge, mode="multi",
+                structured=structured, confidence=confidence
             )
-            
-            x_min = adjusted_coords["x_min"]
-            y_min = adjusted_coords["y_min"]
-            x_max = adjusted_coords["x_max"]
-            y_max = adjusted_coords["y_max"]
-            
-            # 調整前後の座標を比較
-            print(f"16:9比率に調整前: 幅={original_coords['x_max']-original_coords['x_min']}, 高さ={original_coords['y_max']-original_coords['y_min']}")
-            print(f"16:9比率に調整後: 幅={x_max-x_min}, 高さ={y_max-y_min}")
-            print(f"比率: {(x_max-x_min)/(y_max-y_min):.6f} (目標: 1.777778)")
-            
-        print(f"最終クロップ座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
-            
-        # クロップ
+            cached = cache.get(cache_keys[index])
+            if cached is not None:
+                log(f"キャッシュから結果を取得しました（工程{index + 1}）: {cached['crop_coordinates']}")
+                cached['cached'] = True
+                results[index] = cached
+                continue
+        if near_duplicates is not None:
+            results[index] = reuse_near_duplicate(job, instruction, near_duplicates, model)
+            if results[index] is not None:
+                continue
+        pending.append(index)
+    if not pending:
+        return results
+
+    client = client or _create_client(timeout, max_retries=0 if limiter else None)
+    metrics = RequestMetrics()
+    request_job, base64_image, mime_type, upload_stats = _prepare_request_image(job, proxy_max_edge, proxy_quality, metrics)
+
+    body = build_request_body(
+        request_job, base64_image, mime_type, [instructions[index] for index in pending], structured=structured,
+        multi_step=True, model=model, confidence=confidence
+    )
+    response_text = _request_completion(client, body, metrics=metrics, limiter=limiter, image_size=request_job.size)
+    with metrics.stage("parse"):
+        step_results = parse_crop_response(response_text, *request_job.size, structured=structured,
+                                           step_count=len(pending), confidence=confidence)
+    if step_results is None:
+        return results
+
+    # 送信量・計測結果は工程数で按分して各結果に記録する
+    shared_upload = dict(upload_stats, bytes=upload_stats["bytes"] // len(pending), shared_steps=len(pending))
+    for index, result in zip(pending, step_results):
+        if result is None:
+            continue
+        result['metrics'] = metrics.shared(len(pending))
+        results[index] = _finalize_result(result, request_job.size, job.size, dict(shared_upload), cache, cache_keys[index])
+        store_near_duplicate(job, instructions[index], near_duplicates, results[index], model)
+
+    missing = [index + 1 for index in pending if results[index] is None]
+    if missing:
+        log(f"警告: 以下の工程の座標が返されませんでした: {missing}")
+    return results
+
+def crop_image_locally(image, instruction=None, aspect_ratio=(16, 9), analysis_size=256, **api_options):
+    """ネットワークを使わずにローカルでクロップ領域を推定（crop_image_with_gpt と同じ形式の結果を返す）
+
+    縮小画像上でエッジ・色のコントラスト・肌色から顕著性マップを作り、指定の比率で最も顕著な領域を選ぶ。
+    指示文の内容は考慮しない。api_options（proxy_max_edge など）は互換性のために受け付けて無視する。
+    """
+    from local_engine import locate_salient_crop
+
+    job = load_image_job(image)
+    metrics = RequestMetrics()
+    with metrics.stage("decode"):
+        thumbnail = load_thumbnail(job, analysis_size)
+    with metrics.stage("local"):
+        (x_min, y_min, x_max, y_max), score, confidence = locate_salient_crop(
+            thumbnail, ratio=parse_aspect_ratio(aspect_ratio)
+        )
+    coords = scale_crop_coordinates(
+        {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}, thumbnail.size, job.size
+    )
+    log(f"ローカル推定のクロップ座標: {coords} (スコア: {score:.2f}, 確からしさ: {confidence:.2f})")
+    return {
+        "crop_coordinates": coords,
+        "description": "ローカル推定（エッジ・色のコントラスト・手元の肌色に基づく領域）",
+        "backend": "local",
+        "score": score,
+        "confidence": confidence,
+        "metrics": metrics.as_dict(),
+    }
+
+# クロップ座標を求めるバックエンド（いずれも (画像, 指示文, **オプション) を受け取り同じ形式の結果を返す）
+CROP_BACKENDS = {
+    "gpt": crop_image_with_gpt,
+    "local": crop_image_locally,
+}
+
+def analyze_image(image, instructions, backend="gpt", fallback=None, aspect_ratio=(16, 9), escalation=None, **options):
+    """指定したバックエンドで各指示のクロップ座標を取得し、instructions と同じ順序の結果リストを返す
+
+    gpt バックエンドで指示が複数ある場合は1回のリクエストにまとめる。
+    escalation（EscalationPolicy）を指定すると、gpt バックエンドではまず軽量なモデル（またはローカル推定）で求め、
+    結果が無効・小さすぎる・ほぼ全体・確からしさが低い指示だけを大きいモデルで取り直す（analyze_tiered を参照）。
+    fallback を指定すると、エラー（タイムアウトを含む）や無効な結果になった指示をそのバックエンドで取り直す。
+    """
+    job = load_image_job(image)
+
+    def call(name, instruction):
+        if name == "local":
+            return crop_image_locally(job, instruction, aspect_ratio=aspect_ratio)
+        return CROP_BACKENDS[name](job, instruction, **options)
+
+    try:
+        if backend == "gpt" and escalation is not None:
+            results = analyze_tiered(job, instructions, escalation, aspect_ratio=aspect_ratio, **options)
+        elif backend == "gpt" and len(instructions) > 1:
+            results = crop_image_with_gpt_multi(job, instructions, **options)
+        else:
+            results = [call(backend, instruction) for instruction in instructions]
+    except Exception as e:
+        if not fallback:
+            raise
+        log(f"{backend} バックエンドでエラーが発生したため {fallback} バックエンドを使用します: {e}")
+        results = [None] * len(instructions)
+
+    if fallback:
+        for index, result in enumerate(results):
+            if validate_crop_result(result):
+                log(f"指示「{instructions[index]}」の結果が無効なため {fallback} バックエンドを使用します")
+                results[index] = call(fallback, instructions[index])
+                if isinstance(results[index], dict):
+                    results[index]['fallback'] = True
+    return results
+
+def analyze_tiered(image, instructions, escalation, aspect_ratio=(16, 9), **options):
+    """軽量な段（escalation.fast_model のモデル、またはローカル推定）で各指示の座標を求め、
+    大きいモデルに回す必要がある指示（EscalationPolicy.escalation_reason を参照）だけを取り直す
+
+    大きいモデルは options の model（省略した場合は MODEL_NAME）。複数の指示はそれぞれの段で1回のリクエストにまとめる。
+    各結果の tier に使った段（fast / full）、escalation に大きいモデルに回した理由が入る。
+    軽量な段でエラーになった場合は全ての指示を大きいモデルで取り直す。
+    """
+    job = load_image_job(image)
+
+    def request(model, pending, **extra):
+        if model == LOCAL_TIER:
+            return [crop_image_locally(job, instructions[index], aspect_ratio=aspect_ratio) for index in pending]
+        tier_options = dict(options, model=model, **extra)
+        if len(pending) > 1:
+            return crop_image_with_gpt_multi(job, [instructions[index] for index in pending], **tier_options)
+        return [crop_image_with_gpt(job, instructions[pending[0]], **tier_options)]
+
+    started = time.perf_counter()
+    try:
+        results = request(escalation.fast_model, range(len(instructions)), confidence=not escalation.local)
+    except Exception as e:
+        log(f"軽量な段（{escalation.fast_model}）でエラーが発生したため、大きいモデルを使用します: {e}")
+        results = [None] * len(instructions)
+        reasons = ["error"] * len(instructions)
+    else:
+        reasons = [escalation.escalation_reason(result, job.size, validate_crop_result(result)) for result in results]
+    escalation.record_call("fast", time.perf_counter() - started, results)
+    escalation.record_results(reasons)
+    for result in results:
+        if isinstance(result, dict):
+            result['tier'] = "fast"
+
+    pending = [index for index, reason in enumerate(reasons) if reason]
+    if not pending:
+        return results
+    log(f"{len(pending)}件の指示を大きいモデルで取り直します: "
+        f"{', '.join(f'{instructions[index]}（{reasons[index]}）' for index in pending)}")
+    started = time.perf_counter()
+    escalated = request(options.get('model') or MODEL_NAME, pending)
+    escalation.record_call("full", time.perf_counter() - started, escalated)
+    for index, result in zip(pending, escalated):
+        if isinstance(result, dict):
+            result['tier'] = "full"
+            result['escalation'] = reasons[index]
+        elif results[index] is not None and not validate_crop_result(results[index]):
+            # 大きいモデルで取得できなかった場合は、軽量な段の有効な結果を使う
+            results[index]['escalation'] = reasons[index]
+            continue
+        results[index] = result
+    return results
+
+# フレーム列モードでコンタクトシートを送る場合に、各指示文の後に付け加える説明
+FRAME_SHEET_NOTE = ("（この画像は動画の複数のフレームを白い余白で区切って並べたものです。"
+                    "指示に最も合うフレームを1つ選び、そのフレームの中だけで領域を指定してください）")
+
+FRAME_MODES = ('sheet', 'best')
+
+def _frame_job(source, index, frames=None):
+    """フレームのImageJob（ディレクトリのフレームはファイルをそのまま、GIF/WebPのフレームはPNGにエンコードして保持）"""
+    from frame_sequence import frame_path
+
+    path = frame_path(source, index)
+    if path is not None:
+        return ImageJob.from_path(path)
+    buffer = io.BytesIO()
+    frames[index].save(buffer, 'PNG')
+    return ImageJob(buffer.getvalue())
+
+def analyze_frames(source, instructions, frame_mode="sheet", max_keyframes=4, scene_threshold=12.0, tile_edge=512,
+                   backend="gpt", fallback=None, aspect_ratio=(16, 9), **options):
+    """フレーム列（フレーム画像のディレクトリ、または複数フレームのGIF/WebP）から各指示に合うフレームを選び、クロップ座標を取得
+
+    フレームを縮小して1枚ずつ読み、ほとんど変化しないフレームを同じシーンにまとめて、長く映っているシーンの
+    最も鮮明なフレームを最大 max_keyframes 枚の候補にする（frame_sequence.py を参照）。
+    frame_mode が sheet の場合は候補を並べた1枚のコンタクトシートを送り、返された座標を選ばれたフレームの座標に戻す。
+    best の場合は最も長く映っているシーンのフレームだけを送る。
+    いずれもクリップの長さによらず、1回の問い合わせ（複数の工程は1回にまとめる）で済む。
+    戻り値は (instructions と同じ順序の結果リスト, 工程ごとのフレームのImageJob のリスト)。
+    各結果の frame に選ばれたフレームの情報が入る。フレームがない場合は None。
+    """
+    from frame_sequence import scan_scenes, choose_keyframes, load_frames, build_contact_sheet, map_sheet_box
+
+    frame_metrics = RequestMetrics()
+    with frame_metrics.stage("frames"):
+        scenes = scan_scenes(source, scene_threshold=scene_threshold)
+    if not scenes:
+        return None
+    keyframes = choose_keyframes(scenes, 1 if frame_mode == "best" else max_keyframes)
+    frame_count = scenes[-1]["end"] + 1
+    log(f"フレーム数: {frame_count}, シーン数: {len(scenes)}, "
+        f"候補のフレーム: {', '.join(scene['name'] for scene in keyframes)}")
+
+    frames = None if os.path.isdir(source) else load_frames(source, [scene["frame"] for scene in keyframes])
+    jobs = [_frame_job(source, scene["frame"], frames) for scene in keyframes]
+    summary = {"frames": frame_count, "scenes": len(scenes), "candidates": len(keyframes), "mode": frame_mode}
+
+    if len(jobs) == 1:
+        results = analyze_image(jobs[0], instructions, backend=backend, fallback=fallback, aspect_ratio=aspect_ratio,
+                                **options)
+        positions = [0] * len(instructions)
+    else:
+        with frame_metrics.stage("sheet"):
+            sheet, tiles = build_contact_sheet([load_thumbnail(job, tile_edge) for job in jobs], tile_edge=tile_edge)
+            buffer = io.BytesIO()
+            sheet.save(buffer, 'JPEG', quality=90)
+        log(f"{len(jobs)}枚の候補のフレームを並べたコンタクトシートを送信します: {sheet.width}x{sheet.height}")
+        results = analyze_image(
+            ImageJob(buffer.getvalue()), [instruction + FRAME_SHEET_NOTE for instruction in instructions],
+            backend=backend, fallback=fallback, aspect_ratio=aspect_ratio, **options
+        )
+        positions = []
+        for result in results:
+            if validate_crop_result(result):
+                positions.append(0)
+                continue
+            position, coords = map_sheet_box(result['crop_coordinates'], tiles, [job.size for job in jobs])
+            result['sheet_coordinates'] = result['crop_coordinates']
+            result['crop_coordinates'] = coords
+            log(f"フレーム {keyframes[position]['name']} の座標に変換しました: {coords}")
+            positions.append(position)
+
+    # フレームの選択にかかった時間は工程数で按分して各結果に記録する
+    shared = frame_metrics.shared(len(instructions))
+    for result, position in zip(results, positions):
+        if isinstance(result, dict):
+            scene = keyframes[position]
+            result['frame'] = dict(summary, index=scene["frame"], name=scene["name"])
+            metrics = RequestMetrics()
+            metrics.merge(result.get('metrics'))
+            metrics.merge(shared)
+            result['metrics'] = metrics.as_dict()
+    return results, [jobs[position] for position in positions]
+
+def _finalize_result(result, request_size, image_size, upload_stats, cache=None, cache_key=None):
+    """プロキシ画像（request_size）上の座標を元画像（image_size）の座標に戻し、送信量の情報を結果に付け加えてキャッシュに保存する"""
+    if not isinstance(result, dict):
+        return result
+    if tuple(request_size) != tuple(image_size) and isinstance(result.get('crop_coordinates'), dict):
         try:
-            cropped_img = img.crop((x_min, y_min, x_max, y_max))
-            
-            # リサイズ処理（幅優先）
-            if resize_width and resize_width > 0:
-                print(f"\n幅{resize_width}pxにリサイズします...")
-                target_height = int(resize_width * 9 / 16)
-                cropped_img = cropped_img.resize((resize_width, target_height), Image.Resampling.LANCZOS)
-                print(f"リサイズ後のサイズ: {resize_width}x{target_height}")
-            elif resize_height and resize_height > 0:
-                print(f"\n高さ{resize_height}pxにリサイズします...")
-                target_width = int(resize_height * 16 / 9)
-                cropped_img = cropped_img.resize((target_width, resize_height), Image.Resampling.LANCZOS)
-                print(f"リサイズ後のサイズ: {target_width}x{resize_height}")
-            
-            # 出力ファイルの拡張子を確認
-            output_ext = os.path.splitext(output_path)[1].lower()
-            
-            # JPEGで保存する場合、RGBモードに変換
-            if output_ext in ['.jpg', '.jpeg']:
-                if cropped_img.mode in ['P', 'RGBA', 'LA']:
-                    # パレットモードまたは透過チャンネルがある場合はRGBに変換
-                    print(f"画像モードを {cropped_img.mode} から RGB に変換します")
-                    # 白背景を作成して透過部分を処理
-                    if cropped_img.mode == 'P':
-                        cropped_img = cropped_img.convert('RGB')
-                    elif cropped_img.mode in ['RGBA', 'LA']:
-                        background = Image.new('RGB', cropped_img.size, (255, 255, 255))
-                        if cropped_img.mode == 'LA':
-                            cropped_img = cropped_img.convert('RGBA')
-                        background.paste(cropped_img, mask=cropped_img.split()[-1])
-                        cropped_img = background
-                cropped_img.save(output_path, 'JPEG', quality=95)
-            elif output_ext == '.png':
-                # PNGの場合はそのまま保存
-                cropped_img.save(output_path, 'PNG')
-            else:
-                # その他の形式
-                cropped_img.save(output_path)
-            print(f"クロップした画像サイズ: {cropped_img.width}x{cropped_img.height}")
-            return cropped_img, {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}
-        except Exception as e:
-            print(f"画像のクロップ中にエラーが発生しました: {e}")
-            return None, None
-        
-def resize_image_to_fixed_height(image_path, output_path, target_height=120):
-    """16:9の比率を維持したまま画像を指定の高さにリサイズ"""
-    with Image.open(image_path) as img:
-        # 元の画像形式を保存
-        original_format = img.format
-        
-        # 現在のサイズを取得
-        current_width, current_height = img.size
-        print(f"リサイズ前のサイズ: {current_width}x{current_height}")
+            result['crop_coordinates'] = scale_crop_coordinates(result['crop_coordinates'], request_size, image_size)
+            log(f"元画像の座標に変換しました: {result['crop_coordinates']}")
+        except (KeyError, TypeError) as e:
+            log(f"警告: 座標の変換に失敗しました: {e}")
+    result['upload'] = upload_stats
+    if cache is not None and cache_key and not validate_crop_result(result):
+        cache.put(cache_key, result)
+    return result
+
+def reuse_near_duplicate(image, instruction, near_duplicates, model=MODEL_NAME):
+    """似た画像（知覚ハッシュが近く縦横比が同じ画像）の同じ指示文の結果があれば、
+    座標をこの画像のサイズに変換した結果を返す（なければ None）"""
+    from perceptual_index import make_scope_key
+
+    job = load_image_job(image)
+    if job.perceptual_hash is None:
+        return None
+    entry = near_duplicates.lookup(make_scope_key(instruction, model, PROMPT_VERSION), job.perceptual_hash, job.size)
+    if entry is None:
+        return None
+    coords = scale_crop_coordinates(entry['crop_coordinates'], entry['size'], job.size)
+    log(f"似た画像の結果を再利用しました（ハミング距離 {entry['distance']}）: {coords}")
+    result = {
+        "crop_coordinates": coords,
+        "description": entry.get('description'),
+        "near_duplicate": {"distance": entry['distance'], "source_size": list(entry['size'])},
+    }
+    if entry.get('confidence') is not None:
+        result['confidence'] = entry['confidence']
+    return result
+
+def store_near_duplicate(image, instruction, near_duplicates, result, model=MODEL_NAME):
+    """APIから取得した有効な結果を、似た画像のインデックスに追加する"""
+    if near_duplicates is None or validate_crop_result(result):
+        return
+    from perceptual_index import make_scope_key
+
+    job = load_image_job(image)
+    try:
+        if job.perceptual_hash is None:
+            return
+        near_duplicates.add(make_scope_key(instruction, model, PROMPT_VERSION), job.perceptual_hash, job.size, result)
+    except Exception as e:
+        log(f"警告: 似た画像のインデックスへの追加に失敗しました: {e}")
+
+def crop_image(image, crop_coordinates, force_16_9_ratio=True, resize_width=None, resize_height=None,
+               aspect_ratio=(16, 9), reduced_decode=True, metrics=None):
+    """画像をクロップしてメモリ上のPIL画像を返す。16:9（aspect_ratio で変更可能）の比率にし、オプションでリサイズ
+
+    戻り値は (クロップ画像, 最終座標, 比率調整前の座標, リサイズ前のクロップ画像) で、
+    縮小デコード（reduced_decode）を使った場合はリサイズ前のクロップ画像は None になる。
+    metrics（RequestMetrics）を指定すると、デコード・比率調整・切り出し・リサイズの時間を記録する。
+    """
+    metrics = metrics or RequestMetrics()
+    ratio_width, ratio_height = parse_aspect_ratio(aspect_ratio)
+    job = load_image_job(image)
+    # 画像サイズを取得（ピクセルのデコードはクロップ時まで行わない）
+    img_width, img_height = job.size
+    log(f"元画像サイズ: {img_width}x{img_height}")
+    
+    # クロップ座標を取得し、画像の範囲内に収める
+    x_min = max(0, int(crop_coordinates["x_min"]))
+    y_min = max(0, int(crop_coordinates["y_min"]))
+    x_max = min(img_width, int(crop_coordinates["x_max"]))
+    y_max = min(img_height, int(crop_coordinates["y_max"]))
+    
+    log(f"初期クロップ座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
+    
+    # 有効な座標かチェック
+    if x_min >= x_max or y_min >= y_max:
+        log("エラー: 無効なクロップ座標です。最小値の座標を調整します。")
+        # 最小サイズのクロップ領域を作成
+        if x_min >= x_max:
+            x_max = min(x_min + 10, img_width)
+        if y_min >= y_max:
+            y_max = min(y_min + 10, img_height)
+        log(f"調整後の座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
+    
+    # 16:9（指定された比率）に調整
+    if force_16_9_ratio:
+        # 比率調整前の座標を保存(表示用)
+        original_coords = {
+            "x_min": x_min,
+            "y_min": y_min,
+            "x_max": x_max,
+            "y_max": y_max
+        }
         
-        # 16:9の比率を維持したまま、目標の高さに合わせた幅を計算
-        target_width = int(target_height * 16 / 9)
+        # 整数比で厳密に調整
+        with metrics.stage("fit"):
+            adjusted_coords = fit_aspect_ratio(
+                {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max},
+                img_width, img_height, ratio=(ratio_width, ratio_height)
+            )
         
-        # リサイズ (高品質なLANCZOS補間を使用)
-        resized_img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-        print(f"リサイズ後のサイズ: {target_width}x{target_height}")
-        print(f"比率: {target_width/target_height:.6f} (目標: 1.777778)")
+        x_min = adjusted_coords["x_min"]
+        y_min = adjusted_coords["y_min"]
+        x_max = adjusted_coords["x_max"]
+        y_max = adjusted_coords["y_max"]
         
-        # 出力ファイルの拡張子を確認
-        output_ext = os.path.splitext(output_path)[1].lower()
+        # 調整前後の座標を比較
+        log(f"{ratio_width}:{ratio_height}比率に調整前: 幅={original_coords['x_max']-original_coords['x_min']}, 高さ={original_coords['y_max']-original_coords['y_min']}")
+        log(f"{ratio_width}:{ratio_height}比率に調整後: 幅={x_max-x_min}, 高さ={y_max-y_min}")
+        log(f"比率: {(x_max-x_min)/(y_max-y_min):.6f} (目標: {ratio_width/ratio_height:.6f})")
         
-        # JPEGで保存する場合、RGBモードに変換
-        if output_ext in ['.jpg', '.jpeg']:
-            if resized_img.mode in ['P', 'RGBA', 'LA']:
-                print(f"画像モードを {resized_img.mode} から RGB に変換します")
-                if resized_img.mode == 'P':
-                    resized_img = resized_img.convert('RGB')
-                elif resized_img.mode in ['RGBA', 'LA']:
-                    background = Image.new('RGB', resized_img.size, (255, 255, 255))
-                    if resized_img.mode == 'LA':
-                        resized_img = resized_img.convert('RGBA')
-                    background.paste(resized_img, mask=resized_img.split()[-1])
-                    resized_img = background
-            resized_img.save(output_path, 'JPEG', quality=95)
-        elif output_ext == '.png':
-            resized_img.save(output_path, 'PNG')
-        else:
-            resized_img.save(output_path)
+    log(f"最終クロップ座標: ({x_min}, {y_min}) to ({x_max}, {y_max})")
         
-        print(f"リサイズした画像を保存しました: {output_path}")
-        return resized_img
-    
+    # 比率調整前の座標（比率の異なるレンディション用）
+    requested_coords = {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}
+    if force_16_9_ratio:
+        requested_coords = original_coords
 
-def adjust_crop_to_exact_16_9_ratio(crop_coordinates, img_width, img_height):
-    """クロップ座標を正確に16:9の比率に調整する関数（拡大優先・精密計算）"""
-    x_min = crop_coordinates["x_min"]
-    y_min = crop_coordinates["y_min"]
-    x_max = crop_coordinates["x_max"]
-    y_max = crop_coordinates["y_max"]
-    
-    # 現在のクロップ領域の幅と高さを計算
-    current_width = x_max - x_min
-    current_height = y_max - y_min
-    
-    # 目標とする比率
-    target_ratio = 16/9 
-    
-    # 現在の比率を計算
-    current_ratio = current_width / current_height if current_height != 0 else 0
-    
-    print(f"現在の比率: {current_ratio:.4f} (目標: {target_ratio:.4f})")
-    print(f"調整前: 幅={current_width}, 高さ={current_height}")
-    
-    # 精密な計算のため浮動小数点で計算
-    if current_ratio <= target_ratio:
-        # 幅を増やす（高さを固定）
-        new_width = int(current_height * target_ratio + 0.5)  # 四捨五入
-        width_diff = new_width - current_width
-        
-        # 左右均等に拡張
-        new_x_min = max(0, x_min - width_diff // 2)
-        new_x_max = min(img_width, new_x_min + new_width)
-        
-        # 画像の端に達した場合の調整
-        if new_x_max > img_width:
-            new_x_max = img_width
-            new_x_min = max(0, new_x_max - new_width)
-        
-        # 高さはそのまま
-        new_y_min = y_min
-        new_y_max = y_max
-        
+    # クロップ
+    # リサイズ後のサイズ（幅優先）
+    target_size = None
+    if resize_width and resize_width > 0:
+        log(f"\n幅{resize_width}pxにリサイズします...")
+        target_size = (resize_width, int(resize_width * ratio_height / ratio_width))
+    elif resize_height and resize_height > 0:
+        log(f"\n高さ{resize_height}pxにリサイズします...")
+        target_size = (int(resize_height * ratio_width / ratio_height), resize_height)
+
+    full_crop = None
+    if (target_size and reduced_decode
+            and x_max - x_min >= target_size[0] * 2 and y_max - y_min >= target_size[1] * 2):
+        # 出力が十分小さい場合は縮小デコードでクロップとリサイズをまとめて行う（時間は decode に含める）
+        with metrics.stage("decode"):
+            cropped_img = crop_and_resize_reduced(job, (x_min, y_min, x_max, y_max), target_size)
     else:
-        # 高さを増やす（幅を固定）
-        new_height = int(current_width / target_ratio + 0.5)  # 四捨五入
-        height_diff = new_height - current_height
-        
-        # 上下均等に拡張
-        new_y_min = max(0, y_min - height_diff // 2)
-        new_y_max = min(img_height, new_y_min + new_height)
-        
-        # 画像の端に達した場合の調整
-        if new_y_max > img_height:
-            new_y_max = img_height
-            new_y_min = max(0, new_y_max - new_height)
+        if job.large:
+            # 大きい画像モードではクロップ領域だけをデコードする（時間は decode に含める）
+            with metrics.stage("decode"):
+                cropped_img = decode_region(job, (x_min, y_min, x_max, y_max))
+        else:
+            with metrics.stage("decode"):
+                img = job.image
+            with metrics.stage("crop"):
+                cropped_img = img.crop((x_min, y_min, x_max, y_max))
+        full_crop = cropped_img
+        if target_size:
+            with metrics.stage("resize"):
+                cropped_img = cropped_img.resize(target_size, Image.Resampling.LANCZOS)
+    if target_size:
+        log(f"リサイズ後のサイズ: {target_size[0]}x{target_size[1]}")
+    final_coords = {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max}
+    return cropped_img, final_coords, requested_coords, full_crop
+
+def crop_and_save_image(image, crop_coordinates, output_path, force_16_9_ratio=True, resize_width=None, resize_height=None,
+                        aspect_ratio=(16, 9), renditions=None, metrics=None, encode_pool=None):
+    """画像をクロップして保存。16:9（aspect_ratio で変更可能）の比率にし、オプションでリサイズ（画像パスまたはImageJobを受け付ける）
+
+    renditions（レンディションの辞書のリスト）を指定すると、同じクロップから複数のサイズ・比率・形式の画像も保存し、
+    (クロップ画像, 座標, レンディションの情報のリスト) の3つを返す（save_renditions を参照）。
+    metrics（RequestMetrics）を指定すると、各処理段の時間と出力サイズを記録する。
+    encode_pool（ProcessPoolExecutor）を指定すると、エンコードと書き込みをそのプロセスプールで行う。
+    ファイルは一時ファイルに書き込んでから置き換える。
+    """
+    metrics = metrics or RequestMetrics()
+    ratio_width, ratio_height = parse_aspect_ratio(aspect_ratio)
+    job = load_image_job(image)
+    try:
+        cropped_img, final_coords, requested_coords, full_crop = crop_image(
+            job, crop_coordinates, force_16_9_ratio, resize_width, resize_height,
+            aspect_ratio=(ratio_width, ratio_height), reduced_decode=not renditions, metrics=metrics
+        )
         
-        # 幅はそのまま
-        new_x_min = x_min
-        new_x_max = x_max
-    
-    # 最終確認：範囲内に収まっているか
-    new_x_min = max(0, int(new_x_min))
-    new_y_min = max(0, int(new_y_min))
-    new_x_max = min(img_width, int(new_x_max))
-    new_y_max = min(img_height, int(new_y_max))
-    
-    # この時点での比率を確認
-    final_width = new_x_max - new_x_min
-    final_height = new_y_max - new_y_min
-    final_ratio = final_width / final_height if final_height != 0 else 0
-    
-    print(f"一次調整後: 幅={final_width}, 高さ={final_height}")
-    print(f"一次調整後の比率: {final_ratio:.4f}")
-    
-    # 比率の誤差が大きい場合は、ピクセル単位で微調整
-    if abs(final_ratio - target_ratio) > 0.0001:
-        if final_ratio < target_ratio:
-            # 幅を1ピクセルずつ増やす
-            while (new_x_max - new_x_min) / (new_y_max - new_y_min) < target_ratio and new_x_max < img_width:
-                new_x_max += 1
-            # それでも足りない場合は幅を減らす
-            while (new_x_max - new_x_min) / (new_y_max - new_y_min) < target_ratio and new_y_max > new_y_min + 1:
-                new_y_max -= 1
+        # エンコードと書き込み（encode_pool を指定した場合は別プロセスで行う）
+        if encode_pool is None:
+            size, encode_seconds, write_seconds = encode_and_write(cropped_img, output_path)
+        else:
+            size, encode_seconds, write_seconds = encode_pool.submit(encode_and_write, cropped_img, output_path).result()
+        metrics.merge({"timings": {"encode": encode_seconds, "write": write_seconds}, "output_bytes": size})
+        log(f"クロップした画像サイズ: {cropped_img.width}x{cropped_img.height}")
+        if renditions is None:
+            return cropped_img, final_coords
+        outputs = []
+        if renditions:
+            with metrics.stage("renditions"):
+                outputs = save_renditions(
+                    job, requested_coords, output_path, renditions,
+                    aspect_ratio=(ratio_width, ratio_height), force_ratio=force_16_9_ratio, base_crop=full_crop,
+                    encode_pool=encode_pool
+                )
+            metrics.add("output_bytes", sum(output["bytes"] for output in outputs))
+        return cropped_img, final_coords, outputs
+    except Exception as e:
+        log(f"画像のクロップ中にエラーが発生しました: {e}")
+        if renditions is None:
+            return None, None
+        return None, None, []
+
+def encode_and_write(img, output_path, image_format=None, quality=None):
+    """画像をエンコードしてファイルに書き込み、(バイト数, エンコード時間, 書き込み時間) を返す
+
+    image_format を省略した場合は出力パスの拡張子から判断する（save_image と同じ）。
+    プロセスプールから呼び出せるよう、引数と戻り値はpickle可能なものだけにしている。
+    """
+    started = time.perf_counter()
+    data = encode_image(img, image_format or os.path.splitext(output_path)[1], quality=quality)
+    encoded = time.perf_counter()
+    write_file_atomic(output_path, data)
+    return len(data), encoded - started, time.perf_counter() - encoded
+
+# 出力形式（拡張子）とPILの保存形式の対応（ここにない拡張子は Pillow に登録された形式を使う）
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'gif': 'GIF', 'bmp': 'BMP'}
+
+# JPEGでそのまま保存できる画像モード
+JPEG_MODES = ('RGB', 'L', 'CMYK')
+
+def image_save_format(image_format):
+    """出力形式（拡張子。先頭の . はあってもなくてもよい）からPILの保存形式を返す。対応していない場合は None"""
+    extension = image_format.lower().lstrip('.')
+    return IMAGE_FORMATS.get(extension) or Image.registered_extensions().get(f".{extension}")
+
+def encode_image(img, image_format='jpg', quality=None):
+    """画像を指定の形式でエンコードしたバイト列を返す
+
+    JPEGの場合、パレット・透過チャンネルを持つ画像（P / RGBA / LA）は白背景のRGBに変換する
+    （グレースケール・CMYKはそのまま保存する）。
+    quality はJPEG・WebPの品質。省略した場合、JPEGは95、WebPはPillowの既定値。
+    """
+    pil_format = image_save_format(image_format)
+    if pil_format is None:
+        raise ValueError(f"対応していない出力形式です: {image_format}")
+    options = {}
+    if pil_format == 'JPEG':
+        if img.mode not in JPEG_MODES:
+            log(f"画像モードを {img.mode} から RGB に変換します")
+            img = convert_to_rgb(img)
+        options['quality'] = quality or 95
+    elif pil_format == 'WEBP' and quality:
+        options['quality'] = quality
+    buffer = io.BytesIO()
+    img.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+def save_image(img, output_path, image_format=None, quality=None):
+    """画像をエンコードしてファイルに保存（形式を省略した場合は拡張子から判断）"""
+    image_format = image_format or os.path.splitext(output_path)[1]
+    data = encode_image(img, image_format, quality=quality)
+    write_file_atomic(output_path, data)
+    return len(data)
+
+def parse_rendition(spec):
+    """"width=640,format=webp,quality=80" のような文字列をレンディションの辞書に変換"""
+    rendition = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        key, _, value = item.partition('=')
+        key = key.strip()
+        value = value.strip()
+        if key in ['width', 'height', 'quality']:
+            rendition[key] = int(value)
+        elif key in ['aspect_ratio', 'format', 'name']:
+            rendition[key] = value
+        else:
+            raise ValueError(f"不明なレンディションの項目です: {key}")
+    return rendition
+
+def _rendition_size(rendition, crop_size, ratio):
+    """レンディションの出力サイズを求める（幅・高さの片方だけの場合は比率から計算）"""
+    ratio_width, ratio_height = ratio
+    width = rendition.get('width')
+    height = rendition.get('height')
+    if width and height:
+        return width, height
+    if width:
+        return width, max(1, int(width * ratio_height / ratio_width))
+    if height:
+        return max(1, int(height * ratio_width / ratio_height)), height
+    return crop_size
+
+def render_renditions(image, crop_coordinates, renditions, aspect_ratio=(16, 9), force_ratio=True, base_crop=None):
+    """1回のデコードから、複数のサイズ・比率の画像（レンディション）を作成する（保存は行わない）
+
+    各レンディションは width / height / aspect_ratio / format / quality / name を持つ辞書。
+    比率ごとにクロップは1回だけ行い、大きいサイズから順に作成する。小さいサイズは元画像からではなく、
+    作成済みの一回り大きい中間画像から縮小する。
+    作成した順に (レンディションの辞書, PIL画像) を返すジェネレーター。
+    """
+    job = load_image_job(image)
+    img_width, img_height = job.size
+    base_ratio = parse_aspect_ratio(aspect_ratio)
+
+    # 比率ごとにまとめる（幅と高さの両方が指定された場合はその比率）
+    groups = {}
+    for rendition in renditions:
+        if rendition.get('aspect_ratio'):
+            ratio = parse_aspect_ratio(rendition['aspect_ratio'])
+        elif rendition.get('width') and rendition.get('height'):
+            ratio = parse_aspect_ratio((rendition['width'], rendition['height']))
+        else:
+            ratio = base_ratio
+        groups.setdefault(ratio, []).append(rendition)
+
+    for ratio, group in groups.items():
+        if base_crop is not None and (ratio == base_ratio or not force_ratio):
+            crop = base_crop
         else:
-            # 高さを1ピクセルずつ増やす
-            while (new_x_max - new_x_min) / (new_y_max - new_y_min) > target_ratio and new_y_max < img_height:
-                new_y_max += 1
-            # それでも足りない場合は幅を減らす
-            while (new_x_max - new_x_min) / (new_y_max - new_y_min) > target_ratio and new_x_max > new_x_min + 1:
-                new_x_max -= 1
-    
-    # 最終的な比率を計算
-    final_width = new_x_max - new_x_min
-    final_height = new_y_max - new_y_min
-    final_ratio = final_width / final_height if final_height != 0 else 0
-    
-    # 浮動小数点の計算誤差を考慮して、目標比率との絶対誤差を計算
-    ratio_error = abs(final_ratio - target_ratio)
-    
-    print(f"最終調整後: 幅={final_width}, 高さ={final_height}")
-    print(f"最終比率: {final_ratio:.6f} (目標: {target_ratio:.6f}, 誤差: {ratio_error:.6f})")
-    
-    # 元のクロップ領域との比較
-    original_width = x_max - x_min
-    original_height = y_max - y_min
-    width_change = final_width - original_width
-    height_change = final_height - original_height
-    print(f"元領域からの変化: 幅 {width_change:+d}px ({(width_change/original_width*100):+.1f}%), 高さ {height_change:+d}px ({(height_change/original_height*100):+.1f}%)")
+            box = crop_coordinates
+            if force_ratio:
+                box = fit_aspect_ratio(crop_coordinates, img_width, img_height, ratio=ratio)
+            crop = decode_region(job, (box["x_min"], box["y_min"], box["x_max"], box["y_max"]))
+
+        # 大きいものから順に作成し、小さいものは直前の中間画像から縮小する
+        sized = sorted(
+            ((_rendition_size(rendition, crop.size, ratio), rendition) for rendition in group),
+            key=lambda item: item[0][0] * item[0][1], reverse=True
+        )
+        previous = crop
+        for (width, height), rendition in sized:
+            source = previous if previous.width >= width and previous.height >= height else crop
+            if source.size == (width, height):
+                rendered = source
+            elif source is crop:
+                # フルサイズのクロップからの縮小は reduce を併用して高速化
+                rendered = source.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            else:
+                rendered = source.resize((width, height), Image.Resampling.LANCZOS)
+            previous = rendered
+            yield rendition, rendered
+
+def save_renditions(image, crop_coordinates, output_path, renditions, aspect_ratio=(16, 9), force_ratio=True,
+                    base_crop=None, encode_pool=None):
+    """レンディションを作成して保存（render_renditions を参照）
+
+    保存先は output_path の拡張子の前に "_名前"（省略時は "_幅x高さ"）を付けたパス。
+    encode_pool（ProcessPoolExecutor）を指定すると、各レンディションのエンコードと書き込みを並列に行う。
+    戻り値は保存した各画像の情報（name, path, width, height, format, bytes）のリスト。
+    """
+    root, ext = os.path.splitext(output_path)
+    outputs = []
+    pending = []
+    for rendition, rendered in render_renditions(image, crop_coordinates, renditions, aspect_ratio=aspect_ratio,
+                                                 force_ratio=force_ratio, base_crop=base_crop):
+        width, height = rendered.size
+        image_format = (rendition.get('format') or ext.lstrip('.') or 'jpg').lower()
+        name = rendition.get('name') or f"{width}x{height}"
+        path = f"{root}_{name}.{'jpg' if image_format == 'jpeg' else image_format}"
+        output = {"name": name, "path": path, "width": width, "height": height, "format": image_format, "bytes": 0}
+        outputs.append(output)
+        quality = rendition.get('quality', 95)
+        if encode_pool is None:
+            output["bytes"] = encode_and_write(rendered, path, image_format, quality=quality)[0]
+            log(f"レンディションを保存しました: {path} ({width}x{height})")
+        else:
+            pending.append((output, encode_pool.submit(encode_and_write, rendered, path, image_format, quality)))
+    # プロセスプールに渡したレンディションは、全ての書き込みが終わるのを待つ
+    for output, future in pending:
+        output["bytes"] = future.result()[0]
+        log(f"レンディションを保存しました: {output['path']} ({output['width']}x{output['height']})")
+    return outputs
+
+def resize_image_to_fixed_height(image, output_path, target_height=120):
+    """16:9の比率を維持したまま画像を指定の高さにリサイズ（画像パスまたはImageJobを受け付ける）"""
+    job = load_image_job(image)
+    img = job.image
+    # 元の画像形式を保存
+    original_format = job.format
     
+    # 現在のサイズを取得
+    current_width, current_height = img.size
+    log(f"リサイズ前のサイズ: {current_width}x{current_height}")
+    
+    # 16:9の比率を維持したまま、目標の高さに合わせた幅を計算
+    target_width = int(target_height * 16 / 9)
+    
+    # リサイズ (高品質なLANCZOS補間を使用)
+    resized_img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+    log(f"リサイズ後のサイズ: {target_width}x{target_height}")
+    log(f"比率: {target_width/target_height:.6f} (目標: 1.777778)")
+    
+    # 出力ファイルの拡張子を確認
+    output_ext = os.path.splitext(output_path)[1].lower()
+    
+    # JPEGで保存する場合、RGBモードに変換
+    if output_ext in ['.jpg', '.jpeg']:
+        if resized_img.mode in ['P', 'RGBA', 'LA']:
+            log(f"画像モードを {resized_img.mode} から RGB に変換します")
+            if resized_img.mode == 'P':
+                resized_img = resized_img.convert('RGB')
+            elif resized_img.mode in ['RGBA', 'LA']:
+                background = Image.new('RGB', resized_img.size, (255, 255, 255))
+                if resized_img.mode == 'LA':
+                    resized_img = resized_img.convert('RGBA')
+                background.paste(resized_img, mask=resized_img.split()[-1])
+                resized_img = background
+        resized_img.save(output_path, 'JPEG', quality=95)
+    elif output_ext == '.png':
+        resized_img.save(output_path, 'PNG')
+    else:
+        resized_img.save(output_path)
+    
+    log(f"リサイズした画像を保存しました: {output_path}")
+    return resized_img
+    
+
+def parse_aspect_ratio(ratio):
+    """"16:9" のような文字列・(16, 9) のようなタプル・1.5 のような数値を既約な整数比 (p, q) に変換"""
+    if isinstance(ratio, str):
+        if ':' in ratio:
+            width, height = ratio.split(':', 1)
+            ratio = Fraction(int(width), int(height))
+        else:
+            ratio = Fraction(ratio).limit_denominator(1000)
+    elif isinstance(ratio, (tuple, list)):
+        ratio = Fraction(int(ratio[0]), int(ratio[1]))
+    else:
+        ratio = Fraction(ratio).limit_denominator(1000)
+    if ratio <= 0:
+        raise ValueError(f"無効なアスペクト比です: {ratio}")
+    return ratio.numerator, ratio.denominator
+
+def fit_aspect_ratio(crop_coordinates, img_width, img_height, ratio=(16, 9), mode="expand"):
+    """クロップ座標を正確な整数比 p:q に1回の計算で合わせる
+
+    幅と高さを p*k, q*k（kは整数）とすることで比率の誤差を0にする。
+    mode="expand" の場合は元の領域を含む最小の矩形（画像に収まらない場合は画像に収まる最大の矩形）、
+    mode="shrink" の場合は元の領域に含まれる最大の矩形を返す。
+    いずれも元の領域の中心に合わせて配置し、画像の範囲内に収める。
+    """
+    p, q = parse_aspect_ratio(ratio)
+    x_min = int(crop_coordinates["x_min"])
+    y_min = int(crop_coordinates["y_min"])
+    width = max(1, int(crop_coordinates["x_max"]) - x_min)
+    height = max(1, int(crop_coordinates["y_max"]) - y_min)
+
+    # 画像に収まる最大の倍率
+    k_limit = min(img_width // p, img_height // q)
+    if k_limit < 1:
+        # 画像が p×q より小さい場合は正確な比率にできないため画像全体を返す
+        return {"x_min": 0, "y_min": 0, "x_max": img_width, "y_max": img_height}
+
+    if mode == "expand":
+        k = max(-(-width // p), -(-height // q))
+    elif mode == "shrink":
+        k = max(1, min(width // p, height // q))
+    else:
+        raise ValueError(f"mode は 'expand' または 'shrink' を指定してください: {mode}")
+    k = min(k, k_limit)
+    new_width = p * k
+    new_height = q * k
+
+    # 中心を合わせ、画像の端からはみ出す場合は内側にずらす
+    new_x_min = min(max(x_min - (new_width - width) // 2, 0), img_width - new_width)
+    new_y_min = min(max(y_min - (new_height - height) // 2, 0), img_height - new_height)
     return {
         "x_min": new_x_min,
         "y_min": new_y_min,
-        "x_max": new_x_max,
-        "y_max": new_y_max
+        "x_max": new_x_min + new_width,
+        "y_max": new_y_min + new_height
     }
 
-def display_results(original_image_path, cropped_image_path, crop_coordinates, description):
-    """元画像とクロップした画像を表示し、座標情報を描画"""
+def fit_aspect_ratio_batch(boxes, img_width, img_height, ratio=(16, 9), mode="expand"):
+    """fit_aspect_ratio のNumPyベクトル化版。大量のクロップ座標を1回の呼び出しで調整する
+
+    boxes は (N, 4) の配列（x_min, y_min, x_max, y_max）。img_width, img_height はスカラーまたは長さNの配列。
+    戻り値は (N, 4) の int64 配列で、各行は fit_aspect_ratio の結果と一致する。
+    """
+    import numpy as np
+
+    p, q = parse_aspect_ratio(ratio)
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    img_width = np.broadcast_to(np.asarray(img_width, dtype=np.int64), (len(boxes),))
+    img_height = np.broadcast_to(np.asarray(img_height, dtype=np.int64), (len(boxes),))
+
+    x_min = boxes[:, 0]
+    y_min = boxes[:, 1]
+    width = np.maximum(1, boxes[:, 2] - x_min)
+    height = np.maximum(1, boxes[:, 3] - y_min)
+
+    k_limit = np.minimum(img_width // p, img_height // q)
+    if mode == "expand":
+        k = np.maximum(-(-width // p), -(-height // q))
+    elif mode == "shrink":
+        k = np.maximum(1, np.minimum(width // p, height // q))
+    else:
+        raise ValueError(f"mode は 'expand' または 'shrink' を指定してください: {mode}")
+    k = np.minimum(k, k_limit)
+    new_width = p * k
+    new_height = q * k
+
+    new_x_min = np.minimum(np.maximum(x_min - (new_width - width) // 2, 0), img_width - new_width)
+    new_y_min = np.minimum(np.maximum(y_min - (new_height - height) // 2, 0), img_height - new_height)
+    result = np.stack([new_x_min, new_y_min, new_x_min + new_width, new_y_min + new_height], axis=1)
+
+    # 画像が p×q より小さい場合は画像全体
+    too_small = k_limit < 1
+    if too_small.any():
+        result[too_small] = np.stack(
+            [np.zeros_like(img_width), np.zeros_like(img_height), img_width, img_height], axis=1
+        )[too_small]
+    return result
+
+def adjust_crop_to_exact_16_9_ratio(crop_coordinates, img_width, img_height):
+    """クロップ座標を正確に16:9の比率に調整する関数（拡大優先・整数で厳密に計算）"""
+    adjusted = fit_aspect_ratio(crop_coordinates, img_width, img_height, ratio=(16, 9), mode="expand")
+    log(f"16:9に調整: 幅={adjusted['x_max'] - adjusted['x_min']}, 高さ={adjusted['y_max'] - adjusted['y_min']}")
+    return adjusted
+
+# 大きい画像モードで元画像を表示するときの長辺(px)
+DISPLAY_MAX_EDGE = 2048
+
+def display_results(original_image, cropped_image_path, crop_coordinates, description, cropped_img=None):
+    """元画像とクロップした画像を表示し、座標情報を描画
+
+    original_image には画像パスまたはImageJobを渡せる。cropped_img が渡された場合は
+    保存済みファイルを読み直さずにその画像を表示する。
+    大きい画像モードのジョブは、元画像を長辺 DISPLAY_MAX_EDGE ピクセルに縮小デコードして表示する。
+    """
     try:
-        # 元画像を読み込み
-        original_img = Image.open(original_image_path)
+        import matplotlib.pyplot as plt
+
+        # 元画像を取得（デコード済みの画像を使い回す）
+        job = load_image_job(original_image)
+        box = crop_coordinates
+        if job.large:
+            original_img = load_thumbnail(job, DISPLAY_MAX_EDGE)
+            box = scale_crop_coordinates(crop_coordinates, job.size, original_img.size)
+        else:
+            original_img = job.image
         
         # パレットモードの場合はRGBに変換してから描画
         if original_img.mode in ['P', 'L']:
@@ -495,6 +1808,9 @@ def display_results(original_image_path, cropped_image_path, crop_coordinates, d
                 original_img = original_img.convert('RGBA')
             background.paste(original_img, mask=original_img.split()[-1])
             original_img = background
+        else:
+            # 共有しているデコード済み画像に矩形を描き込まないようにコピーする
+            original_img = original_img.copy()
         
         # RGB変換後に描画オブジェクトを作成
         original_draw = ImageDraw.Draw(original_img)
@@ -505,16 +1821,17 @@ def display_results(original_image_path, cropped_image_path, crop_coordinates, d
         x_max = int(crop_coordinates["x_max"])
         y_max = int(crop_coordinates["y_max"])
         
-        # 赤い矩形を描画
-        original_draw.rectangle([(x_min, y_min), (x_max, y_max)], outline="red", width=3)
+        # 赤い矩形を描画（縮小した元画像の場合は縮小後の座標）
+        original_draw.rectangle([(box["x_min"], box["y_min"]), (box["x_max"], box["y_max"])], outline="red", width=3)
         
-        # クロップした画像ファイルがあるか確認
-        if not os.path.exists(cropped_image_path):
-            print(f"警告: クロップ画像ファイル {cropped_image_path} が見つかりません")
-            return
-            
-        # クロップした画像を読み込み
-        cropped_img = Image.open(cropped_image_path)
+        if cropped_img is None:
+            # クロップした画像ファイルがあるか確認
+            if not os.path.exists(cropped_image_path):
+                print(f"警告: クロップ画像ファイル {cropped_image_path} が見つかりません")
+                return
+                
+            # クロップした画像を読み込み
+            cropped_img = Image.open(cropped_image_path)
         if cropped_img.size == (0, 0):
             print("警告: クロップされた画像のサイズが0です")
             return
@@ -560,101 +1877,1002 @@ def display_results(original_image_path, cropped_image_path, crop_coordinates, d
         print(f"結果表示中にエラーが発生しました: {e}")
         print("クロップ座標:", crop_coordinates)
 
+def validate_crop_result(result):
+    """APIの結果が期待通りのフォーマットか確認し、問題があればエラーメッセージを返す"""
+    if not result:
+        return "クロップ座標の取得に失敗しました。"
+    if 'crop_coordinates' not in result:
+        return "APIレスポンスに 'crop_coordinates' が含まれていません。"
+    coords = result['crop_coordinates']
+    required_keys = ['x_min', 'y_min', 'x_max', 'y_max']
+    if not isinstance(coords, dict) or not all(key in coords for key in required_keys):
+        return "クロップ座標データが不完全です。"
+    if not all(_is_number(coords[key]) for key in required_keys):
+        return f"クロップ座標が数値ではありません: {coords}"
+    if coords['x_max'] <= coords['x_min'] or coords['y_max'] <= coords['y_min']:
+        return f"クロップ座標の範囲が不正です（x_max・y_max が x_min・y_min 以下）: {coords}"
+    return None
+
+def _is_number(value):
+    """有限の数値か（bool は除く）"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def load_manifest(manifest_path):
+    """CSVまたはJSONLのマニフェストを読み込み、(image, instruction, output) の行リストを返す"""
+    rows = []
+    ext = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, encoding='utf-8', newline='') as f:
+        if ext in ['.jsonl', '.ndjson']:
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            # CSVはヘッダー行 (image,instruction,output) を前提とする
+            records = csv.DictReader(f)
+        for index, record in enumerate(records):
+            image = (record.get('image') or '').strip()
+            instruction = (record.get('instruction') or '').strip()
+            if not image or not instruction:
+                raise ValueError(f"マニフェストの{index + 1}行目に image または instruction がありません。")
+            rows.append({
+                "index": index,
+                "image": image,
+                "instruction": instruction,
+                "output": (record.get('output') or '').strip() or None,
+            })
+    return rows
+
+def group_manifest_rows(rows):
+    """同じ画像を使う行をまとめる（最初に現れた順序を保つ）"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['image'], []).append(row)
+    return list(groups.values())
+
+class _ImageHold:
+    """1枚の画像のメモリ予算の予約と、その画像を使う残りの行数
+
+    全ての行の処理が終わった時点で予約を解放し、デコード済みの画像を破棄する
+    （結果の集計まで画像を保持し続けないようにする）。
+    """
+
+    def __init__(self, job, count, memory_budget=None, nbytes=0):
+        self.job = job
+        self.remaining = count
+        self.memory_budget = memory_budget
+        self.nbytes = nbytes
+        self._lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, job, count, memory_budget=None, proxy_max_edge=None, request=True):
+        """メモリ予算に空きができるまで待ってから予約する"""
+        nbytes = memory_budget.acquire(estimate_job_memory(job, proxy_max_edge, request)) if memory_budget else 0
+        return cls(job, count, memory_budget, nbytes)
+
+    def done(self, count=1):
+        with self._lock:
+            self.remaining -= count
+            finished = self.remaining <= 0 and self.nbytes is not None
+            if finished:
+                nbytes, self.nbytes = self.nbytes, None
+        if finished:
+            self.job.release()
+            if self.memory_budget is not None:
+                self.memory_budget.release(nbytes)
+
+    def close(self):
+        """残りの行に関係なく解放する"""
+        self.done(self.remaining)
+
+def _analyze_manifest_rows(rows, analyze_options, journal=None, large_image_bytes=0, memory_budget=None):
+    """同じ画像を使うバッチの行を読み込み、クロップ座標を取得する（複数行の場合は1回のリクエストにまとめる）
+
+    journal（JobJournal）を指定すると、完了済みの行と他のワーカーが処理中の行は問い合わせず、
+    戻り値の entries にそのジャーナルの状態を入れる（問い合わせた行は None）。
+    memory_budget（MemoryBudget）を指定すると、画像の処理に必要なメモリを予約できるまで待ってから処理する。
+    戻り値の hold（_ImageHold）は、各行の処理が終わるたびに done を呼んで予約を解放する。
+    """
+    job = ImageJob.from_path(rows[0]['image'], large_image_bytes=large_image_bytes)
+    # base64のデータはAPIに送信する場合だけ見積もりに含める
+    request = "gpt" in (analyze_options.get('backend', "gpt"), analyze_options.get('fallback'))
+    hold = _ImageHold.acquire(job, len(rows), memory_budget, analyze_options.get('proxy_max_edge'), request)
+    try:
+        if journal is None:
+            results = analyze_image(job, [row['instruction'] for row in rows], **analyze_options)
+            return job, results, [None] * len(rows), hold
+
+        entries = []
+        for row in rows:
+            row['journal_key'] = make_job_key(job.sha256, row['instruction'])
+            entries.append(journal.claim(row['journal_key'], image=row['image'], instruction=row['instruction']))
+        pending = [position for position, entry in enumerate(entries) if entry is None]
+        results = [None] * len(rows)
+        if pending:
+            analyzed = analyze_image(job, [rows[position]['instruction'] for position in pending], **analyze_options)
+            for position, result in zip(pending, analyzed):
+                results[position] = result
+        return job, results, entries, hold
+    except BaseException:
+        hold.close()
+        raise
+
+def output_variant(resize_width=0, resize_height=0, aspect_ratio=(16, 9)):
+    """出力ファイル名（content_output_filename）に含める出力設定の文字列"""
+    ratio_width, ratio_height = parse_aspect_ratio(aspect_ratio)
+    return f"{resize_width or 0}x{resize_height or 0}@{ratio_width}:{ratio_height}"
+
+def _crop_manifest_row(row, job, result, output_dir, resize_width, resize_height, aspect_ratio=(16, 9), renditions=None,
+                       metrics=None, naming="timestamp", encode_pool=None):
+    """バッチの1行分のクロップ・リサイズ・保存を行う（ローカル処理）
+
+    出力先が指定されていない行のファイル名は、naming が "content" の場合は入力画像のハッシュ・指示文・出力設定から、
+    "timestamp" の場合は行番号とタイムスタンプから決める。
+    """
+    if row['output']:
+        output_filename = row['output']
+    elif naming == "content":
+        output_filename = content_output_filename(
+            output_dir, job.sha256, row['instruction'], output_variant(resize_width, resize_height, aspect_ratio),
+            input_image_path=row['image']
+        )
+    else:
+        output_filename = generate_output_filename(
+            output_dir=output_dir,
+            base_name=f"cropped_{row['index']:05d}",
+            input_image_path=row['image']
+        )
+    cropped_img, final_coords, outputs = crop_and_save_image(
+        job,
+        result['crop_coordinates'],
+        output_filename,
+        resize_width=resize_width,
+        resize_height=resize_height,
+        aspect_ratio=aspect_ratio,
+        renditions=renditions or [],
+        metrics=metrics,
+        encode_pool=encode_pool
+    )
+    if not cropped_img:
+        raise RuntimeError("クロッピング処理に失敗しました。")
+    return output_filename, final_coords, outputs
+
+def metrics_record(index, image, instruction, status, job=None, result=None, crop_metrics=None):
+    """1件分の結果から、MetricsWriter に渡す計測結果の辞書を作成"""
+    metrics = RequestMetrics()
+    if isinstance(result, dict):
+        metrics.merge(result.get('metrics'))
+    if crop_metrics is not None:
+        metrics.merge(crop_metrics)
+    return {
+        "index": index,
+        "image": image,
+        "instruction": instruction,
+        "status": status,
+        "prompt_version": PROMPT_VERSION,
+        "cached": bool(result.get('cached')) if isinstance(result, dict) else False,
+        "near_duplicate": bool(result.get('near_duplicate')) if isinstance(result, dict) else False,
+        "tier": result.get('tier') if isinstance(result, dict) else None,
+        "image_width": job.width if job else None,
+        "image_height": job.height if job else None,
+        **metrics.as_dict(),
+    }
+
+def batch_record(row, status, result=None, output=None, final_coords=None, error=None, renditions_saved=None,
+                 resumed=False):
+    """バッチ処理の結果JSONLに書き出す1行分の結果（resumed はジャーナルの完了済みの結果を使った行）"""
+    return {
+        "index": row['index'],
+        "image": row['image'],
+        "instruction": row['instruction'],
+        "status": status,
+        "output": output,
+        "crop_coordinates": result.get('crop_coordinates') if result else None,
+        "final_coordinates": final_coords,
+        "renditions": [output["path"] for output in renditions_saved or []],
+        "description": result.get('description') if result else None,
+        "upload_bytes": result.get('upload', {}).get('bytes') if result else None,
+        "prompt_tokens": result.get('metrics', {}).get('prompt_tokens') if result else None,
+        "cached_tokens": result.get('metrics', {}).get('cached_tokens') if result else None,
+        "cached": bool(result.get('cached')) if result else False,
+        "near_duplicate": bool(result.get('near_duplicate')) if result else False,
+        "frame": result.get('frame') if result else None,
+        "tier": result.get('tier') if result else None,
+        "escalation": result.get('escalation') if result else None,
+        "resumed": resumed,
+        "error": error,
+    }
+
+class BatchResultWriter:
+    """バッチ処理の行ごとの結果を、結果JSONL・計測結果（MetricsWriter）・ジャーナル（JobJournal）に記録する
+
+    run_batch と apply_batch_results で共有する。記録は呼び出し側の1つのスレッドから行う。
+    """
+
+    def __init__(self, results_file, metrics_writer=None, journal=None):
+        self.results_file = results_file
+        self.metrics_writer = metrics_writer
+        self.journal = journal
+        self.records = {}
+
+    def _write(self, row, record):
+        self.records[row['index']] = record
+        self.results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.results_file.flush()
+
+    def finish(self, row, status, result=None, output=None, final_coords=None, error=None, renditions_saved=None,
+               job=None, crop_metrics=None):
+        """1行分の結果を記録する（ジャーナルを使う場合は、その行を完了・失敗にする）"""
+        record = batch_record(row, status, result, output, final_coords, error, renditions_saved)
+        self._write(row, record)
+        if self.journal is not None and row.get('journal_key'):
+            self.journal.finish(row['journal_key'], status, record, image=row['image'], instruction=row['instruction'])
+        if self.metrics_writer is not None:
+            self.metrics_writer.record(metrics_record(
+                row['index'], row['image'], row['instruction'], status, job=job, result=result, crop_metrics=crop_metrics
+            ))
+
+    def finish_from_journal(self, row, entry):
+        """ジャーナルで完了済み、または他のワーカーが処理中の行を記録する"""
+        if entry['status'] == "ok":
+            # 前回の結果をそのまま使う（行番号・出力先はマニフェストの現在の内容に合わせる）
+            record = dict(entry['record'] or {}, index=row['index'], image=row['image'],
+                          instruction=row['instruction'], status="ok", resumed=True)
+        else:
+            record = batch_record(row, "skipped", error=f"他のワーカー（{entry['worker']}）が処理中です")
+        self._write(row, record)
+
+    def finish_crop(self, future, row, job, result, crop_metrics):
+        """_crop_manifest_row の future の結果を記録する"""
+        try:
+            output_filename, final_coords, outputs = future.result()
+            self.finish(row, "ok", result=result, output=output_filename, final_coords=final_coords,
+                        renditions_saved=outputs, job=job, crop_metrics=crop_metrics)
+        except Exception as e:
+            self.finish(row, "error", result=result, error=str(e), job=job, crop_metrics=crop_metrics)
+
+def _submit_manifest_crops(writer, api_future, group, crop_pool, crop_futures, output_dir, resize_width, resize_height,
+                           aspect_ratio, renditions, naming, encode_pool):
+    """_analyze_manifest_rows の future の結果から、クロップ・保存の future を作成して返す
+
+    問い合わせに失敗した行・ジャーナルで完了済みの行・無効な結果の行はその場で writer に記録する。
+    作成した future は crop_futures に (行, ImageJob, 結果, 計測結果) と対応付ける。
+    """
+    try:
+        job, results, entries, hold = api_future.result()
+    except Exception as e:
+        for row in group:
+            writer.finish(row, "error", error=f"GPT-4 Vision API呼び出し中にエラーが発生しました: {e}")
+        return []
+    submitted = []
+    for row, result, entry in zip(group, results, entries):
+        if entry is not None:
+            writer.finish_from_journal(row, entry)
+            hold.done()
+            continue
+        error = validate_crop_result(result)
+        if error:
+            writer.finish(row, "error", result=result if isinstance(result, dict) else None, error=error, job=job)
+            hold.done()
+            continue
+        crop_metrics = RequestMetrics()
+        crop_future = crop_pool.submit(
+            _crop_manifest_row, row, job, result, output_dir, resize_width, resize_height, aspect_ratio,
+            renditions, crop_metrics, naming, encode_pool
+        )
+        # 保存が終わった時点で（結果の集計を待たずに）メモリ予算の予約を解放する
+        crop_future.add_done_callback(lambda _, hold=hold: hold.done())
+        crop_futures[crop_future] = (row, job, result, crop_metrics)
+        submitted.append(crop_future)
+    return submitted
+
+def run_batch(manifest_path, output_dir='output', results_path=None, concurrency=4, crop_workers=None,
+              resize_width=0, resize_height=0, proxy_max_edge=None, proxy_quality=85, cache=None,
+              aspect_ratio=(16, 9), group_steps=False, backend="gpt", fallback=None, timeout=None, renditions=None,
+              metrics_writer=None, structured=False, limiter=None, journal=None, naming="timestamp", encode_workers=0,
+              large_image_bytes=0, memory_budget=None, near_duplicates=None, escalation=None):
+    """マニフェストの各行を並列に処理し、行ごとの結果をJSONLで書き出す
+
+    API呼び出しは concurrency 個まで同時に実行し、応答が届いた行から順に
+    クロップ・リサイズ・保存を別スレッドプールで行うことで、ネットワーク待ちとローカル処理を重ねる。
+    group_steps を指定すると、同じ画像を使う行を1回のリクエストにまとめる。
+    backend / fallback でクロップ座標を求める方法を選べる（analyze_image を参照）。
+    metrics_writer（MetricsWriter）を指定すると、行ごとの処理段の時間・送信量・トークン数を書き出す。
+    limiter（RateLimiter）を指定すると、API呼び出しをレート制限の範囲内に抑え、429 や一時的なエラーはリトライする。
+    journal（JobJournal）を指定すると、行ごとの結果をジャーナルに記録し、完了済みの行は省略して前回の結果を使う
+    （失敗した行だけをやり直す。複数のワーカーで同じジャーナルを使うと、他のワーカーが処理中の行は skipped になる）。
+    naming で出力ファイル名の決め方を選べる（_crop_manifest_row を参照）。
+    encode_workers を指定すると、出力画像のエンコードと書き込みをその数のプロセスで行う。
+    large_image_bytes を指定すると、デコード後のサイズがそれを超える画像を大きい画像モードで扱う（ImageJob を参照）。
+    memory_budget（MemoryBudget）を指定すると、同時に処理する画像のメモリ量をその上限以内に抑える
+    （画像ごとに読み込みから全ての行の保存までの間、estimate_job_memory の見積もりを予約する）。
+    near_duplicates（NearDuplicateIndex）を指定すると、似た画像の同じ指示文の結果を再利用する（crop_image_with_gpt を参照）。
+    escalation（EscalationPolicy）を指定すると、まず軽量なモデルで求め、必要な行だけ大きいモデルで取り直す（analyze_tiered を参照）。
+    """
+    rows = load_manifest(manifest_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if not results_path:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        results_path = os.path.join(output_dir, f"batch_results_{timestamp}.jsonl")
+    crop_workers = crop_workers or os.cpu_count() or 1
+
+    print(f"バッチ処理を開始します: {len(rows)}件 (同時リクエスト数: {concurrency}, クロップワーカー数: {crop_workers})")
+    if group_steps:
+        print(f"同じ画像の工程をまとめます: {len(group_manifest_rows(rows))}リクエスト")
+    started = time.perf_counter()
+
+    with open(results_path, 'w', encoding='utf-8') as results_file, \
+            ThreadPoolExecutor(max_workers=concurrency) as api_pool, \
+            ThreadPoolExecutor(max_workers=crop_workers) as crop_pool, \
+            (ProcessPoolExecutor(max_workers=encode_workers) if encode_workers else nullcontext()) as encode_pool:
+        writer = BatchResultWriter(results_file, metrics_writer, journal)
+        groups = group_manifest_rows(rows) if group_steps else [[row] for row in rows]
+        analyze_options = {"backend": backend, "fallback": fallback, "aspect_ratio": aspect_ratio}
+        if backend == "gpt" or fallback == "gpt":
+            analyze_options.update(proxy_max_edge=proxy_max_edge, proxy_quality=proxy_quality, cache=cache, timeout=timeout,
+                                   structured=structured, limiter=limiter, near_duplicates=near_duplicates,
+                                   escalation=escalation)
+            # 全ての行で1つのクライアント（接続プール）を共有する（リトライは limiter に任せる）
+            try:
+                analyze_options["client"] = _create_client(timeout, max_retries=0 if limiter else None)
+            except ValueError as e:
+                print(f"警告: {e}")
+        api_futures = {
+            api_pool.submit(_analyze_manifest_rows, group, analyze_options, journal, large_image_bytes,
+                            memory_budget): group
+            for group in groups
+        }
+        crop_futures = {}
+        # API呼び出しとクロップの future を1つのループで待ち、保存が終わった行はすぐに記録する
+        # （API呼び出しの途中で中断しても、保存済みの行はジャーナルで完了になり、再開時に問い合わせ直さない）
+        pending = set(api_futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in crop_futures:
+                    writer.finish_crop(future, *crop_futures.pop(future))
+                    continue
+                pending.update(_submit_manifest_crops(
+                    writer, future, api_futures[future], crop_pool, crop_futures, output_dir, resize_width,
+                    resize_height, aspect_ratio, renditions, naming, encode_pool
+                ))
+
+    records = writer.records
+    elapsed = time.perf_counter() - started
+    succeeded = sum(1 for record in records.values() if record['status'] == "ok")
+    skipped = sum(1 for record in records.values() if record['status'] == "skipped")
+    # ジャーナルの前回の結果を使った行は、今回の送信量・トークン数に含めない
+    sent = [record for record in records.values() if not record.get('resumed')]
+    upload_bytes = sum(record['upload_bytes'] or 0 for record in sent)
+    print(f"バッチ処理が完了しました: 成功 {succeeded}件 / 失敗 {len(rows) - succeeded - skipped}件"
+          f"{f' / 処理中のため省略 {skipped}件' if skipped else ''} ({elapsed:.1f}秒)")
+    if journal is not None:
+        stats = journal.stats()
+        print(f"ジャーナル: 完了済みのため省略 {stats['skipped']}件 / 今回の処理 {stats['claimed']}件 "
+              f"(成功 {stats['completed']}件, 失敗 {stats['failed']}件), 全体の状態: {journal.summary()}")
+    print(f"送信した画像データ: 合計 {upload_bytes}バイト")
+    prompt_tokens = sum(record['prompt_tokens'] or 0 for record in sent)
+    if prompt_tokens:
+        cached_tokens = sum(record['cached_tokens'] or 0 for record in sent)
+        print(f"入力トークン数: 合計 {prompt_tokens} (うちプロンプトキャッシュ {cached_tokens}, "
+              f"{cached_tokens / prompt_tokens:.1%}, プロンプトのバージョン {PROMPT_VERSION})")
+    if cache is not None:
+        stats = cache.stats()
+        print(f"キャッシュ: ヒット {stats['hits']}件 / ミス {stats['misses']}件 (ヒット率 {stats['hit_rate']:.1%})")
+    if near_duplicates is not None:
+        print_near_duplicate_stats(near_duplicates)
+    if escalation is not None:
+        print_escalation_stats(escalation)
+    if limiter is not None:
+        stats = limiter.stats()
+        print(f"API呼び出し: {stats['calls']}回 (リトライ {stats['retries']}回, うち429 {stats['rate_limited']}回, "
+              f"失敗 {stats['failures']}回, 最終的な同時実行数 {stats['concurrency']}/{stats['max_concurrency']})")
+    if memory_budget is not None:
+        print_memory_budget_stats(memory_budget)
+    if metrics_writer is not None:
+        stage_seconds = metrics_writer.summary()["stage_seconds"]
+        breakdown = ", ".join(f"{name} {seconds:.2f}秒" for name, seconds in
+                              sorted(stage_seconds.items(), key=lambda item: -item[1]))
+        print(f"処理段ごとの合計時間: {breakdown}")
+        print(f"計測結果: {metrics_writer.path}")
+    print(f"結果ファイル: {results_path}")
+    return [records[row['index']] for row in rows]
+
+def print_near_duplicate_stats(near_duplicates):
+    """似た画像の座標の再利用状況を表示"""
+    stats = near_duplicates.stats()
+    print(f"似た画像の座標の再利用: {stats['reused']}件 / 検索 {stats['lookups']}件 (再利用率 {stats['reuse_rate']:.1%}, "
+          f"追加 {stats['stores']}件, 最大ハミング距離 {near_duplicates.max_distance})")
+
+def print_escalation_stats(escalation):
+    """段階的なモデルの切り替えの、エスカレーションの割合と段ごとの時間を表示"""
+    stats = escalation.stats()
+    reasons = ", ".join(f"{reason} {count}件" for reason, count in sorted(stats['reasons'].items()))
+    print(f"大きいモデルへの切り替え: {stats['escalated']}件 / {stats['results']}件 "
+          f"(割合 {stats['escalation_rate']:.1%}{', ' + reasons if reasons else ''})")
+    for tier, name in (("fast", stats['fast_model']), ("full", "大きいモデル")):
+        if tier in stats['tiers']:
+            tier_stats = stats['tiers'][tier]
+            print(f"  {tier} ({name}): {tier_stats['calls']}回, 平均 {tier_stats['mean_ms']:.0f}ms "
+                  f"(p50 {tier_stats['p50_ms']:.0f}ms, p95 {tier_stats['p95_ms']:.0f}ms), "
+                  f"入力トークン {tier_stats['prompt_tokens']} / 出力トークン {tier_stats['completion_tokens']}")
+
+def print_memory_budget_stats(memory_budget):
+    """メモリ予算の使用状況を表示"""
+    stats = memory_budget.stats()
+    print(f"メモリ予算: 上限 {stats['max_bytes'] / 1024 / 1024:.0f}MB / 最大使用量 {stats['peak'] / 1024 / 1024:.0f}MB "
+          f"(空きを待った画像 {stats['waited']}枚, 単独で上限を超えた画像 {stats['oversized']}枚)")
+
+# バッチAPIでリクエストを送るエンドポイント
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+def batch_meta_path(batch_path):
+    """バッチファイルに対応するメタデータファイル（各リクエストの行・画像サイズなど）のパス"""
+    return os.path.splitext(batch_path)[0] + ".meta.json"
+
+def build_batch_file(manifest_path, batch_path, proxy_max_edge=None, proxy_quality=85, group_steps=False,
+                     structured=False, large_image_bytes=0):
+    """マニフェストの全行のリクエスト本文を、バッチAPI用のJSONL（1行1リクエスト）に書き出す（APIは呼び出さない）
+
+    各行は crop_image_with_gpt が送信するものと同じ本文で、画像は1回だけエンコードして同じ画像の行で使い回す。
+    結果の適用（apply_batch_results）に必要な行・画像サイズなどは、別のメタデータファイルに書き出す。
+    large_image_bytes は run_batch と同じ（大きい画像はファイルから分割して読み込みながらエンコードする）。
+    戻り値はメタデータの辞書。
+    """
+    rows = load_manifest(manifest_path)
+    groups = group_manifest_rows(rows) if group_steps else [[row] for row in rows]
+    directory = os.path.dirname(os.path.abspath(batch_path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # 同じ画像を使うリクエストが残っている間だけ、エンコード済みの画像を保持する
+    remaining = {}
+    for group in groups:
+        remaining[group[0]['image']] = remaining.get(group[0]['image'], 0) + 1
+    prepared = {}
+    requests = {}
+    skipped = []
+    upload_bytes = 0
+    with open(batch_path, 'w', encoding='utf-8') as f:
+        for number, group in enumerate(groups):
+            image = group[0]['image']
+            remaining[image] -= 1
+            try:
+                if image not in prepared:
+                    job = ImageJob.from_path(image, large_image_bytes=large_image_bytes)
+                    prepared[image] = (job, *_prepare_request_image(job, proxy_max_edge, proxy_quality))
+                job, request_job, base64_image, mime_type, upload_stats = prepared[image]
+            except Exception as e:
+                print(f"エラー: 画像 '{image}' の読み込みに失敗したため、{len(group)}行をスキップします: {e}")
+                skipped += [{"row": row, "error": str(e)} for row in group]
+                continue
+            finally:
+                if not remaining[image]:
+                    prepared.pop(image, None)
+
+            custom_id = f"crop-{number:06d}"
+            body = build_request_body(
+                request_job, base64_image, mime_type, [row['instruction'] for row in group], structured=structured,
+                multi_step=len(group) > 1
+            )
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                               ensure_ascii=False) + "\n")
+            requests[custom_id] = {
+                "rows": group,
+                "request_size": list(request_job.size),
+                "image_size": list(job.size),
+                "max_tokens": body["max_tokens"],
+                "upload": upload_stats,
+            }
+            upload_bytes += upload_stats["bytes"]
+
+    meta = {
+        "manifest": manifest_path,
+        "model": MODEL_NAME,
+        "prompt_version": PROMPT_VERSION,
+        "structured": structured,
+        "proxy_max_edge": proxy_max_edge,
+        "requests": requests,
+        "skipped": skipped,
+    }
+    with open(batch_meta_path(batch_path), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    print(f"バッチファイルを書き出しました: {batch_path} ({len(requests)}リクエスト / {len(rows)}行, "
+          f"画像データ 合計 {upload_bytes}バイト)")
+    print(f"メタデータ: {batch_meta_path(batch_path)}")
+    return meta
+
+def load_batch_results(results_path):
+    """バッチAPIの結果ファイル（JSONL）を読み込み、custom_id ごとの (応答本文, エラーメッセージ) の辞書を返す"""
+    responses = {}
+    with open(results_path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            error = record.get('error')
+            if error:
+                error = error.get('message', str(error)) if isinstance(error, dict) else str(error)
+            elif response.get('status_code', 200) != 200:
+                body = response.get('body') or {}
+                message = body.get('error', {}).get('message') if isinstance(body.get('error'), dict) else None
+                error = f"APIがステータス {response.get('status_code')} を返しました: {message}"
+            responses[record.get('custom_id')] = (response.get('body'), error)
+    return responses
+
+def apply_batch_results(batch_path, results_path, output_dir='output', record_path=None, crop_workers=None,
+                        resize_width=0, resize_height=0, aspect_ratio=(16, 9), renditions=None, metrics_writer=None,
+                        naming="timestamp", encode_workers=0, large_image_bytes=0, memory_budget=None):
+    """バッチAPIの結果ファイルから各行のクロップ座標を取り出し、クロップ・リサイズ・保存を並列に行う
+
+    応答の解析・座標の調整は通常のAPI呼び出しと同じ処理（parse_crop_response）で行うため、
+    記録した結果ファイルを使えばAPIを呼び出さずに何度でも再実行できる。
+    行ごとの結果は run_batch と同じ形式のJSONLで書き出す。
+    naming / encode_workers / large_image_bytes / memory_budget は run_batch と同じ。
+    """
+    with open(batch_meta_path(batch_path), encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('prompt_version') != PROMPT_VERSION:
+        print(f"警告: バッチファイルのプロンプトのバージョン（{meta.get('prompt_version')}）が現在のバージョン（{PROMPT_VERSION}）と異なります")
+    responses = load_batch_results(results_path)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if not record_path:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        record_path = os.path.join(output_dir, f"batch_results_{timestamp}.jsonl")
+    crop_workers = crop_workers or os.cpu_count() or 1
+    total = sum(len(request['rows']) for request in meta['requests'].values()) + len(meta['skipped'])
+
+    print(f"バッチ結果を適用します: {total}行 (クロップワーカー数: {crop_workers})")
+    started = time.perf_counter()
+
+    with open(record_path, 'w', encoding='utf-8') as results_file, \
+            ThreadPoolExecutor(max_workers=crop_workers) as crop_pool, \
+            (ProcessPoolExecutor(max_workers=encode_workers) if encode_workers else nullcontext()) as encode_pool:
+        writer = BatchResultWriter(results_file, metrics_writer)
+        for skipped in meta['skipped']:
+            writer.finish(skipped['row'], "error", error=skipped['error'])
+
+        crop_futures = {}
+        for custom_id, request in meta['requests'].items():
+            rows = request['rows']
+            body, error = responses.get(custom_id, (None, "結果ファイルに応答がありません"))
+            if error or not body:
+                for row in rows:
+                    writer.finish(row, "error", error=error or "応答の本文がありません")
+                continue
+            metrics = RequestMetrics()
+            try:
+                from openai.types.chat import ChatCompletion
+                response_text = completion_text(ChatCompletion.model_validate(body), request['max_tokens'], metrics)
+                with metrics.stage("parse"):
+                    parsed = parse_crop_response(
+                        response_text, *request['request_size'], structured=meta.get('structured', False),
+                        step_count=len(rows) if len(rows) > 1 else None
+                    )
+            except Exception as e:
+                for row in rows:
+                    writer.finish(row, "error", error=f"応答の解析に失敗しました: {e}")
+                continue
+            results = parsed if len(rows) > 1 else [parsed]
+            if results is None:
+                results = [None] * len(rows)
+            try:
+                job = ImageJob.from_path(rows[0]['image'], large_image_bytes=large_image_bytes)
+            except Exception as e:
+                for row in rows:
+                    writer.finish(row, "error", error=f"画像の読み込みに失敗しました: {e}")
+                continue
+            # メモリ予算に空きができるまで、次の画像の読み込みを待つ
+            hold = _ImageHold.acquire(job, len(rows), memory_budget, request=False)
+
+            # 送信量・計測結果は工程数で按分して各結果に記録する
+            upload = dict(request['upload'])
+            if len(rows) > 1:
+                upload.update(bytes=upload['bytes'] // len(rows), shared_steps=len(rows))
+            for row, result in zip(rows, results):
+                if isinstance(result, dict):
+                    result['metrics'] = metrics.shared(len(rows))
+                    result = _finalize_result(result, request['request_size'], request['image_size'], dict(upload))
+                error = validate_crop_result(result)
+                if error:
+                    writer.finish(row, "error", result=result if isinstance(result, dict) else None, error=error, job=job)
+                    hold.done()
+                    continue
+                crop_metrics = RequestMetrics()
+                crop_future = crop_pool.submit(
+                    _crop_manifest_row, row, job, result, output_dir, resize_width, resize_height, aspect_ratio,
+                    renditions, crop_metrics, naming, encode_pool
+                )
+                crop_future.add_done_callback(lambda _, hold=hold: hold.done())
+                crop_futures[crop_future] = (row, job, result, crop_metrics)
+
+        for future in as_completed(crop_futures):
+            writer.finish_crop(future, *crop_futures[future])
+
+    records = writer.records
+    elapsed = time.perf_counter() - started
+    succeeded = sum(1 for record in records.values() if record['status'] == "ok")
+    print(f"バッチ結果の適用が完了しました: 成功 {succeeded}件 / 失敗 {total - succeeded}件 ({elapsed:.1f}秒)")
+    if memory_budget is not None:
+        print_memory_budget_stats(memory_budget)
+    print(f"結果ファイル: {record_path}")
+    return sorted(records.values(), key=lambda record: record['index'])
+
 def main():
     # コマンドライン引数の設定
     parser = argparse.ArgumentParser(description='GPT-4 Visionを使用して画像をクロッピング')
-    parser.add_argument('--image', required=True, help='クロッピングする画像のパス')
-    parser.add_argument('--instruction', required=True, help='クロッピングする部分の説明（例: "猫の顔"）')
+    parser.add_argument('--image', help='クロッピングする画像のパス（--manifest を使わない場合は必須）')
+    parser.add_argument('--frames', help='--image の代わりに、動画から書き出したフレーム画像のディレクトリ、または複数フレームのGIF/WebPを指定する。ほとんど変化しないフレームを除いて候補のフレームを選び、工程ごとに最も合うフレームをクロップする')
+    parser.add_argument('--instruction', help='クロッピングする部分の説明（例: "猫の顔"）（--manifest を使わない場合は必須）')
+    parser.add_argument('--steps', nargs='+', default=None, help='同じ画像に対する複数のレシピ指示。1回のリクエストでまとめて座標を取得し、工程ごとに保存する')
     parser.add_argument('--output', default=None, help='出力画像のパス（指定しない場合は自動でタイムスタンプ付きファイル名を生成）')
 
     parser.add_argument('--output_dir', default='output', help='出力ディレクトリのパス（デフォルト: output）')
     parser.add_argument('--api_key', help='OpenAI APIキー（環境変数OPENAI_API_KEYでも設定可能）')
     parser.add_argument('--resize_width', type=int, default=0, help='クロップ後の画像の幅(px)。16:9の比率を維持してリサイズ。0の場合はリサイズしない(デフォルト: 0)')
     parser.add_argument('--resize_height', type=int, default=0, help='クロップ後の画像の高さ(px)。16:9の比率を維持してリサイズ。widthとheightの両方が指定された場合はwidthが優先される(デフォルト: 0)')
+    parser.add_argument('--aspect_ratio', default='16:9', help='クロップ後の画像のアスペクト比（例: 16:9, 4:3, 1:1）(デフォルト: 16:9)')
+    parser.add_argument('--backend', choices=sorted(CROP_BACKENDS), default='gpt', help='クロップ座標を求める方法。gpt: GPT-4.1、local: ネットワークを使わないローカル推定(デフォルト: gpt)')
+    parser.add_argument('--fallback', choices=sorted(CROP_BACKENDS), default=None, help='バックエンドがエラー・タイムアウト・無効な結果になった場合に使う方法（例: local）')
+    parser.add_argument('--fast_model', default=None, help='まず問い合わせる軽量なモデル（例: gpt-4.1-mini）。local を指定するとローカル推定。結果が無効・小さすぎる・ほぼ全体・確からしさが低い場合だけ大きいモデル（gpt-4.1）で取り直す。指定しない場合は常に大きいモデルを使う')
+    parser.add_argument('--escalation_confidence', type=float, default=0.6, help='軽量なモデルの確からしさ（0〜1）がこれ未満の場合に大きいモデルで取り直す(デフォルト: 0.6)')
+    parser.add_argument('--escalation_max_area', type=float, default=0.9, help='軽量なモデルの領域の面積比（画像全体に対する割合）がこれ以上の場合に大きいモデルで取り直す(デフォルト: 0.9)')
+    parser.add_argument('--escalation_min_area', type=float, default=0.01, help='軽量なモデルの領域の面積比がこれ未満の場合に大きいモデルで取り直す(デフォルト: 0.01)')
+    parser.add_argument('--structured_output', action='store_true', help='構造化出力（JSONスキーマ）で応答を受け取る。出力トークン数の上限を小さくし、応答をスキーマで検証する')
+    parser.add_argument('--api_timeout', type=float, default=0, help='API呼び出しのタイムアウト(秒)。0の場合はクライアントの既定値(デフォルト: 0)')
+    parser.add_argument('--max_rpm', type=int, default=0, help='1分あたりのAPIリクエスト数の上限。0の場合は応答のレート制限ヘッダーのみに従う(デフォルト: 0)')
+    parser.add_argument('--max_tpm', type=int, default=0, help='1分あたりのトークン数の上限（送信前に見積もった値で制限）。0の場合は応答のレート制限ヘッダーのみに従う(デフォルト: 0)')
+    parser.add_argument('--max_retries', type=int, default=5, help='429や一時的なエラーの場合にリトライする最大回数(デフォルト: 5)')
+    parser.add_argument('--retry_deadline', type=float, default=120, help='1回のAPI呼び出しでリトライを続ける期限(秒)(デフォルト: 120)')
+    parser.add_argument('--display', choices=['auto', 'on', 'off'], default='auto', help='結果をmatplotlibで表示するか。auto: ディスプレイがある場合のみ表示、off: ヘッドレスモード（matplotlibを読み込まない）(デフォルト: auto)')
+    parser.add_argument('--review_dir', default=None, help='結果を1件ずつ表示する代わりに、元画像とクロップ画像を並べたレビュー用ギャラリー（コンタクトシートとHTML）を書き出すディレクトリ')
+    parser.add_argument('--rendition', action='append', default=None, help='同じクロップから追加で保存する画像（複数指定可）。例: "height=120,name=thumb" "width=1280,format=webp,quality=80" "width=600,aspect_ratio=1:1"')
+    parser.add_argument('--frame_mode', choices=FRAME_MODES, default='sheet', help='フレーム列の送り方。sheet: 候補のフレームを並べた1枚のコンタクトシートを送り、工程ごとにフレームを選ばせる、best: 最も長く映っているシーンの最も鮮明なフレームだけを送る(デフォルト: sheet)')
+    parser.add_argument('--max_keyframes', type=int, default=4, help='フレーム列から選ぶ候補のフレームの最大数(デフォルト: 4)')
+    parser.add_argument('--scene_threshold', type=float, default=12, help='新しいシーンとみなす、シーンの最初のフレームとの輝度の平均絶対差（0〜255）。小さいほど候補が細かく分かれる(デフォルト: 12)')
+    parser.add_argument('--manifest', help='バッチ処理用のマニフェスト（CSVまたはJSONL、列: image, instruction, output）')
+    parser.add_argument('--group_steps', action='store_true', help='バッチ処理で同じ画像を使う行を1回のリクエストにまとめる')
+    parser.add_argument('--concurrency', type=int, default=4, help='バッチ処理で同時に実行するAPIリクエスト数(デフォルト: 4)')
+    parser.add_argument('--naming', choices=['timestamp', 'content'], default='timestamp', help='出力ファイル名の決め方。timestamp: タイムスタンプ付き、content: 入力画像のハッシュ・指示文・出力設定から決まる名前で、ハッシュの先頭2文字のサブディレクトリに分けて保存(デフォルト: timestamp)')
+    parser.add_argument('--encode_workers', type=int, default=0, help='バッチ処理で出力画像のエンコードと書き込みを行うプロセス数。0の場合はクロップワーカーのスレッドで行う(デフォルト: 0)')
+    parser.add_argument('--crop_workers', type=int, default=0, help='バッチ処理でクロップ・保存を行うワーカー数。0の場合はCPUコア数(デフォルト: 0)')
+    parser.add_argument('--large_image_mb', type=float, default=0, help='デコード後のサイズがこれを超える画像を大きい画像モード（ファイルを保持せず分割してbase64エンコードし、クロップ領域だけをデコード）で扱う(MB)。0の場合は使わない(デフォルト: 0)')
+    parser.add_argument('--memory_budget_mb', type=float, default=0, help='バッチ処理で同時に処理する画像のメモリ量の上限(MB)。超える画像は先の画像の処理が終わるまで待つ。0の場合は上限なし(デフォルト: 0)')
+    parser.add_argument('--proxy_max_edge', type=int, default=0, help='API送信用に画像を縮小する長辺のピクセル数（例: 1024）。返された座標は元画像の座標に戻される。0の場合は元画像をそのまま送信(デフォルト: 0)')
+    parser.add_argument('--proxy_quality', type=int, default=85, help='縮小プロキシ画像のJPEG品質(デフォルト: 85)')
+    parser.add_argument('--cache', default=None, help='API応答のキャッシュファイル（SQLite）のパス。指定しない場合はキャッシュを使わない')
+    parser.add_argument('--cache_max_mb', type=float, default=100, help='キャッシュの最大サイズ(MB)。超えた場合は古いものから削除(デフォルト: 100)')
+    parser.add_argument('--cache_max_age_days', type=float, default=30, help='キャッシュの有効期間(日)。0の場合は無期限(デフォルト: 30)')
+    parser.add_argument('--near_duplicate_index', default=None, help='似た画像のクロップ座標を再利用するインデックス（SQLite）のパス。知覚ハッシュが近く縦横比が同じ画像の同じ指示文の座標を、APIを呼び出さずに画像サイズに合わせて使う')
+    parser.add_argument('--near_duplicate_distance', type=int, default=6, help='似た画像とみなす知覚ハッシュ（64ビット）のハミング距離の上限。0の場合は縮小・再圧縮したほぼ同じ画像のみ(デフォルト: 6)')
+    parser.add_argument('--batch_file', default=None, help='バッチAPI用のリクエストファイル（JSONL）。--manifest と指定すると書き出し、--batch_results と指定すると結果を適用する')
+    parser.add_argument('--batch_results', default=None, help='バッチAPIの結果ファイル（JSONL）。--batch_file の各行の座標でクロップ・保存を行う（APIは呼び出さない）')
+    parser.add_argument('--journal', default=None, help='バッチ処理のジョブジャーナル（SQLite）のパス。完了済みの行を省略し、失敗した行だけをやり直す。複数のワーカーで共有できる')
+    parser.add_argument('--journal_lease', type=float, default=600, help='処理中の行を他のワーカーが引き継ぐまでの時間(秒)(デフォルト: 600)')
+    parser.add_argument('--results', default=None, help='バッチ処理の行ごとの結果を書き出すJSONLのパス（指定しない場合は出力ディレクトリに自動生成）')
+    parser.add_argument('--metrics', default=None, help='処理段ごとの時間・送信量・トークン数を書き出すパス。拡張子が .prom の場合はPrometheusのテキスト形式、それ以外はJSON Lines')
+    parser.add_argument('--quiet', action='store_true', help='処理途中の経過出力（APIの応答や座標の調整過程など）を行わない')
     args = parser.parse_args()
+
+    global QUIET
+    QUIET = args.quiet
+
+    if args.batch_results and not args.batch_file:
+        parser.error('--batch_results には --batch_file を指定してください。')
+    if args.batch_file and not (args.manifest or args.batch_results):
+        parser.error('--batch_file には --manifest（書き出し）または --batch_results（結果の適用）を指定してください。')
+    if not args.manifest and not args.batch_results and not ((args.image or args.frames) and (args.instruction or args.steps)):
+        parser.error('--image（または --frames）と --instruction（または --steps）、または --manifest を指定してください。')
+    if args.image and args.frames:
+        parser.error('--image と --frames は同時に指定できません。')
+    if args.fast_model and args.backend != "gpt":
+        parser.error('--fast_model は --backend gpt の場合のみ指定できます。')
+    if args.max_keyframes < 1:
+        parser.error('--max_keyframes には1以上の値を指定してください。')
+    if not 0 <= args.near_duplicate_distance <= 64:
+        parser.error('--near_duplicate_distance には0から64の値を指定してください。')
     
-    # 日本語フォントのセットアップ
-    japanese_fonts()
-    
-    # APIキーの取得
+    # APIキーの取得（バッチファイルの書き出し・結果の適用ではAPIを呼び出さない）
     api_key = args.api_key or os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    if not api_key and "gpt" in (args.backend, args.fallback) and not args.batch_file:
         raise ValueError("APIキーが必要です。--api_keyオプションか環境変数OPENAI_API_KEYで指定してください。")
+
+    # 追加で保存するサイズ・比率・形式
+    try:
+        renditions = [parse_rendition(spec) for spec in args.rendition or []]
+    except ValueError as e:
+        parser.error(str(e))
+
+    # API応答のキャッシュ
+    cache = None
+    if args.cache:
+        cache = ResponseCache(
+            args.cache,
+            max_bytes=int(args.cache_max_mb * 1024 * 1024),
+            max_age=args.cache_max_age_days * 24 * 60 * 60
+        )
+
+    # 似た画像のクロップ座標の再利用
+    near_duplicates = None
+    if args.near_duplicate_index:
+        from perceptual_index import NearDuplicateIndex
+        near_duplicates = NearDuplicateIndex(args.near_duplicate_index, max_distance=args.near_duplicate_distance)
+
+    # 段階的なモデルの切り替え（軽量なモデル → 大きいモデル）
+    escalation = None
+    if args.fast_model:
+        escalation = EscalationPolicy(args.fast_model, min_confidence=args.escalation_confidence,
+                                      max_area=args.escalation_max_area, min_area=args.escalation_min_area)
+
+    # 計測結果の出力先
+    metrics_writer = MetricsWriter(args.metrics) if args.metrics else None
+
+    # API呼び出しのレート制限とリトライ
+    limiter = None
+    if "gpt" in (args.backend, args.fallback):
+        limiter = RateLimiter(
+            max_rpm=args.max_rpm,
+            max_tpm=args.max_tpm,
+            max_concurrency=max(1, args.concurrency),
+            max_retries=args.max_retries,
+            deadline=args.retry_deadline
+        )
+
+    # 大きい画像の扱いと、同時に処理する画像のメモリ量の上限
+    large_image_bytes = int(args.large_image_mb * 1024 * 1024)
+    if large_image_bytes and not PARTIAL_DECODE:
+        log(f"警告: Pillow {PIL.__version__} では部分的なデコードを使えないため、大きい画像もクロップ時に画像全体をデコードします")
+    memory_budget = MemoryBudget(int(args.memory_budget_mb * 1024 * 1024)) if args.memory_budget_mb > 0 else None
+
+    # バッチAPI用のファイルの書き出しと、結果の適用
+    if args.batch_file and args.batch_results:
+        if not os.path.exists(args.batch_results):
+            print(f"エラー: 指定された結果ファイル '{args.batch_results}' が見つかりません。")
+            return
+        records = apply_batch_results(
+            args.batch_file,
+            args.batch_results,
+            output_dir=args.output_dir,
+            record_path=args.results,
+            crop_workers=args.crop_workers,
+            resize_width=args.resize_width,
+            resize_height=args.resize_height,
+            aspect_ratio=args.aspect_ratio,
+            renditions=renditions,
+            metrics_writer=metrics_writer,
+            naming=args.naming,
+            encode_workers=args.encode_workers,
+            large_image_bytes=large_image_bytes,
+            memory_budget=memory_budget
+        )
+        write_review_gallery(records, args.review_dir, args.crop_workers)
+        return
+    if args.batch_file:
+        if not os.path.exists(args.manifest):
+            print(f"エラー: 指定されたマニフェスト '{args.manifest}' が見つかりません。")
+            return
+        build_batch_file(
+            args.manifest,
+            args.batch_file,
+            proxy_max_edge=args.proxy_max_edge,
+            proxy_quality=args.proxy_quality,
+            group_steps=args.group_steps,
+            structured=args.structured_output,
+            large_image_bytes=large_image_bytes
+        )
+        return
+
+    # バッチ処理（結果の表示は行わない）
+    if args.manifest:
+        if not os.path.exists(args.manifest):
+            print(f"エラー: 指定されたマニフェスト '{args.manifest}' が見つかりません。")
+            return
+        records = run_batch(
+            args.manifest,
+            output_dir=args.output_dir,
+            results_path=args.results,
+            concurrency=max(1, args.concurrency),
+            crop_workers=args.crop_workers,
+            resize_width=args.resize_width,
+            resize_height=args.resize_height,
+            aspect_ratio=args.aspect_ratio,
+            proxy_max_edge=args.proxy_max_edge,
+            proxy_quality=args.proxy_quality,
+            cache=cache,
+            group_steps=args.group_steps,
+            backend=args.backend,
+            fallback=args.fallback,
+            timeout=args.api_timeout,
+            renditions=renditions,
+            metrics_writer=metrics_writer,
+            structured=args.structured_output,
+            limiter=limiter,
+            journal=JobJournal(args.journal, lease=args.journal_lease) if args.journal else None,
+            naming=args.naming,
+            encode_workers=args.encode_workers,
+            large_image_bytes=large_image_bytes,
+            memory_budget=memory_budget,
+            near_duplicates=near_duplicates,
+            escalation=escalation
+        )
+        write_review_gallery(records, args.review_dir, args.crop_workers)
+        return
+
+    # 結果を表示するかどうか（auto の場合はディスプレイがある環境でのみ表示。ギャラリーを書き出す場合は表示しない）
+    show_results = not args.review_dir and (args.display == 'on' or (args.display == 'auto' and has_display()))
+    if show_results:
+        # 日本語フォントのセットアップ
+        japanese_fonts()
+    else:
+        log("ヘッドレスモードで実行します（結果の表示は行いません）")
     
     # 入力画像が存在することを確認
-    if not os.path.exists(args.image):
+    if args.frames:
+        from frame_sequence import is_frame_source
+        if not os.path.exists(args.frames):
+            print(f"エラー: 指定されたフレーム '{args.frames}' が見つかりません。")
+            return
+        if not is_frame_source(args.frames):
+            print(f"エラー: '{args.frames}' はフレーム画像のディレクトリ、または複数フレームのGIF/WebPではありません。")
+            return
+    elif not os.path.exists(args.image):
         print(f"エラー: 指定された画像ファイル '{args.image}' が見つかりません。")
         return
         
-    try:
-        # 入力画像を開いてテスト
-        with Image.open(args.image) as test_img:
-            img_width, img_height = test_img.size
-            print(f"入力画像の読み込みに成功しました。サイズ: {img_width}x{img_height}")
-    except Exception as e:
-        print(f"エラー: 画像ファイルの読み込みに失敗しました: {e}")
-        return
+    # フレーム列の場合は、候補のフレームを選んだ後に読み込む
+    job = None
+    if not args.frames:
+        try:
+            # 入力画像を1回だけ読み込み、以降の処理で使い回す
+            job = ImageJob.from_path(args.image, large_image_bytes=large_image_bytes)
+            img_width, img_height = job.size
+            log(f"入力画像の読み込みに成功しました。サイズ: {img_width}x{img_height}")
+            if job.large:
+                log("大きい画像モードで処理します（クロップ領域だけをデコードします）")
+        except Exception as e:
+            print(f"エラー: 画像ファイルの読み込みに失敗しました: {e}")
+            return
     
     # GPT-4 Visionでクロップ座標を取得
-    print(f"画像の分析中: {args.image}")
-    print(f"指示: {args.instruction}")
+    log(f"画像の分析中: {args.frames or args.image}")
+    instructions = args.steps or [args.instruction]
+    for number, instruction in enumerate(instructions, start=1):
+        log(f"指示{number if args.steps else ''}: {instruction}")
     
     try:
-        result = crop_image_with_gpt(args.image, args.instruction)
+        # 複数の工程は1回のリクエストでまとめて問い合わせる
+        analyze_options = {}
+        if args.backend == "gpt" or args.fallback == "gpt":
+            analyze_options.update(
+                proxy_max_edge=args.proxy_max_edge, proxy_quality=args.proxy_quality, cache=cache, timeout=args.api_timeout,
+                structured=args.structured_output, limiter=limiter, near_duplicates=near_duplicates,
+                escalation=escalation
+            )
+        if args.frames:
+            analyzed = analyze_frames(
+                args.frames, instructions, frame_mode=args.frame_mode, max_keyframes=args.max_keyframes,
+                scene_threshold=args.scene_threshold,
+                backend=args.backend, fallback=args.fallback, aspect_ratio=args.aspect_ratio, **analyze_options
+            )
+            if analyzed is None:
+                print(f"エラー: '{args.frames}' にフレームが見つかりません。")
+                return
+            results, jobs = analyzed
+        else:
+            results = analyze_image(
+                job, instructions,
+                backend=args.backend, fallback=args.fallback, aspect_ratio=args.aspect_ratio, **analyze_options
+            )
+            jobs = [job] * len(results)
     except Exception as e:
         print(f"GPT-4 Vision API呼び出し中にエラーが発生しました: {e}")
         return
-    
-    if not result:
-        print("クロップ座標の取得に失敗しました。")
+
+    records = []
+    for number, result in enumerate(results, start=1):
+        # フレーム列の場合は工程ごとに選ばれたフレーム（GIF/WebPのフレームはファイルがないため、出力はJPEG）
+        job = jobs[number - 1]
+        image_path = job.path if args.frames else args.image
+        record_path = image_path
+        if args.frames and not image_path:
+            # 結果とレビュー用ギャラリーには "clip.gif#12" の形式で選ばれたフレームを記録する
+            frame = result.get('frame') if isinstance(result, dict) else None
+            record_path = f"{args.frames}#{frame['index']}" if frame else args.frames
+        if args.steps:
+            log(f"\n工程{number}: {args.steps[number - 1]}")
+        if args.output:
+            output_filename = args.output
+            if args.steps:
+                root, ext = os.path.splitext(args.output)
+                output_filename = f"{root}_step{number:02d}{ext}"
+        elif args.naming == 'content':
+            # 入力画像のハッシュ・指示文・出力設定から決まるファイル名（入力画像の拡張子を保持）
+            output_filename = content_output_filename(
+                args.output_dir, job.sha256, instructions[number - 1],
+                output_variant(args.resize_width, args.resize_height, args.aspect_ratio), input_image_path=image_path
+            )
+        else:
+            # 自動でタイムスタンプ付きファイル名を生成（入力画像の拡張子を保持）
+            output_filename = generate_output_filename(
+                output_dir=args.output_dir,
+                base_name=f"cropped_step{number:02d}" if args.steps else "cropped",
+                input_image_path=image_path
+            )
+        records.append(_save_and_display_result(job, result, output_filename, args, show=show_results,
+                                                renditions=renditions, metrics_writer=metrics_writer, index=number - 1,
+                                                image_path=record_path))
+    if escalation is not None:
+        print_escalation_stats(escalation)
+    write_review_gallery(records, args.review_dir)
+
+def write_review_gallery(records, review_dir, workers=0):
+    """review_dir が指定されていれば、結果のレビュー用ギャラリーを書き出す"""
+    if not review_dir:
         return
-    
+    index_path = build_gallery(records, review_dir, workers=workers or None)
+    print(f"レビュー用ギャラリーを書き出しました: {index_path}")
+
+def _save_and_display_result(job, result, output_filename, args, show=True, renditions=None, metrics_writer=None,
+                             index=0, image_path=None):
+    """APIの結果を確認し、画像をクロップして保存し、show が真の場合は表示する
+
+    戻り値はバッチ処理と同じ形式の結果の辞書（レビュー用ギャラリーに使う）。
+    image_path は結果に記録する入力画像のパス（省略した場合は args.image）。
+    """
+    instruction = args.steps[index] if args.steps else args.instruction
+    image_path = image_path or args.image
+    row = {"index": index, "image": image_path, "instruction": instruction}
     # 結果が期待通りのフォーマットか確認
-    if 'crop_coordinates' not in result:
-        print("エラー: APIレスポンスに 'crop_coordinates' が含まれていません。")
-        print("受信したデータ:", result)
-        return
-        
-    required_keys = ['x_min', 'y_min', 'x_max', 'y_max']
-    if not all(key in result['crop_coordinates'] for key in required_keys):
-        print("エラー: クロップ座標データが不完全です。")
-        print("受信したデータ:", result['crop_coordinates'])
-        return
+    error = validate_crop_result(result)
+    if error:
+        print(f"エラー: {error}")
+        if result:
+            print("受信したデータ:", result)
+        if metrics_writer is not None:
+            metrics_writer.record(metrics_record(index, image_path, instruction, "error", job=job, result=result))
+        return batch_record(row, "error", result=result if isinstance(result, dict) else None, error=error)
     
     # 説明フィールドの確認
     description = result.get('description', '説明なし')
     
     # 座標情報を表示
-    print("クロップ座標:")
-    print(f"左上: ({result['crop_coordinates']['x_min']}, {result['crop_coordinates']['y_min']})")
-    print(f"右下: ({result['crop_coordinates']['x_max']}, {result['crop_coordinates']['y_max']})")
-    print(f"説明: {description}")
-
-    if args.output:
-        output_filename = args.output
-    else:
-        # 自動でタイムスタンプ付きファイル名を生成（入力画像の拡張子を保持）
-        output_filename = generate_output_filename(
-            output_dir=args.output_dir,
-            input_image_path=args.image
-        )
+    log("クロップ座標:")
+    log(f"左上: ({result['crop_coordinates']['x_min']}, {result['crop_coordinates']['y_min']})")
+    log(f"右下: ({result['crop_coordinates']['x_max']}, {result['crop_coordinates']['y_max']})")
+    log(f"説明: {description}")
+    if result.get('tier'):
+        log(f"使用した段: {result['tier']}" + (f"（大きいモデルに切り替えた理由: {result['escalation']}）"
+                                              if result.get('escalation') else ""))
+    if result.get('upload'):
+        log(f"送信した画像データ: {result['upload']['bytes']}バイト ({result['upload']['width']}x{result['upload']['height']})")
 
     # 画像をクロップして保存
-    cropped_img, final_coords = crop_and_save_image(
-        args.image, 
+    crop_metrics = RequestMetrics()
+    cropped_img, final_coords, outputs = crop_and_save_image(
+        job, 
         result['crop_coordinates'], 
         output_filename,
         resize_width=args.resize_width,
-        resize_height=args.resize_height
+        resize_height=args.resize_height,
+        aspect_ratio=args.aspect_ratio,
+        renditions=renditions or [],
+        metrics=crop_metrics
     )
+    if metrics_writer is not None:
+        metrics_writer.record(metrics_record(
+            index, image_path, instruction, "ok" if cropped_img else "error", job=job, result=result,
+            crop_metrics=crop_metrics
+        ))
     
     if cropped_img:
         print(f"クロップした画像を保存しました: {output_filename}")
         
         # 結果を表示（GPTが返した元の座標）
-        display_results(args.image, output_filename, result['crop_coordinates'], description)  # ← final_coords ではなく result['crop_coordinates'] を渡す
-    else:
-        print("クロッピング処理に失敗しました。")
+        if show:
+            display_results(job, output_filename, result['crop_coordinates'], description, cropped_img=cropped_img)  # ← final_coords ではなく result['crop_coordinates'] を渡す
+        return batch_record(row, "ok", result, output_filename, final_coords, renditions_saved=outputs)
+    print("クロッピング処理に失敗しました。")
+    return batch_record(row, "error", result, error="クロッピング処理に失敗しました。")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,114 @@
+import math
+import threading
+
+# 段階的なモデルの切り替え（まず軽量なモデルかローカル推定で座標を求め、必要な場合だけ大きいモデルに問い合わせる）
+# 軽量な段の結果が次のいずれかに当たる場合に、大きいモデルの段に回す（エスカレーション）
+#   - invalid: 応答の解析・検証に失敗した（座標がない・不正な値）
+#   - degenerate: 領域が小さすぎる（幅・高さが min_edge ピクセル未満、または画像に対する面積比が min_area 未満）
+#   - full_frame: 領域が画像のほぼ全体（面積比が max_area 以上）で、対象を絞り込めていない
+#   - low_confidence: 自己申告の確からしさ（confidence）が min_confidence 未満
+# 段ごとの呼び出し回数・時間・トークン数と、エスカレーションの割合・理由を集計する
+
+# 軽量な段にローカル推定を使う場合のモデル名
+LOCAL_TIER = "local"
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class EscalationPolicy:
+    """段階的なモデルの切り替えの設定と集計（複数のスレッドから同時に使える）
+
+    fast_model は軽量な段のモデル名（LOCAL_TIER の場合はローカル推定）。
+    大きい段のモデルは呼び出し側の設定（通常は MODEL_NAME）を使う。
+    """
+
+    def __init__(self, fast_model="gpt-4.1-mini", min_confidence=0.6, max_area=0.9, min_area=0.01, min_edge=16):
+        self.fast_model = fast_model
+        self.min_confidence = min_confidence
+        self.max_area = max_area
+        self.min_area = min_area
+        self.min_edge = min_edge
+        self.results = 0
+        self.escalated = 0
+        self.reasons = {}
+        self._tiers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def local(self):
+        return self.fast_model == LOCAL_TIER
+
+    def escalation_reason(self, result, image_size, error=None):
+        """軽量な段の結果を大きいモデルに回す理由を返す（回す必要がない場合は None）
+
+        error は結果の検証エラー（cropping.validate_crop_result の戻り値）。
+        """
+        if error:
+            return "invalid"
+        coords = result['crop_coordinates']
+        if not all(_is_number(coords.get(key)) for key in ('x_min', 'y_min', 'x_max', 'y_max')):
+            return "invalid"
+        width = coords['x_max'] - coords['x_min']
+        height = coords['y_max'] - coords['y_min']
+        area = width * height / float(image_size[0] * image_size[1])
+        if width < self.min_edge or height < self.min_edge or area < self.min_area:
+            return "degenerate"
+        if area >= self.max_area:
+            return "full_frame"
+        confidence = result.get('confidence')
+        if isinstance(confidence, (int, float)) and not isinstance(confidence, bool) and confidence < self.min_confidence:
+            return "low_confidence"
+        return None
+
+    def record_call(self, tier, seconds, results=()):
+        """段（"fast" または "full"）の1回の呼び出しの時間と、返された結果のトークン数を記録する"""
+        prompt_tokens = 0
+        completion_tokens = 0
+        for result in results:
+            metrics = (result.get('metrics') or {}) if isinstance(result, dict) else {}
+            prompt_tokens += metrics.get('prompt_tokens') or 0
+            completion_tokens += metrics.get('completion_tokens') or 0
+        with self._lock:
+            stats = self._tiers.setdefault(tier, {"latencies": [], "prompt_tokens": 0, "completion_tokens": 0})
+            stats["latencies"].append(seconds)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+
+    def record_results(self, reasons):
+        """軽量な段で処理した結果ごとの、エスカレーションの理由（不要な場合は None）を記録する"""
+        with self._lock:
+            for reason in reasons:
+                self.results += 1
+                if reason:
+                    self.escalated += 1
+                    self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def stats(self):
+        """エスカレーションの回数・割合・理由と、段ごとの呼び出し回数・時間（ミリ秒）・トークン数を返す"""
+        with self._lock:
+            tiers = {}
+            for tier, stats in self._tiers.items():
+                latencies = stats["latencies"]
+                tiers[tier] = {
+                    "calls": len(latencies),
+                    "mean_ms": round(sum(latencies) / len(latencies) * 1000, 1),
+                    "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1),
+                    "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+                    "prompt_tokens": stats["prompt_tokens"],
+                    "completion_tokens": stats["completion_tokens"],
+                }
+            return {
+                "fast_model": self.fast_model,
+                "results": self.results,
+                "escalated": self.escalated,
+                "escalation_rate": self.escalated / self.results if self.results else 0.0,
+                "reasons": dict(self.reasons),
+                "tiers": tiers,
+            }
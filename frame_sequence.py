@@ -0,0 +1,201 @@
+import os
+import math
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+# 動画から書き出したフレーム列（フレーム画像のディレクトリ、または複数フレームのGIF/WebP）から、
+# API に送るキーフレームを選ぶ
+# フレームを1枚ずつ縮小して読み込み、前のシーンとの差分（シーンの切り替わり）と鮮明さ（ラプラシアンの分散）だけを
+# 計算する。ほとんど変化しないフレームは同じシーンにまとめ、シーンごとに最も鮮明なフレームだけを候補に残すため、
+# API に送る画像の数（コスト）はクリップの長さによらない
+
+# フレームとして読み込むファイルの拡張子
+FRAME_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+# シーンの比較に使う縮小画像のサイズと、鮮明さの計算に使う縮小画像の長辺
+COMPARE_SIZE = (64, 36)
+SHARPNESS_EDGE = 256
+
+# 最も鮮明なシーンに比べて鮮明さがこの割合未満のシーン（切り替わり途中のぶれたフレーム）は候補にしない
+MIN_SHARPNESS_RATIO = 0.2
+
+# コンタクトシートのフレームの間隔と背景色（フレームの境界が分かるように白で区切る）
+SHEET_GAP = 8
+SHEET_BACKGROUND = (255, 255, 255)
+
+
+def is_frame_source(path):
+    """フレーム画像のディレクトリ、または2フレーム以上のGIF/WebPかどうか"""
+    if os.path.isdir(path):
+        return True
+    try:
+        with Image.open(path) as img:
+            return getattr(img, 'n_frames', 1) > 1
+    except (OSError, ValueError):
+        return False
+
+
+def list_frame_files(directory):
+    """ディレクトリ内のフレーム画像のパスを名前順に返す"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(FRAME_EXTENSIONS))
+    return [os.path.join(directory, name) for name in names]
+
+
+def iter_frames(source, max_edge=SHARPNESS_EDGE):
+    """フレームを1枚ずつ、長辺 max_edge に縮小したRGB画像として (フレーム番号, 名前, 画像, 表示時間) を返す
+
+    表示時間は GIF/WebP ではフレームの表示時間（ミリ秒。エンコーダーが同じフレームを1つにまとめた場合は合計）、
+    ディレクトリでは1（フレーム数）。ディレクトリのJPEGは縮小デコードするため、フルサイズのデコードは行わない。
+    """
+    if os.path.isdir(source):
+        for index, path in enumerate(list_frame_files(source)):
+            with Image.open(path) as img:
+                img.draft('RGB', (max_edge, max_edge))
+                img.thumbnail((max_edge, max_edge), Image.Resampling.BILINEAR)
+                yield index, os.path.basename(path), img.convert('RGB'), 1
+        return
+    with Image.open(source) as img:
+        for index, frame in enumerate(ImageSequence.Iterator(img)):
+            small = frame.convert('RGB')
+            small.thumbnail((max_edge, max_edge), Image.Resampling.BILINEAR)
+            yield index, f"{os.path.basename(source)}#{index}", small, frame.info.get('duration') or 100
+
+
+def sharpness(gray):
+    """グレースケール配列の鮮明さ（4近傍ラプラシアンの分散。ぶれ・ぼけたフレームほど小さい）"""
+    laplacian = (gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var()) if laplacian.size else 0.0
+
+
+def scan_scenes(source, scene_threshold=12.0):
+    """フレームを順に読み、シーン（ほとんど変化しない連続したフレーム）ごとの情報のリストを返す
+
+    シーンの最初のフレームとの輝度の平均絶対差が scene_threshold（0〜255）以上になったフレームから新しいシーンにする。
+    各シーンは {"start", "end", "duration", "frame", "name", "sharpness"}
+    （duration は iter_frames の表示時間の合計、frame はシーンで最も鮮明なフレーム）。
+    保持するのはシーンごとの数値だけで、フレームの画像は保持しない。
+    """
+    scenes = []
+    reference = None
+    for index, name, img, duration in iter_frames(source):
+        gray = np.asarray(img.convert('L'), dtype=np.float32)
+        compare = np.asarray(img.convert('L').resize(COMPARE_SIZE, Image.Resampling.BOX), dtype=np.float32)
+        score = sharpness(gray)
+        if reference is None or float(np.abs(compare - reference).mean()) >= scene_threshold:
+            reference = compare
+            scenes.append({"start": index, "end": index, "duration": duration, "frame": index, "name": name,
+                           "sharpness": score})
+            continue
+        scene = scenes[-1]
+        scene["end"] = index
+        scene["duration"] += duration
+        if score > scene["sharpness"]:
+            scene.update(frame=index, name=name, sharpness=score)
+    return scenes
+
+
+def choose_keyframes(scenes, max_keyframes=4):
+    """長く映っている（表示時間の長い）シーンから順に max_keyframes 個選び、各シーンの最も鮮明なフレームを時間順に返す
+
+    切り替わりの途中のぶれたフレームだけのシーン（鮮明さが MIN_SHARPNESS_RATIO 未満）は除く。
+    """
+    sharpest = max(scene["sharpness"] for scene in scenes)
+    scenes = [scene for scene in scenes if scene["sharpness"] >= sharpest * MIN_SHARPNESS_RATIO]
+    ranked = sorted(scenes, key=lambda scene: (-scene["duration"], -scene["sharpness"], scene["start"]))
+    return sorted(ranked[:max(1, max_keyframes)], key=lambda scene: scene["start"])
+
+
+def load_frames(source, indices):
+    """指定した番号のフレームをフルサイズで読み込み、{フレーム番号: PIL画像} を返す（GIF/WebPは1回だけ先頭から読む）"""
+    wanted = set(indices)
+    frames = {}
+    if os.path.isdir(source):
+        paths = list_frame_files(source)
+        for index in wanted:
+            with Image.open(paths[index]) as img:
+                img.load()
+                frames[index] = img.copy()
+        return frames
+    with Image.open(source) as img:
+        for index, frame in enumerate(ImageSequence.Iterator(img)):
+            if index in wanted:
+                frames[index] = frame.convert('RGBA' if frame.mode in ('RGBA', 'LA', 'P') else 'RGB')
+                if len(frames) == len(wanted):
+                    break
+    return frames
+
+
+def frame_path(source, index):
+    """ディレクトリのフレームの場合はファイルのパス（GIF/WebPのフレームの場合は None）"""
+    return list_frame_files(source)[index] if os.path.isdir(source) else None
+
+
+def build_contact_sheet(frames, tile_edge=512, columns=None):
+    """フレーム（PIL画像のリスト）を格子状に並べた1枚の画像と、各フレームを置いた矩形のリストを返す
+
+    各フレームは縦横比を保って tile_edge 四方のマスに収め、マスの間は SHEET_GAP ピクセル空ける。
+    矩形は (x_min, y_min, x_max, y_max)。
+    """
+    columns = columns or math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / columns)
+    thumbnails = []
+    for frame in frames:
+        thumbnail = frame.convert('RGB')
+        thumbnail.thumbnail((tile_edge, tile_edge), Image.Resampling.LANCZOS)
+        thumbnails.append(thumbnail)
+    # 全てのフレームが同じ縦横比の場合が多いため、マスの大きさは最大の縮小画像に合わせる
+    cell_width = max(thumbnail.width for thumbnail in thumbnails)
+    cell_height = max(thumbnail.height for thumbnail in thumbnails)
+    sheet = Image.new('RGB', (columns * cell_width + (columns - 1) * SHEET_GAP,
+                              rows * cell_height + (rows - 1) * SHEET_GAP), SHEET_BACKGROUND)
+    tiles = []
+    for position, thumbnail in enumerate(thumbnails):
+        left = (position % columns) * (cell_width + SHEET_GAP) + (cell_width - thumbnail.width) // 2
+        top = (position // columns) * (cell_height + SHEET_GAP) + (cell_height - thumbnail.height) // 2
+        sheet.paste(thumbnail, (left, top))
+        tiles.append((left, top, left + thumbnail.width, top + thumbnail.height))
+    return sheet, tiles
+
+
+def map_sheet_box(box, tiles, frame_sizes):
+    """コンタクトシート上の座標（辞書）を、最も重なるフレームの座標に変換して (フレームの位置, 座標) を返す
+
+    どのフレームとも重ならない場合（余白や空いているマス）は、中心が最も近いフレームの中に中心が入るように移動する。
+    座標はフレームの範囲内に収めてから、フレームの元のサイズ（frame_sizes）に拡大する。
+    """
+    def overlap(tile):
+        width = min(box['x_max'], tile[2]) - max(box['x_min'], tile[0])
+        height = min(box['y_max'], tile[3]) - max(box['y_min'], tile[1])
+        return max(0, width) * max(0, height)
+
+    def distance(tile):
+        return ((box['x_min'] + box['x_max'] - tile[0] - tile[2]) ** 2 +
+                (box['y_min'] + box['y_max'] - tile[1] - tile[3]) ** 2)
+
+    areas = [overlap(tile) for tile in tiles]
+    if max(areas) > 0:
+        position = areas.index(max(areas))
+    else:
+        position = min(range(len(tiles)), key=lambda index: distance(tiles[index]))
+    left, top, right, bottom = tiles[position]
+    if max(areas) <= 0:
+        center_x = (box['x_min'] + box['x_max']) / 2
+        center_y = (box['y_min'] + box['y_max']) / 2
+        shift_x = min(max(center_x, left), right) - center_x
+        shift_y = min(max(center_y, top), bottom) - center_y
+        box = {"x_min": box['x_min'] + shift_x, "y_min": box['y_min'] + shift_y,
+               "x_max": box['x_max'] + shift_x, "y_max": box['y_max'] + shift_y}
+    width, height = frame_sizes[position]
+    scale_x = width / (right - left)
+    scale_y = height / (bottom - top)
+    x_min = min(max(box['x_min'], left), right - 1)
+    y_min = min(max(box['y_min'], top), bottom - 1)
+    x_max = max(min(box['x_max'], right), x_min + 1)
+    y_max = max(min(box['y_max'], bottom), y_min + 1)
+    return position, {
+        "x_min": int(round((x_min - left) * scale_x)),
+        "y_min": int(round((y_min - top) * scale_y)),
+        "x_max": min(width, int(round((x_max - left) * scale_x))),
+        "y_max": min(height, int(round((y_max - top) * scale_y))),
+    }
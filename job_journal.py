@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+
+# バッチ処理のジョブジャーナル
+# 画像のハッシュ・指示文ごとの処理状況（処理中・完了・失敗）と結果（座標・説明・出力パス）を
+# SQLiteファイルに追記し、中断したバッチ処理を再実行したときに完了済みの行を省略する
+
+
+def make_job_key(image_hash, instruction):
+    """画像のハッシュと指示文からジョブのキーを作成"""
+    encoded = json.dumps({"image": image_hash, "instruction": instruction}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def default_worker_id():
+    """ワーカーの識別子（ホスト名:プロセスID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobJournal:
+    """追記のみのジョブジャーナル
+
+    状態が変わるたびに1行を追記し、キーごとの最新の行をそのジョブの状態とする。
+    - running: 処理中（lease 秒以内に完了しない場合は、他のワーカーが処理を引き継げる）
+    - ok: 完了（再実行時は省略する）
+    - error: 失敗（再実行時にやり直す）
+    複数のワーカープロセスから同じファイルを同時に使えるように、SQLiteのWALモードを使い、
+    処理の開始（claim）は排他的なトランザクションで行う。
+    """
+
+    def __init__(self, path, lease=600, worker_id=None):
+        self.path = path
+        self.lease = lease
+        self.worker_id = worker_id or default_worker_id()
+        self.claimed = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.busy = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    image TEXT,
+                    instruction TEXT,
+                    worker TEXT NOT NULL,
+                    record TEXT,
+                    created_at REAL NOT NULL,
+                    lease_until REAL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_key ON entries (key, id)")
+
+    def _connect(self):
+        # トランザクションは明示的に開始する。他プロセスが書き込み中の場合は最大30秒待つ
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def _latest(conn, key):
+        row = conn.execute(
+            "SELECT status, image, instruction, worker, record, created_at, lease_until FROM entries "
+            "WHERE key = ? ORDER BY id DESC LIMIT 1",
+            (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, image, instruction, worker, record, created_at, lease_until = row
+        return {
+            "status": status,
+            "image": image,
+            "instruction": instruction,
+            "worker": worker,
+            "record": json.loads(record) if record else None,
+            "created_at": created_at,
+            "lease_until": lease_until,
+        }
+
+    @staticmethod
+    def _worker_alive(worker):
+        """同じホストのワーカーであれば、プロセスが残っているか確認する（別のホストの場合は不明のため True）"""
+        host, _, pid = worker.rpartition(":")
+        if host != socket.gethostname() or not pid.isdigit():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def lookup(self, key):
+        """ジョブの最新の状態を返す。記録がない場合は None"""
+        with closing(self._connect()) as conn:
+            return self._latest(conn, key)
+
+    def claim(self, key, image=None, instruction=None):
+        """ジョブの処理を開始する
+
+        開始できた場合は None を返す。完了済み（ok）の場合と、他のワーカーが処理中（running）の場合は
+        その最新の状態を返す。中断したワーカーの処理中の記録は、期限切れまたはプロセスが
+        終了していれば引き継ぐ。
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                latest = self._latest(conn, key)
+                if latest is not None:
+                    if latest["status"] == "ok":
+                        conn.execute("COMMIT")
+                        self._count('skipped')
+                        return latest
+                    if (latest["status"] == "running" and latest["worker"] != self.worker_id
+                            and (latest["lease_until"] or 0) > now and self._worker_alive(latest["worker"])):
+                        conn.execute("COMMIT")
+                        self._count('busy')
+                        return latest
+                conn.execute(
+                    "INSERT INTO entries (key, status, image, instruction, worker, created_at, lease_until) "
+                    "VALUES (?, 'running', ?, ?, ?, ?, ?)",
+                    (key, image, instruction, self.worker_id, now, now + self.lease)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        self._count('claimed')
+        return None
+
+    def finish(self, key, status, record=None, image=None, instruction=None):
+        """ジョブの結果（ok / error）と、結果の辞書（座標・説明・出力パスなど）を追記する"""
+        value = json.dumps(record, ensure_ascii=False) if record is not None else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO entries (key, status, image, instruction, worker, record, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, status, image, instruction, self.worker_id, value, time.time())
+            )
+        self._count('completed' if status == "ok" else 'failed')
+
+    def summary(self):
+        """ジャーナル全体の、最新の状態ごとのジョブ数を返す"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM entries WHERE id IN (SELECT MAX(id) FROM entries GROUP BY key) "
+                "GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def stats(self):
+        """このプロセスでの開始・完了・失敗・省略した件数を返す"""
+        with self._lock:
+            return {
+                "claimed": self.claimed,
+                "completed": self.completed,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "busy": self.busy,
+            }
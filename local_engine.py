@@ -0,0 +1,149 @@
+import numpy as np
+
+# ネットワークを使わないローカルのクロップ領域推定
+# エッジ・色のコントラスト・肌色（手元）から顕著性マップを作り、
+# 積分画像（summed-area table）を使って指定のアスペクト比で最も顕著性の高い窓を探す
+
+
+def _normalize(values):
+    """0〜1の範囲に正規化（一様な場合は0）"""
+    low = values.min()
+    high = values.max()
+    if high - low < 1e-6:
+        return np.zeros_like(values)
+    return (values - low) / (high - low)
+
+
+def box_blur(values, radius):
+    """積分画像を使った平均フィルタ（端は有効な画素数で割る）"""
+    if radius < 1:
+        return values
+    height, width = values.shape
+    table = integral_image(values)
+    ys = np.arange(height)
+    xs = np.arange(width)
+    y0 = np.clip(ys - radius, 0, height)
+    y1 = np.clip(ys + radius + 1, 0, height)
+    x0 = np.clip(xs - radius, 0, width)
+    x1 = np.clip(xs + radius + 1, 0, width)
+    sums = (table[y1][:, x1] - table[y0][:, x1] - table[y1][:, x0] + table[y0][:, x0])
+    counts = np.outer(y1 - y0, x1 - x0)
+    return sums / counts
+
+
+def integral_image(values):
+    """先頭に0の行・列を付けた積分画像（table[y, x] は values[:y, :x] の合計）"""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=table[1:, 1:])
+    return table
+
+
+def compute_saliency_map(rgb, edge_weight=1.0, contrast_weight=1.0, skin_weight=1.5, center_weight=0.3):
+    """RGB配列 (H, W, 3) から顕著性マップ (H, W) を計算する
+
+    - エッジ: 輝度の勾配の大きさ（食材の切り口や調理器具の輪郭）
+    - 色のコントラスト: 周囲の平均色との差（背景から浮き出た食材）
+    - 肌色: YCbCr 空間での肌色判定（作業中の手元）
+    - 中央重み: 画像の中央をわずかに優先する
+    """
+    rgb = rgb.astype(np.float32)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    luma = 0.299 * red + 0.587 * green + 0.114 * blue
+    height, width = luma.shape
+    radius = max(1, min(height, width) // 16)
+
+    # エッジ
+    grad_y = np.zeros_like(luma)
+    grad_x = np.zeros_like(luma)
+    grad_y[1:-1] = luma[2:] - luma[:-2]
+    grad_x[:, 1:-1] = luma[:, 2:] - luma[:, :-2]
+    edges = box_blur(np.hypot(grad_x, grad_y), radius // 2)
+
+    # 色のコントラスト（反対色空間で周囲の平均との差）
+    opponent = np.stack([red - green, (red + green) / 2 - blue, luma], axis=-1)
+    contrast = np.zeros_like(luma)
+    for channel in range(3):
+        contrast += (opponent[..., channel] - box_blur(opponent[..., channel], radius * 2)) ** 2
+    contrast = np.sqrt(contrast)
+
+    # 肌色
+    cb = 128 - 0.168736 * red - 0.331264 * green + 0.5 * blue
+    cr = 128 + 0.5 * red - 0.418688 * green - 0.081312 * blue
+    skin = ((cb >= 77) & (cb <= 127) & (cr >= 133) & (cr <= 173) & (luma > 40)).astype(np.float32)
+    skin = box_blur(skin, radius // 2)
+
+    # 中央重み
+    yy = (np.arange(height) - (height - 1) / 2) / max(height, 1)
+    xx = (np.arange(width) - (width - 1) / 2) / max(width, 1)
+    center = 1.0 - np.sqrt(yy[:, None] ** 2 + xx[None, :] ** 2) * np.sqrt(2)
+
+    saliency = (edge_weight * _normalize(edges)
+                + contrast_weight * _normalize(contrast)
+                + skin_weight * skin
+                + center_weight * center)
+    return _normalize(saliency)
+
+
+def find_best_window(saliency, ratio=(16, 9), min_scale=0.35, scale_steps=8, stride=None, threshold=1.1):
+    """顕著性マップ上で、比率 ratio の窓のうち最もスコアの高いものを (x_min, y_min, x_max, y_max) で返す
+
+    スコアは「窓内の (顕著性 - 平均顕著性 * threshold) の合計」で、顕著な領域をできるだけ多く含み
+    顕著でない領域をできるだけ含まない窓ほど高くなる。積分画像により、各候補のスコアは定数時間で求まる。
+    """
+    height, width = saliency.shape
+    ratio_width, ratio_height = ratio
+    table = integral_image(saliency - saliency.mean() * threshold)
+
+    # 画像に収まる最大の窓
+    max_window_width = min(width, int(height * ratio_width / ratio_height))
+    best = None
+    for scale in np.linspace(1.0, min_scale, scale_steps):
+        window_width = max(2, int(round(max_window_width * scale)))
+        window_height = max(2, min(height, int(round(window_width * ratio_height / ratio_width))))
+        step = stride or max(1, min(window_width, window_height) // 16)
+
+        # 全ての位置の窓の合計をまとめて計算
+        y0 = np.arange(0, height - window_height + 1, step)
+        x0 = np.arange(0, width - window_width + 1, step)
+        y1 = y0 + window_height
+        x1 = x0 + window_width
+        scores = (table[np.ix_(y1, x1)] - table[np.ix_(y0, x1)]
+                  - table[np.ix_(y1, x0)] + table[np.ix_(y0, x0)])
+        index = np.unravel_index(np.argmax(scores), scores.shape)
+        score = float(scores[index])
+        if best is None or score > best[0]:
+            top = int(y0[index[0]])
+            left = int(x0[index[1]])
+            best = (score, (left, top, left + window_width, top + window_height))
+    return best[1], best[0]
+
+
+def window_confidence(saliency, box):
+    """窓の内側と外側の平均顕著性の差を 0〜1 で返す（顕著な領域が窓に集まっているほど1に近い）
+
+    顕著性が画像全体に散らばっている場合や、窓が画像全体を覆う場合は0に近くなる。
+    """
+    x_min, y_min, x_max, y_max = box
+    total = float(saliency.sum())
+    inside = float(saliency[y_min:y_max, x_min:x_max].sum())
+    inside_area = (x_max - x_min) * (y_max - y_min)
+    outside_area = saliency.size - inside_area
+    if outside_area <= 0 or inside_area <= 0:
+        return 0.0
+    inside_mean = inside / inside_area
+    outside_mean = (total - inside) / outside_area
+    if inside_mean + outside_mean <= 1e-9:
+        return 0.0
+    return max(0.0, min(1.0, (inside_mean - outside_mean) / (inside_mean + outside_mean)))
+
+
+def locate_salient_crop(img, ratio=(16, 9), **options):
+    """PIL画像（縮小済みを想定）から顕著な領域の窓を求め、(座標, スコア, 確からしさ) を返す
+
+    確からしさは window_confidence（0〜1）。
+    """
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    saliency = compute_saliency_map(np.asarray(img))
+    box, score = find_best_window(saliency, ratio=ratio, **options)
+    return box, score, window_confidence(saliency, box)
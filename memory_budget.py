@@ -0,0 +1,79 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# 画像処理のメモリ予算
+# 同時に処理する画像のメモリ量（デコード後のピクセルデータなどの見積もり）の合計を上限以内に抑え、
+# 上限を超える画像は先に始めた画像の処理が終わるまで順番に待たせる
+
+# 1ピクセルあたりのバイト数（Pillow は1チャンネルのモード以外を1ピクセル4バイトで保持する）
+_PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2, "I": 4, "F": 4}
+
+
+def estimate_decode_bytes(width, height, mode="RGB"):
+    """width x height の画像をデコードしたときのピクセルデータのバイト数"""
+    return width * height * _PIXEL_BYTES.get(mode, 4)
+
+
+class MemoryBudget:
+    """プロセス内で同時に処理する画像のメモリ量の上限
+
+    acquire は予約した順に処理し（先に待っている大きい画像が、後から来た小さい画像に追い越され続けることはない）、
+    空きができるまで待つ。1つで上限を超える画像は、他に処理中の画像がない時に単独で処理する。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak = 0
+        self.acquired = 0
+        self.waited = 0
+        self.oversized = 0
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        """nbytes を予約する（空きができるまで待つ）。release に渡す予約量を返す"""
+        nbytes = max(0, int(nbytes))
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+            waited = False
+            while self._queue[0] is not ticket or (self.in_use and self.in_use + nbytes > self.max_bytes):
+                waited = True
+                self._condition.wait()
+            self._queue.popleft()
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            self.acquired += 1
+            self.waited += waited
+            self.oversized += nbytes > self.max_bytes
+            # 次の予約も空きがあれば続けて処理できるように通知する
+            self._condition.notify_all()
+        return nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self.in_use = max(0, self.in_use - nbytes)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """with 文の間だけ nbytes を予約する"""
+        nbytes = self.acquire(nbytes)
+        try:
+            yield nbytes
+        finally:
+            self.release(nbytes)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "max_bytes": self.max_bytes,
+                "in_use": self.in_use,
+                "peak": self.peak,
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "oversized": self.oversized,
+                "queued": len(self._queue),
+            }
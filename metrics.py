@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# 処理段ごとの経過時間・送信量・トークン数の計測
+# 1件ごとの計測結果を RequestMetrics に記録し、MetricsWriter で JSON Lines または
+# Prometheus のテキスト形式（node_exporter の textfile collector 用）に書き出す
+
+# 計測する処理段
+# decode: 画像のデコード, proxy: 縮小プロキシ画像の作成, base64: 送信用のエンコード, api: API呼び出しの往復,
+# parse: 応答のJSON解析, local: ローカル推定, fit: 比率の調整, crop: 切り出し, resize: リサイズ,
+# encode: 出力形式へのエンコード, write: ファイルへの書き込み, renditions: レンディションの作成と保存
+STAGES = ["decode", "proxy", "base64", "api", "parse", "local", "fit", "crop", "resize", "encode", "write", "renditions"]
+
+# API応答の usage から記録するトークン数
+USAGE_FIELDS = ["prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens"]
+
+# 集計時に合計する値
+COUNTER_FIELDS = ["request_bytes", "output_bytes"] + USAGE_FIELDS
+
+
+class RequestMetrics:
+    """1件の処理の、処理段ごとの経過時間（秒）と送信量・トークン数などの値"""
+
+    def __init__(self):
+        self.timings = {}
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        """with ブロックの経過時間を処理段 name に加算する"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+
+    def add(self, name, value):
+        """数値を加算して記録する（None の場合は何もしない）"""
+        if value is not None:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def add_usage(self, usage):
+        """API応答の usage（トークン数）を記録する"""
+        if usage is None:
+            return
+        for field in USAGE_FIELDS[:3]:
+            self.add(field, getattr(usage, field, None))
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.add("cached_tokens", getattr(details, "cached_tokens", None))
+
+    def merge(self, other):
+        """別の計測結果（RequestMetrics または as_dict() の辞書）を加算する"""
+        if isinstance(other, RequestMetrics):
+            other = other.as_dict()
+        for name, seconds in (other or {}).get("timings", {}).items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+        for name, value in (other or {}).items():
+            if name != "timings":
+                self.add(name, value)
+
+    def shared(self, count):
+        """1回のリクエストを count 件で共有した場合の、1件あたりの計測結果（辞書）を返す"""
+        return {
+            "timings": {name: seconds / count for name, seconds in self.timings.items()},
+            **{name: value // count if isinstance(value, int) else value / count for name, value in self.values.items()},
+        }
+
+    def as_dict(self):
+        return {"timings": {name: round(seconds, 6) for name, seconds in self.timings.items()}, **self.values}
+
+
+class MetricsWriter:
+    """計測結果を書き出す
+
+    パスの拡張子が .prom の場合は、それまでの全件の集計を Prometheus のテキスト形式で書き出す
+    （書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える）。
+    それ以外の場合は1件ごとに JSON Lines で追記する。複数スレッドから呼び出せる。
+    """
+
+    def __init__(self, path, prefix="cropping"):
+        self.path = path
+        self.prefix = prefix
+        self.prometheus = path.endswith(".prom")
+        self.stage_seconds = {}
+        self.stage_counts = {}
+        self.values = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def record(self, record):
+        """1件分の計測結果（timings と数値を含む辞書）を記録する"""
+        with self._lock:
+            for name, seconds in record.get("timings", {}).items():
+                self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+                self.stage_counts[name] = self.stage_counts.get(name, 0) + 1
+            for name in COUNTER_FIELDS:
+                if record.get(name) is not None:
+                    self.values[name] = self.values.get(name, 0) + record[name]
+            status = record.get("status", "ok")
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+            if self.prometheus:
+                self._write_prometheus()
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _write_prometheus(self):
+        prefix = self.prefix
+        lines = [
+            f"# HELP {prefix}_stage_seconds 処理段ごとの経過時間(秒)",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for name in sorted(self.stage_seconds, key=lambda name: (STAGES + [name]).index(name)):
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {self.stage_seconds[name]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {self.stage_counts[name]}')
+        lines += [f"# HELP {prefix}_items_total 処理した件数", f"# TYPE {prefix}_items_total counter"]
+        for status, count in sorted(self.statuses.items()):
+            lines.append(f'{prefix}_items_total{{status="{status}"}} {count}')
+        for name, value in sorted(self.values.items()):
+            metric = f"{prefix}_{name}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+        temp_path = f"{self.path}.tmp.{os.getpid()}"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
+
+    def summary(self):
+        """処理段ごとの合計時間と、数値の合計を返す"""
+        with self._lock:
+            return {
+                "stage_seconds": dict(self.stage_seconds),
+                "values": dict(self.values),
+                "statuses": dict(self.statuses),
+            }
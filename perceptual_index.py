@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+from PIL import Image
+
+# 似た画像のクロップ座標の再利用
+# 縮小・再圧縮・軽い色調整などで内容がほぼ同じ画像（知覚ハッシュのハミング距離が小さい画像）に対しては、
+# 同じ指示文で以前に得たクロップ座標を画像サイズに合わせて変換して使い、API呼び出しを省略する
+
+# ハッシュのビット数（9x8 のグレースケール画像の横方向の差分）
+HASH_BITS = 64
+
+# 縮小画像の明暗の差がこれ未満の画像（単色に近い画像）は、内容に関わらず同じハッシュになるため使わない
+MIN_CONTRAST = 8
+
+
+def difference_hash(img):
+    """PIL画像の dHash（64ビットの整数）を計算。単色に近く区別できない画像の場合は None
+
+    9x8 に縮小したグレースケール画像で、各行の隣り合う画素の明暗を比べたビット列。
+    縮小・JPEGの再圧縮・明るさの変化に強く、トリミングや反転には反応する。
+    """
+    pixels = np.asarray(img.convert('L').resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+    if pixels.max() - pixels.min() < MIN_CONTRAST:
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def make_scope_key(instruction, model, prompt_version, **options):
+    """指示文・モデル名・プロンプトのバージョンから、座標を再利用できる範囲のキーを作成"""
+    payload = {
+        "instruction": instruction,
+        "model": model,
+        "prompt_version": prompt_version,
+        "options": {key: value for key, value in sorted(options.items()) if value},
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _to_signed(value):
+    # SQLite の INTEGER は符号付き64ビットのため、上位ビットが立つハッシュは負の値として保存する
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(values):
+        return np.bitwise_count(values)
+else:
+    def _popcount(values):
+        # numpy 2.0 より前はバイト単位に分けて数える
+        return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+class _Scope:
+    """1つの範囲（指示文）のハッシュと画像サイズを連続した配列で保持する（容量は倍々に増やす）"""
+
+    def __init__(self):
+        self.count = 0
+        self.last_id = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.aspects = np.zeros(0, dtype=np.float64)
+
+    def extend(self, rows):
+        if not rows:
+            return
+        needed = self.count + len(rows)
+        if needed > len(self.hashes):
+            capacity = max(needed, len(self.hashes) * 2, 1024)
+            for name in ('ids', 'hashes', 'aspects'):
+                grown = np.zeros(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.count] = getattr(self, name)[:self.count]
+                setattr(self, name, grown)
+        end = self.count + len(rows)
+        self.ids[self.count:end] = [row[0] for row in rows]
+        self.hashes[self.count:end] = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)
+        self.aspects[self.count:end] = [row[2] / row[3] for row in rows]
+        self.count = end
+        self.last_id = max(self.last_id, int(self.ids[end - 1]))
+
+
+class NearDuplicateIndex:
+    """知覚ハッシュで似た画像のクロップ座標を探すインデックス
+
+    エントリはSQLiteファイル（WALモード、操作ごとの接続）に保存し、検索は範囲（指示文など）ごとに
+    メモリ上に展開したハッシュの配列に対して、XOR とビット数の集計をまとめて行う（数十万件でも数ミリ秒程度）。
+    同じファイルを使う他のプロセスが追加したエントリは、検索のたびに差分だけを読み込む。
+    max_distance 以下のハミング距離で、縦横比の差が max_aspect_delta 以内の最も近いエントリを使う。
+    """
+
+    def __init__(self, path, max_distance=6, max_aspect_delta=0.01):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_aspect_delta = max_aspect_delta
+        self.lookups = 0
+        self.reused = 0
+        self.stores = 0
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    scope TEXT NOT NULL,
+                    hash INTEGER NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_scope ON entries (scope, id)")
+
+    def _connect(self):
+        # 他プロセスが書き込み中の場合は最大30秒待つ
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def _refresh(self, scope_key):
+        """範囲のエントリのうち、まだメモリ上にないもの（他のプロセスが追加したものを含む）を読み込む"""
+        with self._lock:
+            scope = self._scopes.setdefault(scope_key, _Scope())
+            last_id = scope.last_id
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, hash, width, height FROM entries WHERE scope = ? AND id > ? ORDER BY id",
+                (scope_key, last_id)
+            ).fetchall()
+        with self._lock:
+            # 別のスレッドが先に読み込んだ分は除く
+            scope.extend([row for row in rows if row[0] > scope.last_id])
+        return scope
+
+    def lookup(self, scope_key, image_hash, size):
+        """似た画像のエントリを探し、見つかった場合は保存した結果と画像サイズ・距離の辞書、なければ None を返す"""
+        scope = self._refresh(scope_key)
+        with self._lock:
+            self.lookups += 1
+            if not scope.count:
+                return None
+            distances = _popcount(scope.hashes[:scope.count] ^ np.uint64(image_hash)).astype(np.int32)
+            aspect = size[0] / size[1]
+            # 縦横比が違う画像（トリミングされたものなど）は座標を変換できないため除外する
+            distances[np.abs(scope.aspects[:scope.count] / aspect - 1) > self.max_aspect_delta] = HASH_BITS + 1
+            position = int(np.argmin(distances))
+            distance = int(distances[position])
+            if distance > self.max_distance:
+                return None
+            entry_id = int(scope.ids[position])
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT width, height, value FROM entries WHERE id = ?", (entry_id,)).fetchone()
+        if row is None:
+            return None
+        self._count('reused')
+        width, height, value = row
+        return dict(json.loads(value), size=(width, height), distance=distance)
+
+    def add(self, scope_key, image_hash, size, result):
+        """crop_coordinates と description（と confidence）を、画像のハッシュとサイズとともに保存"""
+        entry = {
+            "crop_coordinates": result["crop_coordinates"],
+            "description": result.get("description"),
+        }
+        if result.get("confidence") is not None:
+            entry["confidence"] = result["confidence"]
+        value = json.dumps(entry, ensure_ascii=False)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO entries (scope, hash, width, height, value, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (scope_key, _to_signed(image_hash), size[0], size[1], value, time.time())
+            )
+        self._count('stores')
+
+    def __len__(self):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """このプロセスでの検索・再利用・保存の回数を返す"""
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "reused": self.reused,
+                "stores": self.stores,
+                "reuse_rate": self.reused / self.lookups if self.lookups else 0.0,
+            }
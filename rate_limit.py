@@ -0,0 +1,248 @@
+import re
+import time
+import random
+import threading
+
+# API呼び出しのレート制限とリトライ
+# リクエスト数・トークン数の上限をトークンバケットで管理し、応答のレート制限ヘッダーで残量を補正する。
+# 429 や一時的なエラーの場合は同時実行数を減らし、ジッター付きの指数バックオフで期限までリトライする。
+
+# リトライする HTTP ステータス
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# リトライする例外（openai を読み込まずに判定するためクラス名で確認する）
+RETRY_ERRORS = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError"}
+
+
+def parse_duration(value):
+    """レート制限ヘッダーの期間（"1s", "6m0s", "20ms", "0.5"）を秒に変換。解析できない場合は None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+
+class TokenBucket:
+    """1分あたり limit 単位まで補充されるトークンバケット（limit が 0 の場合は制限しない）"""
+
+    def __init__(self, limit_per_minute=0):
+        self.limit = limit_per_minute
+        self.available = float(limit_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.limit:
+            self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """amount 単位を取得できるまでの待ち時間(秒)。0 の場合は取得済み"""
+        with self._lock:
+            if not self.limit:
+                return 0.0
+            now = time.monotonic()
+            self._refill(now)
+            # 上限を超える量は上限まで待てば取得できたものとして扱う
+            amount = min(amount, self.limit)
+            if self.available >= amount:
+                self.available -= amount
+                return 0.0
+            return (amount - self.available) * 60 / self.limit
+
+    def refund(self, amount):
+        """取得した amount 単位を戻す（使わなかった場合）"""
+        with self._lock:
+            if not self.limit:
+                return
+            self._refill(time.monotonic())
+            self.available = min(self.limit, self.available + min(amount, self.limit))
+
+    def update(self, limit=None, remaining=None, reset=None):
+        """応答ヘッダーの上限・残量で補正する"""
+        with self._lock:
+            now = time.monotonic()
+            if limit:
+                self.limit = limit
+            self._refill(now)
+            if remaining is not None:
+                self.available = min(self.available, float(remaining))
+                # 残量が0の場合はリセットまで待つ
+                if remaining <= 0 and reset:
+                    self.available = -reset * self.limit / 60 if self.limit else 0.0
+
+
+class RateLimiter:
+    """API呼び出しのスケジューラー
+
+    - リクエスト数・トークン数のトークンバケット（max_rpm / max_tpm、応答ヘッダーで補正）
+    - 同時実行数の自動調整（429 で半分にし、連続して成功すると1ずつ戻す）
+    - ジッター付きの指数バックオフ（Retry-After があればそれに従う）と、リトライの期限（deadline 秒）
+    複数スレッドから同じインスタンスを共有して使う。
+    """
+
+    def __init__(self, max_rpm=0, max_tpm=0, max_concurrency=4, max_retries=5, deadline=120.0,
+                 base_delay=0.5, max_delay=30.0):
+        self.requests = TokenBucket(max_rpm)
+        self.tokens = TokenBucket(max_tpm)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.calls = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def _acquire_slot(self, give_up_at):
+        with self._condition:
+            while self.in_flight >= self.concurrency:
+                remaining = give_up_at - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("API呼び出しの実行枠を待つ間に期限を過ぎました")
+                self._condition.wait(min(remaining, 1.0))
+            self.in_flight += 1
+
+    def _release_slot(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _wait_budget(self, tokens, give_up_at):
+        """リクエスト数・トークン数の枠を取得するまで待つ。期限までに取得できない場合は、取得済みの枠を戻して TimeoutError"""
+        acquired = []
+        try:
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                while True:
+                    delay = bucket.wait_time(amount)
+                    if delay <= 0:
+                        acquired.append((bucket, amount))
+                        break
+                    if time.monotonic() + delay > give_up_at:
+                        raise TimeoutError("レート制限の待ち時間が期限を超えます")
+                    time.sleep(min(delay, 1.0))
+        except TimeoutError:
+            # 送信しないリクエストの分は他の呼び出しで使えるようにする
+            for bucket, amount in acquired:
+                bucket.refund(amount)
+            raise
+
+    def _on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self.concurrency < self.max_concurrency and self._successes >= self.concurrency:
+                self.concurrency += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def _on_rate_limited(self):
+        with self._condition:
+            self.rate_limited += 1
+            self._successes = 0
+            self.concurrency = max(1, self.concurrency // 2)
+
+    def update_from_headers(self, headers):
+        """x-ratelimit-* ヘッダーからバケットの上限と残量を補正する"""
+        if not headers:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None and remaining is None:
+                continue
+            try:
+                bucket.update(
+                    limit=int(limit) if limit is not None else None,
+                    remaining=int(remaining) if remaining is not None else None,
+                    reset=parse_duration(headers.get(f"x-ratelimit-reset-{kind}")),
+                )
+            except ValueError:
+                continue
+
+    @staticmethod
+    def _retry_after(headers):
+        """Retry-After-Ms / Retry-After ヘッダーの待ち時間（秒）。解析できない場合は None（通常のバックオフを使う）"""
+        if not headers:
+            return None
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            # 単位のない数値はミリ秒、単位付き（"20ms" など）は parse_duration で秒に変換する
+            try:
+                return float(str(value).strip()) / 1000
+            except ValueError:
+                seconds = parse_duration(value)
+                if seconds is not None:
+                    return seconds
+        return parse_duration(headers.get("retry-after"))
+
+    @staticmethod
+    def is_retryable(error):
+        if type(error).__name__ in RETRY_ERRORS:
+            return True
+        return getattr(error, "status_code", None) in RETRY_STATUSES
+
+    def call(self, func, tokens=0):
+        """func() を実行して結果を返す。結果に headers 属性があればレート制限の残量を補正する
+
+        リトライできないエラー、最大回数、期限を超えた場合は最後の例外を送出する。
+        """
+        give_up_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self._wait_budget(tokens, give_up_at)
+            self._acquire_slot(give_up_at)
+            try:
+                with self._condition:
+                    self.calls += 1
+                result = func()
+            except Exception as e:
+                self._release_slot()
+                headers = getattr(getattr(e, "response", None), "headers", None)
+                self.update_from_headers(headers)
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    with self._condition:
+                        self.failures += 1
+                    raise
+                if getattr(e, "status_code", None) == 429:
+                    self._on_rate_limited()
+                delay = self._retry_after(headers)
+                if delay is None:
+                    # フルジッター: 0〜(base * 2^attempt) の一様乱数
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if time.monotonic() + delay > give_up_at:
+                    with self._condition:
+                        self.failures += 1
+                    raise
+                attempt += 1
+                with self._condition:
+                    self.retries += 1
+                time.sleep(delay)
+                continue
+            self._release_slot()
+            self.update_from_headers(getattr(result, "headers", None))
+            self._on_success()
+            return result
+
+    def stats(self):
+        with self._condition:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "concurrency": self.concurrency,
+                "max_concurrency": self.max_concurrency,
+            }
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+
+# クロップ結果のキャッシュ
+# 同じ画像・同じ指示文・同じモデル・同じプロンプトの組み合わせに対するAPI応答を
+# SQLiteファイルに保存し、再実行時にAPI呼び出しを省略する
+
+
+def make_cache_key(image_hash, instruction, model, prompt_version, **options):
+    """画像のハッシュ・指示文・モデル名・プロンプトのバージョン（と追加オプション）からキャッシュキーを作成"""
+    payload = {
+        "image": image_hash,
+        "instruction": instruction,
+        "model": model,
+        "prompt_version": prompt_version,
+        "options": {key: value for key, value in sorted(options.items()) if value},
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ResponseCache:
+    """crop_coordinates と description をディスクに保存するキャッシュ
+
+    複数のワーカープロセスから同じファイルを同時に使えるように、SQLiteのWALモードと
+    操作ごとの接続を使う。max_bytes を超えた場合は最後に使われた時刻が古いものから削除し、
+    max_age を過ぎたエントリは読み出し時に破棄する。
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, max_age=30 * 24 * 60 * 60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _connect(self):
+        # 他プロセスが書き込み中の場合は最大30秒待つ
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def get(self, key):
+        """キャッシュされた結果を返す。存在しないか期限切れの場合は None"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count('misses')
+                return None
+            value, created_at = row
+            if self.max_age and now - created_at > self.max_age:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._count('evictions')
+                self._count('misses')
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        self._count('hits')
+        return json.loads(value)
+
+    def put(self, key, result):
+        """crop_coordinates と description（と confidence）のみを保存し、必要に応じて古いエントリを削除"""
+        entry = {
+            "crop_coordinates": result["crop_coordinates"],
+            "description": result.get("description"),
+        }
+        if result.get("confidence") is not None:
+            entry["confidence"] = result["confidence"]
+        value = json.dumps(entry, ensure_ascii=False)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            self._evict(conn, now)
+        self._count('stores')
+
+    def _evict(self, conn, now):
+        """期限切れのエントリと、サイズ上限を超えた分の古いエントリを削除"""
+        evicted = 0
+        if self.max_age:
+            evicted += conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.max_age,)).rowcount
+        if self.max_bytes:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    total -= size
+                    evicted += 1
+        if evicted:
+            self._count('evictions', evicted)
+
+    def stats(self):
+        """このプロセスでのヒット・ミスなどの回数を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,257 @@
+"""バッチ処理の結果を確認するためのレビュー用ギャラリーを作成する
+
+使い方:
+    python review_gallery.py results/batch_results_20250101_120000.jsonl --output_dir review --per_page 20
+
+結果JSONL（cropping.py のバッチ処理・バッチ結果の適用で書き出したもの）の各行について、
+クロップ領域を赤い枠で示した元画像とクロップ画像を並べたパネルを作成し、
+ページごとのコンタクトシートと、説明・座標を載せた静的なHTMLを書き出す。
+描画は Pillow のみで行い（matplotlib のウィンドウは開かない）、ワーカーのスレッドで並列に行う。
+"""
+import os
+import re
+import html
+import json
+import argparse
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+# パネルの配置（元画像の枠は4:3、クロップ画像の枠は16:9、下にラベル）
+PANEL_HEIGHT = 240
+LABEL_HEIGHT = 24
+PANEL_GAP = 8
+BACKGROUND = (245, 245, 245)
+
+# 複数フレームのGIF/WebPのフレームを指すパス（"clip.gif#12"。frame_sequence のフレーム名と同じ形式）
+FRAME_PATH = re.compile(r"^(?P<path>.+)#(?P<index>\d+)$")
+
+
+def load_records(path):
+    """結果JSONLを読み込む（同じ行番号の記録が複数ある場合は最後のものを使い、行番号順に並べる）"""
+    records = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record.get('index', len(records))] = record
+    return [records[index] for index in sorted(records)]
+
+
+def _to_rgb(img):
+    """透過チャンネルを持つ画像は白背景に合成してRGBにする"""
+    if img.mode in ['RGBA', 'LA'] or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def _open_image(path):
+    """画像を開く（"clip.gif#12" のようなパスはそのフレームに移動して返す）"""
+    match = FRAME_PATH.match(path)
+    if match and not os.path.exists(path):
+        img = Image.open(match.group('path'))
+        try:
+            img.seek(int(match.group('index')))
+        except EOFError:
+            img.close()
+            raise ValueError(f"フレームがありません: {path}")
+        return img
+    return Image.open(path)
+
+
+def _load_fitted(path, size):
+    """画像を size に収まるように縮小して読み込む（JPEGは縮小デコード）。読み込めない場合は (None, None)"""
+    try:
+        with _open_image(path) as img:
+            original_size = img.size
+            img.draft('RGB', size)
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+            # 既に size より小さい画像は thumbnail でデコードされないため、ファイルを閉じる前に読み込む
+            img.load()
+            return _to_rgb(img), original_size
+    except (OSError, ValueError):
+        return None, None
+
+
+def _placeholder(size, text):
+    img = Image.new('RGB', size, (220, 220, 220))
+    ImageDraw.Draw(img).text((8, 8), text, fill=(120, 120, 120), font=_font())
+    return img
+
+
+def _font(size=14):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def _scaled_box(box, from_size, to_size):
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    return [box["x_min"] * scale_x, box["y_min"] * scale_y, box["x_max"] * scale_x, box["y_max"] * scale_y]
+
+
+def panel_size(panel_height=PANEL_HEIGHT):
+    """パネル1枚の (幅, 高さ)"""
+    return panel_height * 4 // 3 + PANEL_GAP + panel_height * 16 // 9, panel_height + LABEL_HEIGHT
+
+
+def render_panel(record, panel_height=PANEL_HEIGHT):
+    """1行分のパネル（左: クロップ領域の枠を描いた元画像、右: クロップ画像、下: 行番号と座標）を作成"""
+    source_area = (panel_height * 4 // 3, panel_height)
+    crop_area = (panel_height * 16 // 9, panel_height)
+    panel = Image.new('RGB', panel_size(panel_height), BACKGROUND)
+    draw = ImageDraw.Draw(panel)
+
+    source, original_size = _load_fitted(record['image'], source_area)
+    if source is None:
+        source = _placeholder(source_area, "source not found")
+    else:
+        source_draw = ImageDraw.Draw(source)
+        # モデルが返した座標（黄）と、比率を調整して保存した領域（赤）
+        if record.get('crop_coordinates') and record.get('crop_coordinates') != record.get('final_coordinates'):
+            source_draw.rectangle(_scaled_box(record['crop_coordinates'], original_size, source.size),
+                                  outline=(255, 200, 0), width=1)
+        if record.get('final_coordinates') or record.get('crop_coordinates'):
+            box = record.get('final_coordinates') or record['crop_coordinates']
+            source_draw.rectangle(_scaled_box(box, original_size, source.size), outline=(255, 0, 0), width=2)
+    panel.paste(source, ((source_area[0] - source.width) // 2, (panel_height - source.height) // 2))
+
+    crop = None
+    if record.get('output'):
+        crop, _ = _load_fitted(record['output'], crop_area)
+    if crop is None:
+        crop = _placeholder(crop_area, record.get('status', 'error') if not record.get('output') else "output not found")
+    left = source_area[0] + PANEL_GAP
+    panel.paste(crop, (left + (crop_area[0] - crop.width) // 2, (panel_height - crop.height) // 2))
+
+    box = record.get('final_coordinates') or record.get('crop_coordinates')
+    label = f"#{record.get('index', '?')} {record.get('status', '')}"
+    if box:
+        label += f"  ({box['x_min']}, {box['y_min']}) - ({box['x_max']}, {box['y_max']})"
+    color = (0, 0, 0) if record.get('status') == "ok" else (200, 0, 0)
+    draw.text((4, panel_height + 4), label, fill=color, font=_font())
+    return panel
+
+
+def _relative_url(path, directory):
+    return quote(os.path.relpath(os.path.abspath(path), os.path.abspath(directory)).replace(os.sep, '/'))
+
+
+def _write_page(path, title, body):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(
+            "<!DOCTYPE html>\n<html lang=\"ja\">\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{html.escape(title)}</title>\n"
+            "<style>body{font-family:sans-serif;margin:16px}table{border-collapse:collapse}"
+            "td,th{border:1px solid #ccc;padding:4px 8px;vertical-align:top;font-size:14px}"
+            ".error{color:#c00}img.panel{max-width:100%}</style>\n"
+            f"</head>\n<body>\n<h1>{html.escape(title)}</h1>\n{body}</body>\n</html>\n"
+        )
+
+
+def build_gallery(records, output_dir, per_page=20, columns=2, workers=None, panel_height=PANEL_HEIGHT):
+    """レビュー用ギャラリー（パネル画像・ページごとのコンタクトシート・HTML）を書き出し、index.html のパスを返す
+
+    パネルの描画はページごとに workers 個のスレッドで並列に行う（保持する画像は1ページ分のみ）。
+    """
+    panel_dir = os.path.join(output_dir, "panels")
+    os.makedirs(panel_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    per_page = max(1, per_page)
+    pages = [records[start:start + per_page] for start in range(0, len(records), per_page)]
+    width, height = panel_size(panel_height)
+
+    def render(record):
+        panel = render_panel(record, panel_height)
+        path = os.path.join(panel_dir, f"{record.get('index', 0):06d}.jpg")
+        panel.save(path, 'JPEG', quality=85)
+        return panel, path
+
+    page_links = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for number, page in enumerate(pages, start=1):
+            rendered = list(pool.map(render, page))
+            rows = (len(page) + columns - 1) // columns
+            sheet = Image.new('RGB', (columns * width + (columns + 1) * PANEL_GAP,
+                                      rows * height + (rows + 1) * PANEL_GAP), (255, 255, 255))
+            for position, (panel, _) in enumerate(rendered):
+                sheet.paste(panel, (PANEL_GAP + (position % columns) * (width + PANEL_GAP),
+                                    PANEL_GAP + (position // columns) * (height + PANEL_GAP)))
+            sheet_name = f"sheet_{number:03d}.jpg"
+            sheet.save(os.path.join(output_dir, sheet_name), 'JPEG', quality=85)
+
+            table = []
+            for record, (_, panel_path) in zip(page, rendered):
+                box = record.get('final_coordinates') or record.get('crop_coordinates')
+                coordinates = (f"({box['x_min']}, {box['y_min']}) - ({box['x_max']}, {box['y_max']})" if box else "-")
+                output = record.get('output')
+                output_link = (f"<a href=\"{_relative_url(output, output_dir)}\">{html.escape(os.path.basename(output))}</a>"
+                               if output else "-")
+                status = html.escape(record.get('status', ''))
+                detail = html.escape(record.get('description') or '')
+                if record.get('error'):
+                    detail += f"<div class=\"error\">{html.escape(record['error'])}</div>"
+                table.append(
+                    f"<tr><td>{record.get('index', '')}</td>"
+                    f"<td><img class=\"panel\" src=\"{_relative_url(panel_path, output_dir)}\" loading=\"lazy\"></td>"
+                    f"<td><b>{html.escape(record.get('instruction', ''))}</b><br>{detail}</td>"
+                    f"<td>{coordinates}</td>"
+                    f"<td class=\"{'' if status == 'ok' else 'error'}\">{status}</td>"
+                    f"<td>{html.escape(os.path.basename(record.get('image', '')))}<br>{output_link}</td></tr>"
+                )
+            page_name = f"page_{number:03d}.html"
+            navigation = " ".join(
+                f"<a href=\"page_{other:03d}.html\">{other}</a>" if other != number else f"<b>{other}</b>"
+                for other in range(1, len(pages) + 1)
+            )
+            _write_page(
+                os.path.join(output_dir, page_name), f"レビュー {number}/{len(pages)}",
+                f"<p><a href=\"index.html\">一覧</a> | ページ: {navigation} | "
+                f"<a href=\"{sheet_name}\">コンタクトシート</a></p>\n"
+                "<p>赤い枠: 保存した領域、黄色の枠: モデルが返した座標（比率の調整前）</p>\n"
+                "<table>\n<tr><th>行</th><th>元画像 / クロップ画像</th><th>指示・説明</th><th>座標</th>"
+                "<th>状態</th><th>ファイル</th></tr>\n" + "\n".join(table) + "\n</table>\n"
+            )
+            errors = sum(1 for record in page if record.get('status') != "ok")
+            page_links.append(
+                f"<li><a href=\"{page_name}\">ページ {number}</a>（行 {page[0].get('index')}〜{page[-1].get('index')}, "
+                f"失敗 {errors}件） <a href=\"{sheet_name}\">コンタクトシート</a></li>"
+            )
+
+    succeeded = sum(1 for record in records if record.get('status') == "ok")
+    index_path = os.path.join(output_dir, "index.html")
+    _write_page(
+        index_path, "クロップ結果のレビュー",
+        f"<p>全 {len(records)}件 / 成功 {succeeded}件 / 失敗・省略 {len(records) - succeeded}件</p>\n"
+        "<ul>\n" + "\n".join(page_links) + "\n</ul>\n"
+    )
+    return index_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='バッチ処理の結果のレビュー用ギャラリーを作成')
+    parser.add_argument('results', help='cropping.py のバッチ処理で書き出した結果ファイル（JSONL）')
+    parser.add_argument('--output_dir', default='review', help='ギャラリーの出力先ディレクトリ(デフォルト: review)')
+    parser.add_argument('--per_page', type=int, default=20, help='1ページ（1枚のコンタクトシート）に載せる件数(デフォルト: 20)')
+    parser.add_argument('--columns', type=int, default=2, help='コンタクトシートの列数(デフォルト: 2)')
+    parser.add_argument('--panel_height', type=int, default=PANEL_HEIGHT, help=f'パネルの画像の高さ(px)(デフォルト: {PANEL_HEIGHT})')
+    parser.add_argument('--workers', type=int, default=0, help='描画を行うスレッド数。0の場合はCPUコア数(デフォルト: 0)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.results):
+        print(f"エラー: 指定された結果ファイル '{args.results}' が見つかりません。")
+        return
+    records = load_records(args.results)
+    index_path = build_gallery(records, args.output_dir, per_page=args.per_page, columns=args.columns,
+                               workers=args.workers or None, panel_height=args.panel_height)
+    print(f"レビュー用ギャラリーを書き出しました: {index_path} ({len(records)}件)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""クロップ処理を常駐させるHTTPサーバー
+
+使い方:
+    python server.py --port 8080 --max_concurrency 4 --max_queue 16
+
+POST /crop に画像のバイト列を送ると、クロップ座標・説明・クロップした画像を返す。
+指示文などはクエリパラメータで指定する（JSONで送る場合は image に base64 の画像を入れる）。
+
+    curl --data-binary @kitchen.jpg "http://localhost:8080/crop?instruction=タマネギを切ります&resize_width=640"
+
+OpenAIクライアントは起動時に1つだけ作成して全てのリクエストで使い回すため、
+リクエストごとのインタプリタ起動・import・接続確立のコストがかからない。
+同時に処理するリクエスト数と待ち行列の長さには上限があり、超えた場合は 503 を返す。
+"""
+import json
+import base64
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import cropping
+from response_cache import ResponseCache
+from metrics import RequestMetrics, MetricsWriter
+from rate_limit import RateLimiter
+from memory_budget import MemoryBudget
+from escalation import EscalationPolicy
+
+
+class CropService:
+    """共有のクライアント・キャッシュと、同時実行数・待ち行列・メモリ量の上限を持つクロップ処理"""
+
+    def __init__(self, backend="gpt", fallback=None, max_concurrency=4, max_queue=16, proxy_max_edge=None,
+                 proxy_quality=85, cache=None, timeout=None, base_url=None, client=None, metrics_writer=None,
+                 structured=False, limiter=None, large_image_bytes=0, memory_budget=None, near_duplicates=None,
+                 escalation=None):
+        self.backend = backend
+        self.fallback = fallback
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.options = {"proxy_max_edge": proxy_max_edge, "proxy_quality": proxy_quality, "cache": cache, "timeout": timeout,
+                        "structured": structured}
+        self.limiter = None
+        if backend == "gpt" or fallback == "gpt":
+            # limiter を使う場合はリトライを limiter に任せる
+            self.options["client"] = client or cropping._create_client(
+                timeout, base_url=base_url, max_retries=0 if limiter else None
+            )
+            self.options["limiter"] = self.limiter = limiter
+            self.options["near_duplicates"] = near_duplicates
+            self.options["escalation"] = escalation
+        self.near_duplicates = near_duplicates
+        self.escalation = escalation
+        self.metrics_writer = metrics_writer
+        self.large_image_bytes = large_image_bytes
+        self.memory_budget = memory_budget
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def try_admit(self):
+        """待ち行列に空きがあれば受け付ける（処理中 + 待機中が上限以内）"""
+        with self._lock:
+            if self.pending >= self.max_concurrency + self.max_queue:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            return True
+
+    def process(self, image, instruction, aspect_ratio="16:9", resize_width=0, resize_height=0,
+                image_format="jpg", quality=95):
+        """受け付けたリクエストを実行枠が空くまで待ってから処理し、結果の辞書を返す"""
+        try:
+            with self._slots:
+                with self._lock:
+                    self.active += 1
+                try:
+                    return self._crop(image, instruction, aspect_ratio, resize_width, resize_height,
+                                      image_format, quality)
+                finally:
+                    with self._lock:
+                        self.active -= 1
+                        self.completed += 1
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _crop(self, image, instruction, aspect_ratio, resize_width, resize_height, image_format, quality):
+        job = image if isinstance(image, cropping.ImageJob) else cropping.ImageJob(
+            image, large_image_bytes=self.large_image_bytes
+        )
+        if self.memory_budget is None:
+            return self._crop_job(job, instruction, aspect_ratio, resize_width, resize_height, image_format, quality)
+        # 実行枠が空いていても、メモリ量の上限を超える場合は先のリクエストが終わるまで待つ
+        estimate = cropping.estimate_job_memory(job, self.options["proxy_max_edge"])
+        with self.memory_budget.reserve(estimate):
+            return self._crop_job(job, instruction, aspect_ratio, resize_width, resize_height, image_format, quality)
+
+    def _crop_job(self, job, instruction, aspect_ratio, resize_width, resize_height, image_format, quality):
+        ratio = cropping.parse_aspect_ratio(aspect_ratio)
+        result = cropping.analyze_image(job, [instruction], backend=self.backend, fallback=self.fallback,
+                                        aspect_ratio=ratio, **self.options)[0]
+        error = cropping.validate_crop_result(result)
+        if error:
+            self._record(instruction, "error", job, result)
+            raise ValueError(error)
+        crop_metrics = RequestMetrics()
+        cropped_img, final_coords, _, _ = cropping.crop_image(
+            job, result['crop_coordinates'], resize_width=resize_width, resize_height=resize_height, aspect_ratio=ratio,
+            metrics=crop_metrics
+        )
+        with crop_metrics.stage("encode"):
+            image_bytes = cropping.encode_image(cropped_img, image_format, quality=quality)
+        crop_metrics.add("output_bytes", len(image_bytes))
+        self._record(instruction, "ok", job, result, crop_metrics)
+        return {
+            "crop_coordinates": result['crop_coordinates'],
+            "final_coordinates": final_coords,
+            "description": result.get('description'),
+            "near_duplicate": result.get('near_duplicate'),
+            "tier": result.get('tier'),
+            "width": cropped_img.width,
+            "height": cropped_img.height,
+            "format": image_format,
+            "image_bytes": image_bytes,
+        }
+
+    def _record(self, instruction, status, job, result, crop_metrics=None):
+        if self.metrics_writer is None:
+            return
+        with self._lock:
+            index = self.completed
+        self.metrics_writer.record(cropping.metrics_record(
+            index, job.sha256, instruction, status, job=job, result=result, crop_metrics=crop_metrics
+        ))
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "active": self.active,
+                "queued": self.pending - self.active,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+            }
+        if self.limiter is not None:
+            stats["api"] = self.limiter.stats()
+        if self.memory_budget is not None:
+            stats["memory"] = self.memory_budget.stats()
+        if self.near_duplicates is not None:
+            stats["near_duplicates"] = self.near_duplicates.stats()
+        if self.escalation is not None:
+            stats["escalation"] = self.escalation.stats()
+        return stats
+
+
+class CropRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive で接続を使い回せるようにする
+    protocol_version = "HTTP/1.1"
+    service = None
+    max_body_bytes = 50 * 1024 * 1024
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # --quiet の場合はアクセスログも出力しない
+        if not cropping.QUIET:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._send(200, {"status": "ok", **self.service.stats()})
+        else:
+            self._send(404, {"error": "見つかりません"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/crop":
+            self._send(404, {"error": "見つかりません"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > self.max_body_bytes:
+            self.close_connection = True
+            self._send(413 if length > 0 else 400, {"error": "リクエストの本文が空か、サイズの上限を超えています"})
+            return
+        body = self.rfile.read(length)
+
+        try:
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                payload = json.loads(body)
+                params.update({key: value for key, value in payload.items() if key != "image"})
+                body = base64.b64decode(payload["image"])
+            if not params.get("instruction"):
+                raise ValueError("instruction を指定してください")
+            image_format = params.get("format", "jpg")
+            if image_format.lower() not in cropping.IMAGE_FORMATS:
+                raise ValueError(f"対応していない出力形式です: {image_format}")
+            task = dict(
+                aspect_ratio=params.get("aspect_ratio", "16:9"),
+                resize_width=int(params.get("resize_width", 0)),
+                resize_height=int(params.get("resize_height", 0)),
+                image_format=image_format,
+                quality=int(params.get("quality", 95)),
+            )
+            # ヘッダーのみを解析して画像として読み込めるか確認する
+            job = cropping.ImageJob(body, large_image_bytes=self.service.large_image_bytes)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self._send(400, {"error": str(e)})
+            return
+
+        if not self.service.try_admit():
+            self._send(503, {"error": "処理待ちのリクエストが上限に達しています"}, headers={"Retry-After": "1"})
+            return
+        try:
+            result = self.service.process(job, params["instruction"], **task)
+        except ValueError as e:
+            self._send(422, {"error": str(e)})
+            return
+        except Exception as e:
+            self._send(502, {"error": f"クロップ処理中にエラーが発生しました: {e}"})
+            return
+
+        image_bytes = result.pop("image_bytes")
+        if params.get("output") == "image":
+            # 画像のバイト列をそのまま返し、座標などはヘッダーに入れる
+            headers = {
+                "X-Crop-Coordinates": json.dumps(result["crop_coordinates"]),
+                "X-Final-Coordinates": json.dumps(result["final_coordinates"]),
+            }
+            mime = cropping.IMAGE_FORMATS.get(image_format.lower(), "JPEG").lower()
+            self._send(200, image_bytes, content_type=f"image/{mime}", headers=headers)
+        else:
+            result["image"] = base64.b64encode(image_bytes).decode('ascii')
+            self._send(200, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='クロップ処理を常駐させるHTTPサーバー')
+    parser.add_argument('--host', default='127.0.0.1', help='待ち受けるアドレス(デフォルト: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='待ち受けるポート(デフォルト: 8080)')
+    parser.add_argument('--backend', choices=sorted(cropping.CROP_BACKENDS), default='gpt', help='クロップ座標を求める方法(デフォルト: gpt)')
+    parser.add_argument('--fallback', choices=sorted(cropping.CROP_BACKENDS), default=None, help='バックエンドが失敗した場合に使う方法')
+    parser.add_argument('--max_concurrency', type=int, default=4, help='同時に処理するリクエスト数の上限(デフォルト: 4)')
+    parser.add_argument('--max_queue', type=int, default=16, help='処理待ちにできるリクエスト数の上限。超えた場合は503を返す(デフォルト: 16)')
+    parser.add_argument('--large_image_mb', type=float, default=0, help='デコード後のサイズがこれを超える画像を、クロップ領域だけをデコードして処理する(MB)。0の場合は使わない(デフォルト: 0)')
+    parser.add_argument('--memory_budget_mb', type=float, default=0, help='同時に処理する画像のメモリ量の上限(MB)。0の場合は上限なし(デフォルト: 0)')
+    parser.add_argument('--max_body_mb', type=float, default=50, help='受け付ける画像サイズの上限(MB)(デフォルト: 50)')
+    parser.add_argument('--api_base_url', default=None, help='APIの接続先URL（テスト用のモックサーバーなど）')
+    parser.add_argument('--structured_output', action='store_true', help='構造化出力（JSONスキーマ）で応答を受け取る')
+    parser.add_argument('--fast_model', default=None, help='まず問い合わせる軽量なモデル（local の場合はローカル推定）。必要な場合だけ大きいモデルで取り直す')
+    parser.add_argument('--escalation_confidence', type=float, default=0.6, help='軽量なモデルの確からしさがこれ未満の場合に大きいモデルで取り直す(デフォルト: 0.6)')
+    parser.add_argument('--escalation_max_area', type=float, default=0.9, help='軽量なモデルの領域の面積比がこれ以上の場合に大きいモデルで取り直す(デフォルト: 0.9)')
+    parser.add_argument('--escalation_min_area', type=float, default=0.01, help='軽量なモデルの領域の面積比がこれ未満の場合に大きいモデルで取り直す(デフォルト: 0.01)')
+    parser.add_argument('--api_timeout', type=float, default=0, help='API呼び出しのタイムアウト(秒)。0の場合はクライアントの既定値(デフォルト: 0)')
+    parser.add_argument('--max_rpm', type=int, default=0, help='1分あたりのAPIリクエスト数の上限。0の場合は応答のレート制限ヘッダーのみに従う(デフォルト: 0)')
+    parser.add_argument('--max_tpm', type=int, default=0, help='1分あたりのトークン数の上限。0の場合は応答のレート制限ヘッダーのみに従う(デフォルト: 0)')
+    parser.add_argument('--max_retries', type=int, default=5, help='429や一時的なエラーの場合にリトライする最大回数(デフォルト: 5)')
+    parser.add_argument('--retry_deadline', type=float, default=60, help='1回のAPI呼び出しでリトライを続ける期限(秒)(デフォルト: 60)')
+    parser.add_argument('--proxy_max_edge', type=int, default=0, help='API送信用の縮小プロキシ画像の長辺(px)。0の場合は元画像を送信(デフォルト: 0)')
+    parser.add_argument('--proxy_quality', type=int, default=85, help='縮小プロキシ画像のJPEG品質(デフォルト: 85)')
+    parser.add_argument('--cache', default=None, help='API応答キャッシュのSQLiteファイルのパス')
+    parser.add_argument('--near_duplicate_index', default=None, help='似た画像のクロップ座標を再利用するインデックス（SQLite）のパス')
+    parser.add_argument('--near_duplicate_distance', type=int, default=6, help='似た画像とみなす知覚ハッシュのハミング距離の上限(デフォルト: 6)')
+    parser.add_argument('--metrics', default=None, help='処理段ごとの時間・送信量・トークン数を書き出すパス（.prom の場合はPrometheusのテキスト形式）')
+    parser.add_argument('--quiet', action='store_true', help='リクエストごとの経過出力を行わない')
+    args = parser.parse_args()
+
+    cropping.QUIET = args.quiet
+
+    cache = ResponseCache(args.cache) if args.cache else None
+    near_duplicates = None
+    if args.near_duplicate_index:
+        from perceptual_index import NearDuplicateIndex
+        near_duplicates = NearDuplicateIndex(args.near_duplicate_index, max_distance=args.near_duplicate_distance)
+    escalation = None
+    if args.fast_model:
+        escalation = EscalationPolicy(args.fast_model, min_confidence=args.escalation_confidence,
+                                      max_area=args.escalation_max_area, min_area=args.escalation_min_area)
+    limiter = RateLimiter(
+        max_rpm=args.max_rpm,
+        max_tpm=args.max_tpm,
+        max_concurrency=args.max_concurrency,
+        max_retries=args.max_retries,
+        deadline=args.retry_deadline
+    )
+    try:
+        service = CropService(
+            backend=args.backend,
+            fallback=args.fallback,
+            max_concurrency=args.max_concurrency,
+            max_queue=args.max_queue,
+            proxy_max_edge=args.proxy_max_edge or None,
+            proxy_quality=args.proxy_quality,
+            cache=cache,
+            timeout=args.api_timeout or None,
+            base_url=args.api_base_url,
+            metrics_writer=MetricsWriter(args.metrics) if args.metrics else None,
+            structured=args.structured_output,
+            limiter=limiter,
+            large_image_bytes=int(args.large_image_mb * 1024 * 1024),
+            memory_budget=MemoryBudget(int(args.memory_budget_mb * 1024 * 1024)) if args.memory_budget_mb > 0 else None,
+            near_duplicates=near_duplicates,
+            escalation=escalation,
+        )
+    except ValueError as e:
+        print(f"エラー: {e}")
+        return
+
+    CropRequestHandler.service = service
+    CropRequestHandler.max_body_bytes = int(args.max_body_mb * 1024 * 1024)
+    server = ThreadingHTTPServer((args.host, args.port), CropRequestHandler)
+    print(f"クロップサーバーを起動しました: http://{args.host}:{args.port}/crop "
+          f"(同時処理数: {args.max_concurrency}, 待ち行列: {args.max_queue})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("サーバーを停止します")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
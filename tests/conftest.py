@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# cropping.py などのモジュールと、ベンチマークの補助関数（benchmarks/）を読み込めるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture(autouse=True)
+def quiet_cropping():
+    """経過出力を行わない"""
+    import cropping
+    previous = cropping.QUIET
+    cropping.QUIET = True
+    yield
+    cropping.QUIET = previous
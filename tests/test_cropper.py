@@ -0,0 +1,40 @@
+"""ライブラリAPI（Cropper）は標準出力へ出力しない"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import cropping
+from cropper import Cropper
+
+
+def _image_bytes(image_format):
+    pixels = np.random.default_rng(0).integers(0, 256, (600, 800, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def verbose(monkeypatch):
+    """CLIと同じく経過出力を行う設定にする（Cropper の中で止まることを確認する）"""
+    monkeypatch.setattr(cropping, "QUIET", False)
+
+
+@pytest.mark.parametrize("image_format", ["PNG", "JPEG", "BMP"])
+@pytest.mark.parametrize("renditions", [None, ["width=160,format=webp"]])
+def test_large_image_crop_prints_nothing(verbose, capsys, image_format, renditions):
+    cropper = Cropper(backend="local", large_image_bytes=1, resize_width=320, renditions=renditions)
+    result = cropper.crop(_image_bytes(image_format), "中央を切り出す")
+    assert result["image"]
+    assert capsys.readouterr().out == ""
+
+
+def test_failed_partial_decode_prints_nothing(verbose, capsys, monkeypatch):
+    # 部分的なデコードに失敗して画像全体のデコードに戻る場合の警告も出力しない
+    monkeypatch.setattr(cropping, "partial_decode_plan", lambda img, box: ([("zip", (0, 0, 1, 1), 10 ** 9, "RGB")], 1))
+    cropper = Cropper(backend="local", large_image_bytes=1, renditions=["height=120"])
+    result = cropper.crop(_image_bytes("PNG"), "中央を切り出す")
+    assert result["renditions"][0]["height"] == 120
+    assert capsys.readouterr().out == ""
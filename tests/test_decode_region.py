@@ -0,0 +1,150 @@
+"""大きい画像モードの部分的なデコード（decode_region）
+
+PNG・タイル形式のTIFFの部分的なデコードは Pillow の公開されていない仕組みに依存するため、Pillow を更新して
+使えなくなった場合に画像全体のデコードに戻ったことに気付けるよう、部分的なデコードが選ばれることを確認する。
+PARTIAL_DECODE_PILLOW_VERSIONS の各バージョンで実行する（例: pip install --target /tmp/pillow11 "pillow==11.*" の後、
+PYTHONPATH=/tmp/pillow11 python -m pytest tests/test_decode_region.py）。
+"""
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import cropping
+
+BOX = (100, 40, 400, 200)
+SIZE = (800, 600)
+
+
+def _save(path, image_format, mode="RGB", **options):
+    pixels = np.random.default_rng(0).integers(0, 256, (SIZE[1], SIZE[0], 4), dtype=np.uint8)
+    Image.fromarray(pixels).convert(mode).save(path, image_format, **options)
+    return str(path)
+
+
+def _large_job(path, in_memory=False):
+    if in_memory:
+        with open(path, "rb") as f:
+            job = cropping.ImageJob(f.read(), large_image_bytes=1)
+    else:
+        job = cropping.ImageJob.from_path(path, large_image_bytes=1)
+    assert job.large
+    return job
+
+
+def _full_crop(path, box=BOX):
+    with Image.open(path) as img:
+        img.load()
+        return img.crop(box)
+
+
+def _assert_same(region, expected):
+    assert region.mode == expected.mode
+    assert region.size == expected.size
+    assert np.array_equal(np.asarray(region), np.asarray(expected))
+
+
+def test_installed_pillow_supports_partial_decode():
+    assert cropping.PARTIAL_DECODE, f"Pillow {Image.__version__} で部分的なデコードが使えなくなりました"
+
+
+@pytest.mark.parametrize("version, expected", [("11.0.0", True), ("12.3.0", True), ("10.4.0", False),
+                                               ("13.0.0", False), ("dev", False)])
+def test_partial_decode_supported(version, expected):
+    assert cropping.partial_decode_supported(version) is expected
+
+
+@pytest.mark.parametrize("name, image_format, mode, options", [
+    ("rgb.tif", "TIFF", "RGB", {"compression": None}),
+    ("gray.tif", "TIFF", "L", {"compression": None}),
+    ("rgba.tif", "TIFF", "RGBA", {"compression": None}),
+    # BMPは下の行から順に保存される
+    ("rgb.bmp", "BMP", "RGB", {}),
+    ("gray.bmp", "BMP", "L", {}),
+])
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_uncompressed_formats_read_only_region_rows(tmp_path, name, image_format, mode, options, in_memory):
+    path = _save(tmp_path / name, image_format, mode, **options)
+    job = _large_job(path, in_memory)
+    with job.open() as img:
+        region = cropping.read_raw_region(job, img, BOX)
+    assert region is not None
+    _assert_same(region, _full_crop(path))
+    _assert_same(cropping.decode_region(job, BOX), _full_crop(path))
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_png_decodes_only_top_rows(tmp_path, mode):
+    path = _save(tmp_path / "image.png", "PNG", mode)
+    job = _large_job(path)
+    with job.open() as img:
+        assert cropping.read_raw_region(job, img, BOX) is None
+        plan = cropping.partial_decode_plan(img, BOX)
+    assert plan is not None
+    tiles, bottom = plan
+    assert bottom == BOX[3]
+    assert tiles[0].extents == (0, 0, SIZE[0], BOX[3])
+    _assert_same(cropping.decode_region(job, BOX), _full_crop(path))
+
+
+@pytest.mark.parametrize("name, image_format, options", [
+    ("image.jpg", "JPEG", {}),
+    ("deflate.tif", "TIFF", {"compression": "tiff_deflate"}),
+])
+def test_compressed_formats_decode_whole_image(tmp_path, name, image_format, options):
+    path = _save(tmp_path / name, image_format, **options)
+    job = _large_job(path)
+    with job.open() as img:
+        assert cropping.read_raw_region(job, img, BOX) is None
+        assert cropping.partial_decode_plan(img, BOX) is None
+    _assert_same(cropping.decode_region(job, BOX), _full_crop(path))
+
+
+def test_unsupported_pillow_decodes_png_whole(tmp_path, monkeypatch):
+    path = _save(tmp_path / "image.png", "PNG")
+    job = _large_job(path)
+    monkeypatch.setattr(cropping, "PARTIAL_DECODE", False)
+    with job.open() as img:
+        assert cropping.partial_decode_plan(img, BOX) is None
+    _assert_same(cropping.decode_region(job, BOX), _full_crop(path))
+
+
+def test_failed_partial_decode_falls_back_quietly(tmp_path, monkeypatch, capsys):
+    path = _save(tmp_path / "image.png", "PNG")
+    job = _large_job(path)
+    monkeypatch.setattr(cropping, "partial_decode_plan", lambda img, box: ([("zip", (0, 0, 1, 1), 10 ** 9, "RGB")], 1))
+    with cropping.quiet():
+        _assert_same(cropping.decode_region(job, BOX), _full_crop(path))
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="開いているファイルを数えられない")
+@pytest.mark.parametrize("name, image_format", [("image.png", "PNG"), ("image.bmp", "BMP"), ("image.jpg", "JPEG")])
+def test_decode_region_closes_files(tmp_path, name, image_format):
+    path = _save(tmp_path / name, image_format)
+    job = _large_job(path)
+    cropping.decode_region(job, BOX)
+    before = len(os.listdir("/proc/self/fd"))
+    for _ in range(20):
+        cropping.decode_region(job, BOX)
+    assert len(os.listdir("/proc/self/fd")) == before
+
+
+
+
+def test_reduced_jpeg_decode_closes_file_on_error(tmp_path, monkeypatch):
+    # デコードに失敗した場合も、縮小デコードで開いたファイルを閉じる
+    path = _save(tmp_path / "image.jpg", "JPEG")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    job = _large_job(path)
+    opened = []
+    open_image = cropping.ImageJob.open
+    monkeypatch.setattr(cropping.ImageJob, "open", lambda self: opened.append(open_image(self)) or opened[-1])
+    with pytest.raises(OSError):
+        cropping.crop_and_resize_reduced(job, BOX, (75, 40))
+    assert opened
+    assert all(img.fp is None for img in opened)
@@ -0,0 +1,57 @@
+import io
+
+import pytest
+from PIL import Image
+
+import cropping
+
+
+def _image(mode):
+    img = Image.new(mode, (40, 30))
+    if mode in ('RGBA', 'LA'):
+        # 透過部分は白背景になる
+        img.putalpha(0)
+    return img
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("RGB", "RGB"),
+    ("L", "L"),
+    ("CMYK", "CMYK"),
+    ("P", "RGB"),
+    ("RGBA", "RGB"),
+    ("LA", "RGB"),
+    ("I", "RGB"),
+])
+def test_jpeg_converts_only_modes_jpeg_cannot_store(mode, expected):
+    img = Image.open(io.BytesIO(cropping.encode_image(_image(mode), 'jpg')))
+    assert img.format == "JPEG"
+    assert img.mode == expected
+    if mode in ('RGBA', 'LA'):
+        assert img.getpixel((0, 0)) == pytest.approx((255, 255, 255), abs=2)
+
+
+@pytest.mark.parametrize("extension, pil_format", [
+    (".jpg", "JPEG"), (".png", "PNG"), (".webp", "WEBP"), (".tif", "TIFF"), (".tiff", "TIFF"),
+])
+def test_encode_and_write_uses_output_extension(tmp_path, extension, pil_format):
+    path = str(tmp_path / f"out{extension}")
+    size, _, _ = cropping.encode_and_write(_image("RGBA"), path)
+    with Image.open(path) as img:
+        assert img.format == pil_format
+        assert img.mode == ("RGB" if pil_format == "JPEG" else "RGBA")
+    assert size > 0
+
+
+def test_unknown_extension_is_rejected():
+    with pytest.raises(ValueError):
+        cropping.encode_image(_image("RGB"), '.unknown')
+
+
+def test_webp_quality_defaults_to_pillow_default():
+    img = Image.effect_noise((64, 64), 50).convert('RGB')
+    default = cropping.encode_image(img, 'webp')
+    buffer = io.BytesIO()
+    img.save(buffer, 'WEBP')
+    assert default == buffer.getvalue()
+    assert len(cropping.encode_image(img, 'webp', quality=95)) > len(default)
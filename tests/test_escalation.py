@@ -0,0 +1,97 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import cropping
+from escalation import EscalationPolicy
+
+FAST_MODEL = "gpt-4.1-mini"
+
+
+class _ModelClient:
+    """モデルごとに決まった応答本文を返す OpenAI クライアントの代わり（chat.completions.create のみ）"""
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.chat = SimpleNamespace(completions=self)
+        self.models = []
+
+    def create(self, **body):
+        from openai.types.chat import ChatCompletion
+
+        self.models.append(body["model"])
+        return ChatCompletion.model_validate({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps(self.contents[body["model"]])}}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        })
+
+
+@pytest.fixture
+def image_job(tmp_path):
+    path = str(tmp_path / "image.jpg")
+    Image.new('RGB', (640, 480), (120, 120, 120)).save(path)
+    return cropping.ImageJob.from_path(path)
+
+
+def _result(x_min=100, y_min=80, x_max=420, y_max=260, **extra):
+    return {"crop_coordinates": {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max},
+            "description": "手元", **extra}
+
+
+@pytest.mark.parametrize("coords, valid", [
+    ({"x_min": 10, "y_min": 10, "x_max": 100, "y_max": 80}, True),
+    ({"x_min": 10.5, "y_min": 10, "x_max": 100, "y_max": 80}, True),
+    ({"x_min": None, "y_min": 10, "x_max": 100, "y_max": 80}, False),
+    ({"x_min": "10", "y_min": 10, "x_max": 100, "y_max": 80}, False),
+    ({"x_min": True, "y_min": 10, "x_max": 100, "y_max": 80}, False),
+    ({"x_min": float("nan"), "y_min": 10, "x_max": 100, "y_max": 80}, False),
+    ({"x_min": 100, "y_min": 10, "x_max": 100, "y_max": 80}, False),
+    ({"x_min": 10, "y_min": 80, "x_max": 100, "y_max": 20}, False),
+    ({"x_min": 10, "y_min": 10, "x_max": 100}, False),
+])
+def test_validate_crop_result_coordinates(coords, valid):
+    assert (cropping.validate_crop_result({"crop_coordinates": coords}) is None) is valid
+
+
+@pytest.mark.parametrize("result, expected", [
+    (_result(confidence=0.9), None),
+    (_result(confidence=0.2), "low_confidence"),
+    (_result(0, 0, 640, 480, confidence=0.9), "full_frame"),
+    (_result(100, 100, 105, 105, confidence=0.9), "degenerate"),
+    (_result(x_min=None, confidence=0.9), "invalid"),
+    (_result(y_max="260", confidence=0.9), "invalid"),
+])
+def test_escalation_reason(result, expected):
+    assert EscalationPolicy(FAST_MODEL).escalation_reason(result, (640, 480)) == expected
+
+
+def test_malformed_fast_result_is_escalated(image_job):
+    client = _ModelClient({
+        FAST_MODEL: _result(x_min=None, confidence=0.9),
+        cropping.MODEL_NAME: _result(),
+    })
+    escalation = EscalationPolicy(FAST_MODEL)
+    results = cropping.analyze_image(image_job, ["手元"], client=client, escalation=escalation)
+
+    assert client.models == [FAST_MODEL, cropping.MODEL_NAME]
+    assert cropping.validate_crop_result(results[0]) is None
+    assert results[0]["tier"] == "full"
+    assert results[0]["escalation"] == "invalid"
+    assert escalation.stats()["reasons"] == {"invalid": 1}
+
+
+def test_confident_fast_result_is_kept(image_job):
+    client = _ModelClient({FAST_MODEL: _result(confidence=0.9)})
+    escalation = EscalationPolicy(FAST_MODEL)
+    results = cropping.analyze_image(image_job, ["手元"], client=client, escalation=escalation)
+
+    assert client.models == [FAST_MODEL]
+    assert results[0]["tier"] == "fast"
+    assert escalation.stats()["escalated"] == 0
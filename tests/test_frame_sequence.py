@@ -0,0 +1,92 @@
+import sys
+
+import pytest
+from PIL import Image, ImageDraw
+
+import cropping
+import review_gallery
+from frame_sequence import build_contact_sheet, choose_keyframes, map_sheet_box, scan_scenes
+
+RED = (220, 30, 30)
+BLUE = (30, 30, 220)
+
+
+@pytest.fixture
+def two_scene_gif(tmp_path):
+    """赤い四角のシーン（短い）と青い円のシーン（長い）の2フレームのGIF"""
+    red = Image.new('RGB', (640, 480), (255, 255, 255))
+    ImageDraw.Draw(red).rectangle((100, 80, 300, 260), fill=RED)
+    blue = Image.new('RGB', (640, 480), (255, 255, 255))
+    ImageDraw.Draw(blue).ellipse((300, 200, 500, 400), fill=BLUE)
+    path = str(tmp_path / "clip.gif")
+    red.save(path, save_all=True, append_images=[blue], duration=[100, 900])
+    return path
+
+
+def _tiles(size=(160, 90), count=3):
+    _, tiles = build_contact_sheet([Image.new('RGB', size) for _ in range(count)], tile_edge=size[0])
+    return tiles
+
+
+def test_map_sheet_box_uses_tile_with_largest_overlap():
+    tiles = _tiles()
+    left, top, right, bottom = tiles[1]
+    box = {"x_min": left + 40, "y_min": top + 18, "x_max": left + 120, "y_max": top + 72}
+    position, coords = map_sheet_box(box, tiles, [(1600, 900)] * 3)
+    assert position == 1
+    assert coords == {"x_min": 400, "y_min": 180, "x_max": 1200, "y_max": 720}
+
+
+def test_map_sheet_box_clamps_box_spanning_tiles():
+    tiles = _tiles()
+    first, second = tiles[0], tiles[1]
+    box = {"x_min": first[0] + 100, "y_min": first[1], "x_max": second[0] + 20, "y_max": first[3]}
+    position, coords = map_sheet_box(box, tiles, [(160, 90)] * 3)
+    assert position == 0
+    assert coords == {"x_min": 100, "y_min": 0, "x_max": 160, "y_max": 90}
+
+
+def test_map_sheet_box_moves_box_in_empty_cell_into_nearest_tile():
+    # 3枚を2列に並べると右下のマスは空く（中心が最も近いのは上のフレーム）
+    tiles = _tiles()
+    cell_left = tiles[1][0]
+    cell_top = tiles[2][1]
+    box = {"x_min": cell_left + 40, "y_min": cell_top + 20, "x_max": cell_left + 120, "y_max": cell_top + 70}
+    position, coords = map_sheet_box(box, tiles, [(160, 90)] * 3)
+    assert position == 1
+    # 中心をフレームの下端に移してから、フレームの範囲内に収める
+    assert coords == {"x_min": 40, "y_min": 65, "x_max": 120, "y_max": 90}
+
+
+def test_scenes_and_keyframes(two_scene_gif):
+    scenes = scan_scenes(two_scene_gif)
+    assert [(scene["start"], scene["end"]) for scene in scenes] == [(0, 0), (1, 1)]
+    assert [scene["duration"] for scene in scenes] == [100, 900]
+    assert [scene["name"] for scene in choose_keyframes(scenes, 1)] == ["clip.gif#1"]
+    assert [scene["frame"] for scene in choose_keyframes(scenes, 4)] == [0, 1]
+
+
+def test_gallery_loads_the_referenced_gif_frame(two_scene_gif):
+    img, size = review_gallery._load_fitted(f"{two_scene_gif}#1", (320, 240))
+    assert size == (640, 480)
+    assert img.getpixel((200, 150)) == pytest.approx(BLUE, abs=40)
+    assert review_gallery._load_fitted(f"{two_scene_gif}#5", (320, 240)) == (None, None)
+
+
+def test_frames_cli_records_chosen_gif_frame_for_gallery(two_scene_gif, tmp_path, monkeypatch):
+    records = []
+    monkeypatch.setattr(cropping, "write_review_gallery", lambda found, review_dir, workers=0: records.extend(found))
+    monkeypatch.setattr(sys, "argv", [
+        "cropping.py", "--frames", two_scene_gif, "--instruction", "手元", "--frame_mode", "best", "--backend", "local",
+        "--output_dir", str(tmp_path / "output"), "--review_dir", str(tmp_path / "review"), "--display", "off", "--quiet",
+    ])
+    cropping.main()
+
+    assert len(records) == 1
+    assert records[0]['status'] == "ok"
+    assert records[0]['image'] == f"{two_scene_gif}#1"
+    assert records[0]['frame']['index'] == 1
+    # パネルの元画像（320x240 に縮小）は青い円のフレームで、赤い四角のフレームではない
+    panel = review_gallery.render_panel(records[0])
+    assert panel.getpixel((200, 150)) == pytest.approx(BLUE, abs=40)
+    assert panel.getpixel((100, 85)) == pytest.approx((255, 255, 255), abs=40)
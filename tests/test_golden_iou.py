@@ -0,0 +1,86 @@
+"""記録したAPI応答（benchmarks/replay/golden.json）を再生して、最終的なクロップ領域と正解領域の IoU を確認する
+
+ネットワークは使わない。処理時間の比較は benchmarks/bench_pipeline.py で行う。
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import cropping
+from bench_pipeline import GOLDEN_PATH, ReplayClient, image_path, iou, load_golden, make_image
+
+# bench_pipeline.py の --min_iou の既定値と同じ
+MIN_IOU = 0.5
+LARGE_IMAGE_BYTES = 64 * 1024 * 1024
+# 出力画像と、画像全体をデコードして切り出した画像の1画素あたりの平均誤差の上限（JPEG の圧縮と縮小の方法の違いを許容する）
+MAX_PIXEL_ERROR = 4
+
+CASES = load_golden(GOLDEN_PATH)["cases"]
+
+
+@pytest.fixture(scope="module")
+def image_dir(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("golden"))
+    for case in CASES:
+        make_image(case["image"], image_path(directory, case))
+    return directory
+
+
+@pytest.mark.parametrize("proxy_max_edge", [None, 1024])
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_golden_iou(case, proxy_max_edge, image_dir, tmp_path):
+    client = ReplayClient(CASES)
+    job = cropping.ImageJob.from_path(image_path(image_dir, case), large_image_bytes=LARGE_IMAGE_BYTES)
+    result = cropping.crop_image_with_gpt(job, case["instruction"], proxy_max_edge=proxy_max_edge, client=client)
+    assert cropping.validate_crop_result(result) is None
+
+    cropped_img, final_coords = cropping.crop_and_save_image(job, result["crop_coordinates"], str(tmp_path / "out.jpg"))
+    assert cropped_img is not None
+    assert iou(final_coords, case["golden"]) >= MIN_IOU
+    assert client.calls == 1
+
+
+def _reference_crop(path, box, size):
+    """画像全体をデコードして切り出し、size にリサイズしたRGB画像（出力の比較用）"""
+    with Image.open(path) as full:
+        full.load()
+        crop = cropping.convert_to_rgb(full.crop(box))
+    return crop.resize(size, Image.Resampling.LANCZOS)
+
+
+@pytest.mark.parametrize("large_image_bytes", [0, 1])
+@pytest.mark.parametrize("resize_width", [None, 160])
+@pytest.mark.parametrize("extension", ["jpg", "png"])
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_golden_output(case, extension, resize_width, large_image_bytes, image_dir, tmp_path):
+    """画像モード（P/RGBA/LA）・出力形式・縮小デコード・大きい画像モードの組み合わせで、出力画像が正しい領域を切り出しているか
+
+    JPEG で保存できないモードは encode_image で RGB に変換し、PNG ではモードをそのまま保存する。
+    resize_width を指定すると縮小デコード（crop_and_resize_reduced）、large_image_bytes=1 では
+    大きい画像モード（decode_region・JPEG の draft）を通る。
+    """
+    source = image_path(image_dir, case)
+    job = cropping.ImageJob.from_path(source, large_image_bytes=large_image_bytes)
+    assert job.large == (large_image_bytes == 1)
+    output_path = str(tmp_path / f"out.{extension}")
+    result = cropping.crop_image_with_gpt(job, case["instruction"], client=ReplayClient(CASES))
+    cropped_img, final_coords = cropping.crop_and_save_image(job, result["crop_coordinates"], output_path,
+                                                             resize_width=resize_width)
+    assert cropped_img is not None
+    assert iou(final_coords, case["golden"]) >= MIN_IOU
+
+    box = tuple(final_coords[key] for key in ("x_min", "y_min", "x_max", "y_max"))
+    with Image.open(output_path) as output:
+        output.load()
+    if resize_width:
+        assert output.width == resize_width
+    else:
+        assert output.size == (box[2] - box[0], box[3] - box[1])
+    if extension == "jpg":
+        assert output.mode == "RGB"
+    else:
+        assert output.mode == case["image"]["mode"]
+
+    expected = np.asarray(_reference_crop(source, box, output.size), dtype=np.int16)
+    actual = np.asarray(cropping.convert_to_rgb(output), dtype=np.int16)
+    assert np.abs(actual - expected).mean() < MAX_PIXEL_ERROR
@@ -0,0 +1,118 @@
+import os
+import json
+import threading
+
+import pytest
+from PIL import Image, ImageDraw
+
+import cropping
+from job_journal import JobJournal, make_job_key
+
+
+class _Crash(BaseException):
+    """バッチ処理の強制終了の代わり（行ごとのエラーとして扱われないように BaseException を使う）"""
+
+
+def _make_image(path, color):
+    img = Image.new('RGB', (320, 240), (200, 200, 200))
+    ImageDraw.Draw(img).ellipse((120, 80, 220, 170), fill=color)
+    img.save(path, quality=90)
+    return path
+
+
+def _write_manifest(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        for image, instruction in rows:
+            f.write(json.dumps({"image": image, "instruction": instruction}, ensure_ascii=False) + "\n")
+    return path
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    images = [_make_image(str(tmp_path / f"image_{number}.jpg"), color)
+              for number, color in enumerate([(220, 60, 40), (40, 60, 220), (40, 160, 60)])]
+    return _write_manifest(str(tmp_path / "manifest.jsonl"), [(image, f"工程{number + 1}") for number, image in enumerate(images)])
+
+
+def test_claim_finish_and_resume(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = JobJournal(path, worker_id="host:1")
+    key = make_job_key("hash", "工程1")
+
+    assert journal.claim(key, image="a.jpg", instruction="工程1") is None
+    journal.finish(key, "ok", {"output": "out.jpg"}, image="a.jpg", instruction="工程1")
+
+    resumed = JobJournal(path, worker_id="host:2").claim(key)
+    assert resumed["status"] == "ok"
+    assert resumed["record"] == {"output": "out.jpg"}
+
+
+def test_failed_job_is_claimed_again(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal = JobJournal(path, worker_id="host:1")
+    key = make_job_key("hash", "工程1")
+    journal.claim(key)
+    journal.finish(key, "error", {"error": "timeout"})
+
+    assert JobJournal(path, worker_id="host:2").claim(key) is None
+
+
+def test_running_job_of_other_worker_is_busy_until_lease_expires(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    # 別のホストのワーカーはプロセスの有無を確認できないため、期限までは処理中として扱う
+    JobJournal(path, worker_id="other-host:1").claim("key")
+    assert JobJournal(path, worker_id="this-host:1").claim("key")["status"] == "running"
+
+    JobJournal(path, lease=-1, worker_id="other-host:2").claim("expired")
+    assert JobJournal(path, worker_id="this-host:1").claim("expired") is None
+
+
+def test_run_batch_resumes_completed_rows(tmp_path, manifest):
+    journal_path = str(tmp_path / "journal.sqlite3")
+    first = cropping.run_batch(manifest, output_dir=str(tmp_path / "output"), backend="local", concurrency=1,
+                               crop_workers=1, journal=JobJournal(journal_path))
+    assert [record['status'] for record in first] == ["ok"] * 3
+
+    second = cropping.run_batch(manifest, output_dir=str(tmp_path / "output"), backend="local", concurrency=1,
+                                crop_workers=1, journal=JobJournal(journal_path))
+    assert all(record['resumed'] for record in second)
+    assert [record['output'] for record in second] == [record['output'] for record in first]
+
+
+def test_rows_are_finished_before_the_api_phase_ends(tmp_path, manifest, monkeypatch):
+    """API呼び出しの途中で中断しても、保存済みの行はジャーナルで完了になり、再開時に問い合わせ直さない"""
+    journal_path = str(tmp_path / "journal.sqlite3")
+    analyze_image = cropping.analyze_image
+    saved = threading.Event()
+
+    class CountingJournal(JobJournal):
+        def finish(self, key, status, record=None, image=None, instruction=None):
+            super().finish(key, status, record, image=image, instruction=instruction)
+            if self.completed >= 2:
+                saved.set()
+
+    def crash_on_last_row(image, instructions, **options):
+        if instructions == ["工程3"]:
+            # 先の2行の保存と記録を待ってから中断する
+            saved.wait(10)
+            raise _Crash()
+        return analyze_image(image, instructions, **options)
+
+    monkeypatch.setattr(cropping, "analyze_image", crash_on_last_row)
+    with pytest.raises(_Crash):
+        cropping.run_batch(manifest, output_dir=str(tmp_path / "output"), backend="local", concurrency=1,
+                           crop_workers=1, journal=CountingJournal(journal_path))
+    assert JobJournal(journal_path).summary() == {"ok": 2, "running": 1}
+
+    analyzed = []
+
+    def record_calls(image, instructions, **options):
+        analyzed.extend(instructions)
+        return analyze_image(image, instructions, **options)
+
+    monkeypatch.setattr(cropping, "analyze_image", record_calls)
+    records = cropping.run_batch(manifest, output_dir=str(tmp_path / "output"), backend="local", concurrency=1,
+                                 crop_workers=1, journal=JobJournal(journal_path))
+    assert analyzed == ["工程3"]
+    assert [record['resumed'] for record in records] == [True, True, False]
+    assert all(os.path.exists(record['output']) for record in records)
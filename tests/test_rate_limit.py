@@ -0,0 +1,83 @@
+import pytest
+
+from rate_limit import RateLimiter, parse_duration
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("20ms", 0.02),
+    ("1h2m", 3720.0),
+    ("0.5", 0.5),
+    (None, None),
+    ("soon", None),
+])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after-ms": "20ms"}, 0.02),
+    ({"retry-after-ms": "soon"}, None),
+    ({"retry-after-ms": "soon", "retry-after": "2"}, 2.0),
+    ({"retry-after": "3"}, 3.0),
+    ({}, None),
+    (None, None),
+])
+def test_retry_after(headers, expected):
+    assert RateLimiter._retry_after(headers) == expected
+
+
+class _Response:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class _RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, headers):
+        super().__init__("rate limited")
+        self.response = _Response(headers)
+
+
+def test_call_retries_when_retry_after_is_unparsable():
+    limiter = RateLimiter(max_retries=2, base_delay=0.01, max_delay=0.01)
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise _RateLimitError({"retry-after-ms": "soon"})
+        return "ok"
+
+    assert limiter.call(func) == "ok"
+    stats = limiter.stats()
+    assert stats["retries"] == 1
+    assert stats["rate_limited"] == 1
+    assert stats["failures"] == 0
+
+
+def test_call_raises_original_error_after_retries():
+    limiter = RateLimiter(max_retries=1, base_delay=0.01, max_delay=0.01)
+
+    def func():
+        raise _RateLimitError({"retry-after-ms": "later"})
+
+    with pytest.raises(_RateLimitError):
+        limiter.call(func)
+    assert limiter.stats()["failures"] == 1
+
+
+def test_token_timeout_refunds_request_budget():
+    # トークン数の枠を期限までに取得できない場合、取得したリクエスト数の枠を戻す
+    limiter = RateLimiter(max_rpm=60, max_tpm=100, deadline=0.5)
+    assert limiter.call(lambda: "ok", tokens=100) == "ok"
+    requests_before = limiter.requests.available
+    calls = []
+    with pytest.raises(TimeoutError):
+        limiter.call(lambda: calls.append(1), tokens=100)
+    assert calls == []
+    assert limiter.requests.available >= requests_before
+    assert limiter.stats()["calls"] == 1